@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc.  All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+"""
+Measures how many bootstrap scripts per second a single process renders, with a distinct
+token per request as a provisioning service would, using the compiled template and, for
+reference, a Jinja2 rendering of the same template when Jinja2 is installed:
+
+   python3 BootstrapGenerator/benchmark.py --renders 20000
+"""
+
+import argparse
+import sys
+import time
+
+from bootstrap_generator import (PARAMETERS, TEMPLATE_DIR, TEMPLATE_FILE, BootstrapGenerator,
+                                 quote)
+
+
+def requestParams(count):
+   for i in range(count):
+      yield {"cvAddr": "www.arista.io", "ntpServer": "ntp.example.com",
+             "enrollmentToken": "eyJhbGciOiJSUzI1NiJ9.{i:016x}.signature".format(i=i)}
+
+
+def jinjaRenderer(templateDir, templateFile):
+   try:
+      import jinja2
+   except ImportError:
+      return None
+   env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=templateDir),
+                            keep_trailing_newline=True, autoescape=False)
+   template = env.get_template(templateFile)
+   def render(params):
+      return template.render(dict((name, quote(params.get(name)))
+                                  for name in PARAMETERS)).encode("utf-8")
+   return render
+
+
+def measure(name, render, count):
+   size = 0
+   startTime = time.perf_counter()
+   for params in requestParams(count):
+      size += len(render(params))
+   elapsed = time.perf_counter() - startTime
+   print("{name:>9}: {rate:10.0f} renders/s, {latency:7.1f}us per render, "
+         "{size} bytes per script".format(name=name, rate=count / elapsed,
+                                          latency=elapsed / count * 1e6,
+                                          size=size // count))
+   return count / elapsed
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--renders", type=int, default=20000)
+   parser.add_argument("--template-dir", default=TEMPLATE_DIR)
+   args = parser.parse_args(argv)
+
+   startTime = time.perf_counter()
+   generator = BootstrapGenerator(args.template_dir, TEMPLATE_FILE)
+   print("compiled the template in {elapsed:.1f}ms".format(
+      elapsed=(time.perf_counter() - startTime) * 1e3))
+   compiledRate = measure("compiled", generator.renderBytes, args.renders)
+   render = jinjaRenderer(args.template_dir, TEMPLATE_FILE)
+   if render is not None:
+      jinjaRate = measure("jinja2", render, args.renders)
+      print("{speedup:.1f}x faster than jinja2".format(speedup=compiledRate / jinjaRate))
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc.  All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+"""
+Generates the bootstrap scripts of many devices or sites from an inventory, in CSV or
+YAML, with one entry per device holding the USER INPUT values of the script:
+
+   name,mac,cvAddr,enrollmentToken,cvproxy,eosUrl,ntpServer
+   leaf1,00:1c:73:00:00:01,www.arista.io,eyJhbGciOiJSUzI1Nixxx...,,,
+
+`name`, `cvAddr` and `enrollmentToken` are required, the other columns may be left empty.
+The template is compiled once into the literal chunks between its slots, which every
+script is a join of with its quoted values, and the inventory is rendered in a streaming
+pass by parallel workers. Scripts are named after the hash of their content, so devices sharing
+the same values share a script, and scripts already present are not written again.
+A DHCP bootfile mapping of every device to its script can be emitted alongside.
+"""
+
+import argparse
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "BootstrapScriptWithToken")
+TEMPLATE_FILE = "bootstrap_template.j2"
+# USER INPUT values of the bootstrap script
+PARAMETERS = ["cvAddr", "enrollmentToken", "cvproxy", "eosUrl", "ntpServer"]
+REQUIRED_FIELDS = ["name", "cvAddr", "enrollmentToken"]
+SCRIPT_PREFIX = "bootstrap-"
+SCRIPT_SUFFIX = ".py"
+# Inventory entries handed to a worker at once
+BATCH_SIZE = 256
+
+
+class InventoryError(Exception):
+   pass
+
+
+class TemplateError(Exception):
+   pass
+
+
+def quote(value):
+   """
+   Returns the value as a Python string literal, valid for both the python2 and python3
+   interpreters the bootstrap script may run with. Non printable characters are written
+   as \\xNN escapes, which both decode alike, unlike \\uNNNN in a python2 byte string.
+   """
+   value = "" if value is None else str(value)
+   try:
+      value.encode("ascii")
+   except UnicodeEncodeError:
+      raise InventoryError("Non ASCII value {value!r}".format(value=value))
+   escaped = []
+   for char in value:
+      if char in "\"\\":
+         escaped.append("\\" + char)
+      elif " " <= char <= "~":
+         escaped.append(char)
+      else:
+         escaped.append("\\x{code:02x}".format(code=ord(char)))
+   return '"' + "".join(escaped) + '"'
+
+
+# `{{ name }}` slots and `{% raw %}` blocks, the only Jinja syntax the template may use
+TEMPLATE_TOKEN = re.compile(r"\{\{\s*(\w+)\s*\}\}|\{%\s*raw\s*%\}(.*?)\{%\s*endraw\s*%\}|"
+                            r"\{\{|\{%|\{#", re.DOTALL)
+
+
+class CompiledTemplate(object):
+   """
+   A template split once into its literal chunks and the names of the slots between
+   them. Rendering joins the chunks with the slot values, as bytes, without any parsing.
+   """
+
+   def __init__(self, source):
+      literals = []
+      self.slots = []
+      literal = []
+      position = 0
+      for match in TEMPLATE_TOKEN.finditer(source):
+         literal.append(source[position:match.start()])
+         position = match.end()
+         if match.group(1):
+            literals.append("".join(literal))
+            literal = []
+            self.slots.append(match.group(1))
+         elif match.group(2) is not None:
+            literal.append(match.group(2))
+         else:
+            raise TemplateError("Unsupported template syntax {token!r} on line {line}".format(
+               token=match.group(0), line=source.count("\n", 0, match.start()) + 1))
+      literal.append(source[position:])
+      literals.append("".join(literal))
+      # Literal chunks at even indexes, slots at odd ones
+      self.parts = [None] * (2 * len(literals) - 1)
+      self.parts[0::2] = [chunk.encode("utf-8") for chunk in literals]
+
+   def render(self, values):
+      """Joins the literal chunks with the values of the slots, given as bytes"""
+      parts = list(self.parts)
+      try:
+         parts[1::2] = [values[name] for name in self.slots]
+      except KeyError as e:
+         raise TemplateError("No value for slot {name}".format(name=e))
+      return b"".join(parts)
+
+
+@functools.lru_cache(maxsize=16)
+def _compileTemplate(path, mtime, size):
+   with open(path, encoding="utf-8") as f:
+      return CompiledTemplate(f.read())
+
+
+def loadTemplate(path):
+   """Returns the compiled template, compiled again only once the file changed"""
+   stat = os.stat(path)
+   return _compileTemplate(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class BootstrapGenerator(object):
+   """Renders the bootstrap script template, compiled once, for sets of parameters"""
+
+   def __init__(self, templateDir=TEMPLATE_DIR, templateFile=TEMPLATE_FILE):
+      self.template = loadTemplate(os.path.join(templateDir, templateFile))
+      unknown = set(self.template.slots) - set(PARAMETERS)
+      if unknown:
+         raise TemplateError("Unknown template slots {slots}".format(
+            slots=", ".join(sorted(unknown))))
+
+   def renderBytes(self, params):
+      """
+      Renders the script for the given USER INPUT values, missing ones are left empty,
+      as UTF-8 bytes
+      """
+      return self.template.render(dict((name, quote(params.get(name)).encode("ascii"))
+                                       for name in PARAMETERS))
+
+   def render(self, params):
+      return self.renderBytes(params).decode("utf-8")
+
+
+def scriptName(content):
+   """Content addressed file name of a rendered script, given as bytes"""
+   digest = hashlib.sha256(content).hexdigest()[:16]
+   return "{prefix}{digest}{suffix}".format(prefix=SCRIPT_PREFIX, digest=digest,
+                                           suffix=SCRIPT_SUFFIX)
+
+
+def writeScript(outputDir, content):
+   """
+   Writes the script unless a script with the same content is already there. Returns
+   its file name and whether it was written.
+   """
+   name = scriptName(content)
+   path = os.path.join(outputDir, name)
+   if os.path.exists(path):
+      return name, False
+   tmpPath = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+   with open(tmpPath, "wb") as f:
+      f.write(content)
+   os.chmod(tmpPath, 0o755)
+   # Unlike a rename, linking fails when another worker wrote the same script meanwhile
+   try:
+      os.link(tmpPath, path)
+   except FileExistsError:
+      return name, False
+   finally:
+      os.remove(tmpPath)
+   return name, True
+
+
+def readInventory(path):
+   """Yields the entries of a CSV or YAML inventory, one dict per device"""
+   if path.endswith((".yaml", ".yml")):
+      entries = readYamlInventory(path)
+   else:
+      entries = readCsvInventory(path)
+   names = set()
+   for i, entry in enumerate(entries, 1):
+      missing = [field for field in REQUIRED_FIELDS if not entry.get(field)]
+      if missing:
+         raise InventoryError("{path}: entry {i} misses {fields}".format(
+            path=path, i=i, fields=", ".join(missing)))
+      if entry["name"] in names:
+         raise InventoryError("{path}: duplicate name {name}".format(path=path,
+                                                                     name=entry["name"]))
+      names.add(entry["name"])
+      yield entry
+
+
+def readCsvInventory(path):
+   with open(path, newline="", encoding="utf-8") as f:
+      for row in csv.DictReader(f):
+         yield dict((key.strip(), (value or "").strip()) for key, value in row.items()
+                    if key is not None)
+
+
+def readYamlInventory(path):
+   """
+   Yields the devices of a YAML inventory, either a list of devices or a mapping with a
+   `devices` list and `defaults` applied to every device
+   """
+   try:
+      import yaml
+   except ImportError:
+      raise InventoryError("PyYAML is required to read YAML inventories, "
+                           "install it or use a CSV inventory")
+   with open(path, encoding="utf-8") as f:
+      document = yaml.safe_load(f) or []
+   defaults = {}
+   if isinstance(document, dict):
+      defaults = document.get("defaults") or {}
+      document = document.get("devices") or []
+   for device in document:
+      entry = dict(defaults)
+      entry.update(device)
+      yield dict((key, "" if value is None else str(value)) for key, value in entry.items())
+
+
+_generator = None
+
+def _initWorker(templateDir, templateFile):
+   global _generator
+   _generator = BootstrapGenerator(templateDir, templateFile)
+
+
+def _renderBatch(outputDir, batch):
+   results = []
+   for entry in batch:
+      name, written = writeScript(outputDir, _generator.renderBytes(entry))
+      results.append((entry, name, written))
+   return results
+
+
+class GenerationResult(object):
+   def __init__(self):
+      self.devices = 0
+      self.written = 0
+      self.scripts = set()
+      # (inventory entry, script file name) of every device, in inventory order
+      self.mapping = []
+
+   def add(self, entry, script, written):
+      self.devices += 1
+      self.written += written
+      self.scripts.add(script)
+      self.mapping.append((entry, script))
+
+
+def generate(inventory, outputDir, workers=1, templateDir=TEMPLATE_DIR,
+             templateFile=TEMPLATE_FILE):
+   """
+   Renders the scripts of all the inventory entries into `outputDir`. With more than one
+   worker, batches of entries are rendered by a pool of processes, at most two batches
+   per worker being in flight so that the inventory is consumed as it is read.
+   """
+   os.makedirs(outputDir, exist_ok=True)
+   result = GenerationResult()
+   inventory = iter(inventory)
+   batches = iter(lambda: list(itertools.islice(inventory, BATCH_SIZE)), [])
+   if workers <= 1:
+      _initWorker(templateDir, templateFile)
+      for batch in batches:
+         for entry, script, written in _renderBatch(outputDir, batch):
+            result.add(entry, script, written)
+      return result
+
+   context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+   with ProcessPoolExecutor(workers, mp_context=context, initializer=_initWorker,
+                            initargs=(templateDir, templateFile)) as executor:
+      pending = []
+      for batch in itertools.chain(batches, [None]):
+         if batch is not None:
+            pending.append(executor.submit(_renderBatch, outputDir, batch))
+         # Results are collected in submission order, keeping the mapping ordered
+         while pending and (batch is None or len(pending) >= 2 * workers):
+            for entry, script, written in pending.pop(0).result():
+               result.add(entry, script, written)
+   return result
+
+
+def pruneScripts(outputDir, keep):
+   """Removes the generated scripts no device uses anymore, returns how many"""
+   removed = 0
+   for name in os.listdir(outputDir):
+      if name.startswith(SCRIPT_PREFIX) and name.endswith(SCRIPT_SUFFIX) and \
+            name not in keep:
+         os.remove(os.path.join(outputDir, name))
+         removed += 1
+   return removed
+
+
+def bootfileMapping(mapping, baseUrl, dhcpFormat="json"):
+   """
+   Formats the bootfile URL of every device, as JSON keyed by device name or as ISC
+   dhcpd host declarations, the latter only for the devices with a `mac`
+   """
+   if dhcpFormat == "json":
+      devices = {}
+      for entry, script in mapping:
+         devices[entry["name"]] = {"mac": entry.get("mac", ""), "bootfile": baseUrl + script}
+      return json.dumps(devices, indent=2, sort_keys=True) + "\n"
+   lines = []
+   for entry, script in mapping:
+      if not entry.get("mac"):
+         continue
+      lines.append('host {name} {{ hardware ethernet {mac}; '
+                   'option bootfile-name "{url}"; }}'.format(name=entry["name"],
+                                                              mac=entry["mac"],
+                                                              url=baseUrl + script))
+   return "\n".join(lines) + "\n"
+
+
+def writeIfChanged(path, content):
+   """Atomically replaces the file with the given content, unless it already holds it"""
+   if os.path.exists(path):
+      with open(path, encoding="utf-8") as f:
+         if f.read() == content:
+            return False
+   tmpPath = path + ".tmp"
+   with open(tmpPath, "w", encoding="utf-8") as f:
+      f.write(content)
+   os.replace(tmpPath, path)
+   return True
+
+
+def parseArgs(argv):
+   parser = argparse.ArgumentParser(description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("inventory", help="CSV, or YAML (.yaml/.yml), inventory")
+   parser.add_argument("-o", "--output-dir", required=True,
+                       help="directory the scripts are written to")
+   parser.add_argument("-j", "--workers", type=int, default=min(os.cpu_count() or 1, 8),
+                       help="number of rendering processes")
+   parser.add_argument("--base-url", default="",
+                       help="URL the output directory is served at, prefixing the bootfiles")
+   parser.add_argument("--dhcp-map", help="file the DHCP bootfile mapping is written to")
+   parser.add_argument("--dhcp-format", choices=["json", "isc"], default="json",
+                       help="format of the DHCP bootfile mapping")
+   parser.add_argument("--prune", action="store_true",
+                       help="remove the scripts of the output directory no device uses")
+   parser.add_argument("--template-dir", default=TEMPLATE_DIR,
+                       help="directory holding the bootstrap script template")
+   return parser.parse_args(argv)
+
+
+def main(argv=None):
+   args = parseArgs(argv)
+   try:
+      result = generate(readInventory(args.inventory), args.output_dir,
+                        workers=args.workers, templateDir=args.template_dir)
+   except (InventoryError, TemplateError, OSError) as e:
+      sys.exit("Error: {err}".format(err=e))
+
+   removed = pruneScripts(args.output_dir, result.scripts) if args.prune else 0
+   if args.dhcp_map:
+      writeIfChanged(args.dhcp_map,
+                     bootfileMapping(result.mapping, args.base_url, args.dhcp_format))
+   print("{devices} devices, {scripts} distinct scripts, {written} written, "
+         "{removed} removed".format(devices=result.devices, scripts=len(result.scripts),
+                                    written=result.written, removed=removed))
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
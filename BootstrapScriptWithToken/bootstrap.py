@@ -3,18 +3,40 @@
 # Use of this source code is governed by the Apache License 2.0
 # that can be found in the COPYING file.
 
+import os
+import sys
+
+##########  INTERPRETER SELECTION  ##########
+# Starting EOS 4.30.1, the EOS modules this script needs are not available to python2,
+# which `#!/usr/bin/python` may still run. They are looked up without being imported, so
+# that switching to python3 happens before paying for any other import.
+if sys.version_info < (3,) and os.path.exists("/usr/bin/python3"):
+   import pkgutil
+   if not all(pkgutil.find_loader(name) for name in ("Cell", "requests", "SysdbHelperUtils")):
+      os.execl("/usr/bin/python3", "python3", os.path.abspath(__file__), *sys.argv[1:])
+
+# Modules only needed by some steps or features (requests, Sysdb, NTP, digests) are
+# imported when first used
+import atexit
 import base64
-import datetime
+import binascii
+import collections
+import contextlib
+import errno
 import json
 import logging
 import logging.handlers
-import os
 import signal
 import socket
 import subprocess
-import sys
+import threading
 import time
 
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+
 ##############  USER INPUT  ##############
 # Note: If you are saving the file on windows, please make sure to use linux (LF) as newline.
 # By default, windows uses (CR LF), you need to convert the newline char to linux (LF).
@@ -64,76 +86,1088 @@ TOKEN_FILE_PATH = "/tmp/token.tok"
 BOOT_SCRIPT_PATH = "/tmp/bootstrap-script"
 REDIRECTOR_PATH = "api/v3/services/arista.redirector.v1.AssignmentService/GetOne"
 VERSION = "2.0.1"
+TERMINATTR_BINARY = "/usr/bin/TerminAttr"
+NTPSTAT_BINARY = "ntpstat"
+SWI_VERSION_FILE = "/etc/swi-version"
+ARCH_FILE = "/etc/arch"
+# Overlap steps that do not depend on each other (device header collection runs
+# while the redirector and enrollment steps are in progress)
+PIPELINED_RUN = True
+# Connection pool size of the HTTP session shared by all the requests made to CVaaS
+HTTP_POOL_MAXSIZE = 4
+# Stream the bootstrap script to disk instead of buffering it in memory. Interrupted
+# transfers are resumed with an HTTP Range request.
+STREAM_BOOTSTRAP_DOWNLOAD = True
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_ATTEMPTS = 3
+# Run the downloaded bootstrap script without a shell, logging its stdout and stderr line
+# by line as they come. It is stopped after BOOTSTRAP_EXEC_TIMEOUT seconds, 0 meaning
+# never, or when the ZTP process is terminated, being given BOOTSTRAP_TERMINATE_GRACE
+# seconds to exit before it is killed. The last BOOTSTRAP_OUTPUT_TAIL lines of output,
+# each cut at BOOTSTRAP_OUTPUT_LINE_MAX bytes, are kept in the metrics.
+STREAM_BOOTSTRAP_OUTPUT = True
+BOOTSTRAP_EXEC_TIMEOUT = 3600
+BOOTSTRAP_TERMINATE_GRACE = 10
+BOOTSTRAP_OUTPUT_TAIL = 50
+BOOTSTRAP_OUTPUT_LINE_MAX = 4096
+# Overall time, in seconds, given to the clock to synchronize after restarting ntp.
+# ntpstat is polled every NTP_POLL_MIN_INTERVAL seconds at first, since an iburst restart
+# usually syncs within a few seconds, backing off with jitter up to NTP_POLL_MAX_INTERVAL.
+NTP_SYNC_DEADLINE = 310
+NTP_POLL_MIN_INTERVAL = 0.5
+NTP_POLL_MAX_INTERVAL = 8
+# Keep a single FastCli process open and run every batch of CLI commands through it,
+# instead of starting a new FastCli process per batch
+CLI_SESSION_MODE = False
+# Seconds a single CLI command is given to complete in the FastCli session.
+# Image installs from `eosUrl` are the slowest commands run.
+CLI_COMMAND_TIMEOUT = 1800
+# Send the redirector query to `cvAddr` and to all the regional front doors below at the
+# same time, and use the first valid assignment (cloud deployments only). The hosts of
+# the assignment are then tried in order of their measured connect latency.
+PARALLEL_REDIRECTOR_PROBE = False
+REDIRECTOR_FRONT_DOORS = [
+   "www.arista.io",
+   "www.cv-prod-us-central1-b.arista.io",
+   "www.cv-prod-us-central1-c.arista.io",
+   "www.cv-prod-na-northeast1-b.arista.io",
+   "www.cv-prod-euwest-2.arista.io",
+   "www.cv-prod-apnortheast-1.arista.io",
+   "www.cv-prod-ausoutheast-1.arista.io",
+   "www.cv-prod-uk-1.arista.io",
+]
+# Seconds allowed for the TCP connect used to measure the latency to an assigned host
+CONNECT_PROBE_TIMEOUT = 3
+# Before anything slow, the enrollment token is decoded and validated, cvproxy or else
+# cvAddr resolved and connected to, each within PREFLIGHT_TIMEOUT seconds, and the
+# binaries the steps run looked up, in parallel. The run stops right away if any of these
+# fails, a token for another host than cvAddr being only warned about. The token may
+# become valid up to TOKEN_CLOCK_SKEW seconds after the device clock says so.
+PREFLIGHT_CHECKS = True
+PREFLIGHT_TIMEOUT = 3
+TOKEN_CLOCK_SKEW = 300
+# Time, in seconds, the script is given to complete ZTP. No retry is attempted past it.
+ZTP_DEADLINE = 1800
+# Retries of the network and subprocess steps: number of attempts, and bounds in seconds
+# of the exponential backoff, which is jittered
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+# TerminAttr failures are only retried when it timed out, or when its output shows one of
+# the transient network or server conditions below. Rejected tokens are not retried.
+TERMINATTR_TRANSIENT_ERRORS = [
+   "connection refused",
+   "connection reset",
+   "timed out",
+   "timeout",
+   "unavailable",
+   "no route to host",
+   "network is unreachable",
+   "temporary failure",
+   "unexpected eof",
+]
+# Per-attempt timeouts, in seconds, of HTTP requests and TerminAttr invocations
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+TERMINATTR_TIMEOUT = 60
+# TerminAttr is probed once for its version and the flags it supports, with its -version
+# and -help outputs, so that a device whose TerminAttr lacks a flag the enrollment needs
+# is sent to the EOS upgrade right away. TERMINATTR_FLAG_VERSIONS holds the versions
+# introducing those flags, used when only the version is known. The probe is kept in the
+# state cache until the TerminAttr binary changes.
+TERMINATTR_PROBE_TIMEOUT = 10
+TERMINATTR_FLAG_VERSIONS = {"enrollonly": (1, 9, 0), "cvproxy": (1, 19, 0)}
+# Download the `eosUrl` image to flash in the background from the start of the script,
+# so that it is ready if an upgrade turns out to be needed. It is fetched over
+# PRESTAGE_CONNECTIONS parallel range requests and checked against the SHA-512 published
+# next to it, at `eosUrl` + EOS_IMAGE_CHECKSUM_SUFFIX. Nothing is downloaded when
+# EOS_IMAGE_PATH, or PRESTAGED_IMAGE_PATH left by an interrupted run, already holds that
+# image. Off by default, as devices not needing the upgrade would download it for
+# nothing. The prestaged image is removed when the script exits without booting it.
+PRESTAGE_EOS_IMAGE = False
+PRESTAGE_CONNECTIONS = 4
+EOS_IMAGE_CHECKSUM_SUFFIX = ".sha512sum"
+EOS_IMAGE_PATH = "/mnt/flash/EOS.swi"
+PRESTAGED_IMAGE_PATH = "/mnt/flash/EOS.swi.prestaged"
+# Per-stage and per-operation timings of the run are written there as a JSON summary,
+# which is also sent to syslog
+METRICS_FILE_PATH = "/mnt/flash/ztp-bootstrap-metrics.json"
+# A checkpoint of the outputs of every completed step is kept there, so that a later ZTP
+# attempt with the same token and cvAddr resumes from the first step without a valid
+# checkpoint. Client certificates expiring within CERT_EXPIRY_MARGIN seconds are not
+# reused, nor is a fetched bootstrap script older than BOOTSTRAP_SCRIPT_MAX_AGE seconds.
+STATE_CACHE_ENABLED = True
+STATE_CACHE_PATH = "/persist/local/ztp-bootstrap-state.json"
+CERT_EXPIRY_MARGIN = 3600
+BOOTSTRAP_SCRIPT_MAX_AGE = 1800
+OPENSSL_BINARY = "openssl"
+# Log records are written by a background thread, to stdout, to syslog from SYSLOG_LEVEL
+# up, and to LOG_FILE_PATH as JSON lines, rotated past LOG_FILE_MAX_BYTES. The last
+# LOG_RING_SIZE records, debug ones included, are kept in memory and written to
+# LOG_DUMP_PATH if the script fails.
+SYSLOG_ADDRESS = "/dev/log"
+SYSLOG_LEVEL = logging.INFO
+LOG_FILE_PATH = "/mnt/flash/ztp-bootstrap-log.jsonl"
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_RING_SIZE = 1000
+LOG_DUMP_PATH = "/mnt/flash/ztp-bootstrap-failure.log"
+# Record the interactions of the run with Sysdb, FastCli, TerminAttr, ntpstat, openssl and
+# CVaaS, with their timings and results, to TRACE_PATH, with secrets redacted. The trace
+# can be replayed on any machine with `bootstrap.py --replay TRACE [--speed N]`.
+RECORD_TRACE = False
+TRACE_PATH = "/mnt/flash/ztp-bootstrap-trace.jsonl.gz"
 
 ##############  HELPER FUNCTIONS  ##############
 proxies = {"https": cvproxy, "http": cvproxy}
 
+class JsonLinesFormatter(logging.Formatter):
+   def format(self, record):
+      return json.dumps({"time": round(record.created, 3), "level": record.levelname,
+                         "thread": record.threadName, "message": record.getMessage()})
+
+
+class RingBufferHandler(logging.Handler):
+   """Keeps the last `capacity` formatted records in memory"""
+
+   def __init__(self, capacity):
+      logging.Handler.__init__(self)
+      self.records = collections.deque(maxlen=capacity)
+
+   def emit(self, record):
+      self.records.append(self.format(record))
+
+   def dump(self, path):
+      with open(path, "w") as f:
+         for line in list(self.records):
+            f.write(line + "\n")
+
+
+class QueueHandler(logging.Handler):
+   """
+   Queues the records as they are, the message being formatted with its arguments by the
+   LogWriter thread instead of by the thread logging it
+   """
+
+   def __init__(self, logQueue):
+      logging.Handler.__init__(self)
+      self.queue = logQueue
+
+   def emit(self, record):
+      self.queue.put(record)
+
+
+class LogWriter(object):
+   """Writes the queued records out through the handlers, in a daemon thread"""
+
+   def __init__(self, logQueue, handlers):
+      self.queue = logQueue
+      self.handlers = handlers
+      self.thread = threading.Thread(target=self._run, name="logWriter")
+      self.thread.daemon = True
+      self.thread.start()
+
+   def _run(self):
+      while True:
+         record = self.queue.get()
+         try:
+            if record is None:
+               return
+            for handler in self.handlers:
+               if record.levelno >= handler.level:
+                  handler.handle(record)
+         finally:
+            self.queue.task_done()
+
+   def stop(self):
+      self.queue.put(None)
+      self.thread.join()
+
+
 logger = None
+logWriter = None
+ringBuffer = None
 def setupLogger():
-   global logger
+   global logger, logWriter, ringBuffer
    logger = logging.getLogger("customBootstrap")
    logger.setLevel(logging.DEBUG)
-   try:
-      handler = logging.handlers.SysLogHandler(address="/dev/log")
-      logger.addHandler(handler)
-   except socket.error:
-      print("Error setting up logger.")
-      logger = None
+   logger.propagate = False
+   for handler in list(logger.handlers):
+      logger.removeHandler(handler)
+
+   stdoutHandler = logging.StreamHandler(sys.stdout)
+   stdoutHandler.setLevel(logging.INFO)
+   ringBuffer = RingBufferHandler(LOG_RING_SIZE)
+   ringBuffer.setFormatter(logging.Formatter(
+      "%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+   handlers = [stdoutHandler, ringBuffer]
+   if SYSLOG_ADDRESS:
+      try:
+         syslogHandler = logging.handlers.SysLogHandler(address=SYSLOG_ADDRESS)
+         syslogHandler.setLevel(SYSLOG_LEVEL)
+         handlers.append(syslogHandler)
+      except socket.error:
+         print("Error setting up logger.")
+   if LOG_FILE_PATH:
+      try:
+         fileHandler = logging.handlers.RotatingFileHandler(
+            LOG_FILE_PATH, maxBytes=LOG_FILE_MAX_BYTES, backupCount=1)
+         fileHandler.setLevel(logging.INFO)
+         fileHandler.setFormatter(JsonLinesFormatter())
+         handlers.append(fileHandler)
+      except (IOError, OSError) as e:
+         print("Error opening {path}, err: {err}".format(path=LOG_FILE_PATH, err=e))
+
+   logQueue = queue.Queue()
+   logger.addHandler(QueueHandler(logQueue))
+   logWriter = LogWriter(logQueue, handlers)
 
 
-def log(msg):
-   """Print message to terminal and log if logging is up"""
-   print(msg)
+def flushLogger():
+   """Waits for the queued records to be written out"""
+   if logWriter is not None:
+      logWriter.queue.join()
+
+
+def stopLogger():
+   """
+   Writes out the records still queued and closes the handlers. If the script did not
+   succeed, the records kept in memory are dumped to LOG_DUMP_PATH.
+   """
+   global logger, logWriter
+   if logger is None:
+      return
+   logWriter.stop()
+   if metrics.status != "success" and LOG_DUMP_PATH:
+      try:
+         ringBuffer.dump(LOG_DUMP_PATH)
+         print("Last {count} log records written to {path}".format(
+            count=len(ringBuffer.records), path=LOG_DUMP_PATH))
+      except (IOError, OSError) as e:
+         print("Error writing {path}, err: {err}".format(path=LOG_DUMP_PATH, err=e))
+   for handler in logWriter.handlers:
+      handler.close()
+   for handler in list(logger.handlers):
+      logger.removeHandler(handler)
+   logger = None
+   logWriter = None
+
+
+def log(msg, *args, **kwargs):
+   """
+   Logs a message at INFO level, or at the given `level`. The message is %-formatted with
+   `args` only when written out, off the calling thread. Before the logger is set up, it
+   is printed right away.
+   """
+   level = kwargs.get("level", logging.INFO)
    if logger:
-      logger.critical(msg)
+      logger.log(level, msg, *args)
+   elif level >= logging.INFO:
+      print(msg % args if args else msg)
 
 
-def monitorNtpSync():
-   timeInterval = 10
-   expo = 2
-   for i in range(5):
-      log("Polling NTP status.")
+class BootstrapMetrics(object):
+   """
+   Collects timed events of the bootstrap run: the steps ("stage") and the operations
+   they are made of ("ntp", "fastCli", "terminAttr", "http"). Each event holds its
+   start offset from the beginning of the run, its duration and any extra attributes.
+   """
+
+   def __init__(self):
+      self.startTime = time.time()
+      self.status = "failed"
+      self.events = []
+      self.lock = threading.Lock()
+      self.exported = False
+
+   def record(self, kind, name, startTime, duration, **attrs):
+      event = {"kind": kind, "name": name, "start": round(startTime - self.startTime, 3),
+               "duration": round(duration, 3)}
+      event.update(attrs)
+      with self.lock:
+         self.events.append(event)
+
+   @contextlib.contextmanager
+   def timer(self, kind, name, **attrs):
+      """
+      Times the enclosed block. The attributes dict is yielded so that the block can add
+      to it, an exception raised by the block is recorded as the `error` attribute.
+      """
+      startTime = time.time()
       try:
-         ntpStatInfo = subprocess.call(["ntpstat"])
+         yield attrs
+      except Exception as e:
+         attrs["error"] = str(e)
+         raise
+      finally:
+         self.record(kind, name, startTime, time.time() - startTime, **attrs)
+
+   def stageTimings(self, since=None):
+      """(name, duration) of the stages, of those started at `since` or later if given"""
+      start = round(since - self.startTime, 3) if since is not None else 0.0
+      with self.lock:
+         return [(event["name"], event["duration"]) for event in self.events
+                 if event["kind"] == "stage" and event["start"] >= start]
+
+   def summary(self):
+      with self.lock:
+         events = list(self.events)
+      return {
+         "version": VERSION,
+         "status": self.status,
+         "startTime": round(self.startTime, 3),
+         "wallTime": round(time.time() - self.startTime, 3),
+         "stages": dict((event["name"], event["duration"]) for event in events
+                        if event["kind"] == "stage"),
+         "events": events,
+      }
+
+   def counters(self, summary):
+      """
+      Returns the summary without its events, which are counted by kind instead, as the
+      ones of the bootstrap script carry the tail of its output
+      """
+      counters = dict((key, value) for key, value in summary.items() if key != "events")
+      counters["counts"] = collections.Counter(event["kind"] for event in summary["events"]
+                                               if event["kind"] != "stage")
+      counters["errors"] = len([event for event in summary["events"] if "error" in event])
+      return counters
+
+   def export(self):
+      """
+      Writes the summary to METRICS_FILE_PATH and logs its counters and timings, once per
+      run
+      """
+      if self.exported:
+         return
+      self.exported = True
+      summary = self.summary()
+      try:
+         with open(METRICS_FILE_PATH, "w") as f:
+            f.write(json.dumps(summary, sort_keys=True) + "\n")
+      except (IOError, OSError) as e:
+         log("Could not write metrics to %s, err: %s", METRICS_FILE_PATH, e,
+             level=logging.WARNING)
+      log("ZTP metrics: %s", json.dumps(self.counters(summary), sort_keys=True))
+
+metrics = BootstrapMetrics()
+
+
+def remainingTime():
+   """Returns the number of seconds left before ZTP_DEADLINE"""
+   return metrics.startTime + ZTP_DEADLINE - time.time()
+
+
+def getRetryAfter(error):
+   """
+   Returns the delay in seconds requested by the Retry-After header of the HTTP response
+   carried by `error`, None if there is none.
+   """
+   response = getattr(error, "response", None)
+   retryAfter = response.headers.get("Retry-After") if response is not None else None
+   if not retryAfter:
+      return None
+   if retryAfter.strip().isdigit():
+      return float(retryAfter)
+   import email.utils
+   date = email.utils.parsedate_tz(retryAfter)
+   return max(email.utils.mktime_tz(date) - time.time(), 0) if date else None
+
+
+def isRetryableError(error):
+   """
+   Transient failures are retryable: connection errors and timeouts, HTTP 408, 429 and
+   5xx responses, and TerminAttr invocations that timed out or failed with one of the
+   TERMINATTR_TRANSIENT_ERRORS.
+   """
+   if isinstance(error, subprocess.CalledProcessError):
+      output = (error.output or "").lower()
+      return error.returncode == 124 or any(transient in output
+                                             for transient in TERMINATTR_TRANSIENT_ERRORS)
+   if requests is None:
+      return False
+   if isinstance(error, requests.exceptions.HTTPError):
+      status = error.response.status_code if error.response is not None else 0
+      return status in (408, 429) or status >= 500
+   return isinstance(error, (requests.exceptions.ConnectionError,
+                             requests.exceptions.ChunkedEncodingError,
+                             requests.exceptions.Timeout))
+
+
+class RetryPolicy(object):
+   """
+   Retries a failed step with an exponential backoff, capped at RETRY_MAX_DELAY and with
+   full jitter, or after the delay requested through Retry-After. Only errors accepted by
+   `isRetryable` are retried, and never past ZTP_DEADLINE. Once the `cancelled` event is
+   set, no further attempt is made and the last error is raised.
+   """
+
+   def __init__(self, name, attempts=RETRY_ATTEMPTS, isRetryable=isRetryableError,
+                cancelled=None):
+      self.name = name
+      self.attempts = attempts
+      self.isRetryable = isRetryable
+      self.cancelled = cancelled
+
+   def isCancelled(self):
+      return self.cancelled is not None and self.cancelled.is_set()
+
+   def backoff(self, attempt, error):
+      """Returns the delay before the attempt following `attempt`, None if none is due"""
+      if attempt >= self.attempts or not self.isRetryable(error):
+         return None
+      delay = getRetryAfter(error)
+      if delay is None:
+         import random
+         delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+      if delay >= remainingTime():
+         log("Not retrying %s, ZTP deadline reached", self.name, level=logging.WARNING)
+         return None
+      return delay
+
+   def sleepBeforeRetry(self, attempt, error):
+      """Waits for the next attempt, re-raises `error` if there is none to be made"""
+      if self.isCancelled():
+         raise error
+      delay = self.backoff(attempt, error)
+      if delay is None:
+         raise error
+      log("%s attempt %d failed, retrying in %.1fs, err: %s", self.name, attempt, delay, error,
+          level=logging.WARNING)
+      metrics.record("retry", self.name, time.time(), delay, attempt=attempt, error=str(error))
+      if self.cancelled is None:
+         time.sleep(delay)
+      elif self.cancelled.wait(delay):
+         raise error
+
+   def run(self, func, *args):
+      attempt = 1
+      while True:
+         try:
+            return func(*args)
+         except Exception as e:
+            self.sleepBeforeRetry(attempt, e)
+            attempt += 1
+
+
+class TraceError(Exception):
+   pass
+
+
+class InteractionTrace(object):
+   """
+   Trace of the interactions of the script with the device and the network: Sysdb,
+   FastCli, TerminAttr, ntpstat, openssl, HTTP and the bootstrap script execution. Each
+   one is recorded with its duration and its result, or the error it raised, as a line of
+   a gzipped JSON lines file. The first line holds the USER INPUT values and the state
+   cache the run started with, secrets being redacted throughout.
+
+   When replaying, the interactions return the recorded results, taking their recorded
+   duration divided by `speed`, or no time at all with a speed of 0. Interactions of the
+   same kind and name are replayed in the recorded order.
+   """
+   REDACTED = "<redacted>"
+
+   def __init__(self, path, replay=False, speed=1.0):
+      self.path = path
+      self.replaying = replay
+      self.speed = speed
+      self.lock = threading.Lock()
+      self.header = None
+      self.file = None
+      # Replay only: recorded events by (kind, name), whether the recorded run exited
+      # normally, and how much later than the recording the replay runs
+      self.events = {}
+      self.complete = False
+      self.timeOffset = 0.0
+      self.secrets = [enrollmentToken]
+      proxyAddr = urlparse(cvproxy) if cvproxy else None
+      if proxyAddr is not None and proxyAddr.password:
+         self.secrets.append("{user}:{password}".format(user=proxyAddr.username,
+                                                        password=proxyAddr.password))
+
+   def redact(self, value):
+      if isinstance(value, dict):
+         return dict((key, self.redact(item)) for key, item in value.items())
+      if isinstance(value, (list, tuple)):
+         return [self.redact(item) for item in value]
+      if isinstance(value, bytes) and not isinstance(value, str):
+         value = value.decode("utf-8", "replace")
+      if isinstance(value, (type(u""), str)):
+         for secret in self.secrets:
+            if secret:
+               value = value.replace(secret, self.REDACTED)
+      return value
+
+   def start(self, header):
+      """Starts recording, the header describing the configuration of the run"""
+      import gzip
+      self.file = gzip.open(self.path, "wb")
+      self.write(dict(header, kind="header", version=VERSION, startTime=time.time()))
+
+   def write(self, record):
+      line = json.dumps(self.redact(record), sort_keys=True) + "\n"
+      with self.lock:
+         if self.file is not None:
+            self.file.write(line.encode("utf-8"))
+            # Events are kept if the device reloads before the trace is closed
+            self.file.flush()
+
+   def close(self, status):
+      if self.file is None:
+         return
+      self.write({"kind": "end", "status": status})
+      with self.lock:
+         self.file.close()
+         self.file = None
+
+   def load(self):
+      """Reads the trace to replay, returns its header"""
+      import gzip
+      with gzip.open(self.path, "rb") as f:
+         for line in f:
+            record = json.loads(line.decode("utf-8"))
+            if record["kind"] == "header":
+               self.header = record
+            elif record["kind"] == "end":
+               self.complete = True
+            else:
+               key = (record["kind"], record["name"])
+               self.events.setdefault(key, collections.deque()).append(record)
+      if self.header is None:
+         raise TraceError("{path} holds no trace header".format(path=self.path))
+      self.timeOffset = time.time() - self.header["startTime"]
+      return self.header
+
+   def call(self, kind, name, func, args, encode, decode):
+      if self.replaying:
+         return self.replay(kind, name, decode)
+      startTime = time.time()
+      try:
+         result = func(*args)
+      except BaseException as e:
+         self.write({"kind": kind, "name": name, "start": round(startTime, 3),
+                     "duration": round(time.time() - startTime, 3),
+                     "error": encodeTraceError(e)})
+         raise
+      self.write({"kind": kind, "name": name, "start": round(startTime, 3),
+                  "duration": round(time.time() - startTime, 3),
+                  "result": encode(result) if encode else result})
+      return result
+
+   def replay(self, kind, name, decode):
+      with self.lock:
+         events = self.events.get((kind, name))
+         if not events:
+            event = None
+         elif len(events) > 1:
+            event = events.popleft()
+         else:
+            # The last answer is repeated, e.g. to a replayed run polling more often
+            event = events[0]
+      if event is None:
+         if not self.complete:
+            log("The recorded run stopped before %s %s, ending the replay", kind, name)
+            sys.exit(0)
+         raise TraceError("No recorded {kind} interaction {name}".format(kind=kind,
+                                                                        name=name))
+      if self.speed:
+         time.sleep(event["duration"] / self.speed)
+      if "error" in event:
+         raise decodeTraceError(event["error"])
+      result = event.get("result")
+      return decode(result) if decode else result
+
+
+def encodeTraceError(error):
+   encoded = {"type": error.__class__.__name__, "message": str(error)}
+   if isinstance(error, subprocess.CalledProcessError):
+      encoded.update(returncode=error.returncode, cmd=error.cmd, output=error.output)
+   elif isinstance(error, SystemExit):
+      encoded["code"] = error.code
+   return encoded
+
+
+def decodeTraceError(error):
+   """Returns an exception of the recorded type, falling back to Exception"""
+   if error["type"] == "CalledProcessError":
+      return subprocess.CalledProcessError(error["returncode"], error["cmd"], error["output"])
+   if error["type"] == "SystemExit":
+      return SystemExit(error["code"])
+   if requests is not None and hasattr(requests.exceptions, error["type"]):
+      return getattr(requests.exceptions, error["type"])(error["message"])
+   return Exception(error["message"])
+
+
+def encodeHttpResponse(response):
+   content = response.content
+   result = {"status": response.status_code, "reason": response.reason,
+             "elapsed": response.elapsed.total_seconds(), "url": response.url,
+             "headers": dict((key, value) for key, value in response.headers.items()
+                             if key.lower() != "set-cookie")}
+   try:
+      result["body"] = content.decode("utf-8")
+   except UnicodeDecodeError:
+      result["body64"] = base64.b64encode(content).decode("ascii")
+   return result
+
+
+def decodeHttpResponse(result):
+   """Rebuilds a complete requests Response from its recording"""
+   import datetime
+   importRequests()
+   response = requests.models.Response()
+   response.status_code = result["status"]
+   response.reason = result["reason"]
+   response.url = result["url"]
+   response.elapsed = datetime.timedelta(seconds=result["elapsed"])
+   response.headers = requests.structures.CaseInsensitiveDict(result["headers"])
+   response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+   if "body64" in result:
+      response._content = base64.b64decode(result["body64"])
+   else:
+      response._content = result["body"].encode("utf-8")
+   response._content_consumed = True
+   return response
+
+
+trace = None
+
+def traced(kind, name, func, args=(), encode=None, decode=None):
+   """
+   Calls func(*args), an interaction with the outside of the script, through the trace
+   being recorded or replayed if any. `encode` makes its result JSON serialisable, and
+   `decode` turns that back into the result.
+   """
+   if trace is None:
+      return func(*args)
+   return trace.call(kind, name, func, args, encode, decode)
+
+
+def startTrace():
+   """Records the interactions of the run into TRACE_PATH"""
+   global trace
+   state = None
+   if os.path.exists(STATE_CACHE_PATH):
+      try:
+         with open(STATE_CACHE_PATH, "r") as f:
+            state = json.load(f).get("values")
+      except (IOError, OSError, ValueError):
+         pass
+   trace = InteractionTrace(TRACE_PATH)
+   try:
+      trace.start({"cvAddr": cvAddr, "cvproxy": cvproxy, "eosUrl": eosUrl,
+                   "ntpServer": ntpServer, "state": state})
+   except (IOError, OSError) as e:
+      log("Could not record a trace to %s, err: %s", TRACE_PATH, e, level=logging.WARNING)
+      trace = None
+      return
+   atexit.register(lambda: trace.close(metrics.status))
+   log("Recording a trace of the run to %s", TRACE_PATH)
+
+
+def startReplay(path, speed):
+   """
+   Sets the script up to replay the trace at `path` on any machine: the USER INPUT values
+   are taken from the trace, the state cache is seeded with the recorded one, and the
+   files the script writes go to a temporary directory instead of flash and /persist.
+   """
+   global trace, cvAddr, cvproxy, enrollmentToken, eosUrl, ntpServer, proxies
+   global TOKEN_FILE_PATH, BOOT_SCRIPT_PATH, METRICS_FILE_PATH, STATE_CACHE_PATH
+   global LOG_FILE_PATH, LOG_DUMP_PATH, SYSLOG_ADDRESS, PRESTAGE_EOS_IMAGE
+   import tempfile
+   trace = InteractionTrace(path, replay=True, speed=speed)
+   header = trace.load()
+   cvAddr = header["cvAddr"]
+   cvproxy = header["cvproxy"]
+   proxies = {"https": cvproxy, "http": cvproxy}
+   enrollmentToken = InteractionTrace.REDACTED
+   eosUrl = header["eosUrl"]
+   ntpServer = header["ntpServer"]
+
+   workDir = tempfile.mkdtemp(prefix="ztp-replay-")
+   TOKEN_FILE_PATH = os.path.join(workDir, "token.tok")
+   BOOT_SCRIPT_PATH = os.path.join(workDir, "bootstrap-script")
+   METRICS_FILE_PATH = os.path.join(workDir, "ztp-bootstrap-metrics.json")
+   STATE_CACHE_PATH = os.path.join(workDir, "ztp-bootstrap-state.json")
+   LOG_FILE_PATH = os.path.join(workDir, "ztp-bootstrap-log.jsonl")
+   LOG_DUMP_PATH = os.path.join(workDir, "ztp-bootstrap-failure.log")
+   SYSLOG_ADDRESS = ""
+   # The image download is not part of the trace
+   PRESTAGE_EOS_IMAGE = False
+
+   state = header.get("state")
+   if state:
+      # The recorded times are shifted like the clock of the replay
+      for checkpoint in (state.get("checkpoints") or {}).values():
+         for key in ("time", "certExpiry"):
+            if checkpoint.get(key):
+               checkpoint[key] += trace.timeOffset
+      seeded = BootstrapState(STATE_CACHE_PATH)
+      seeded.values = state
+      seeded.save()
+   return workDir
+
+
+def runTerminAttr(name, args, timeout=None):
+   """
+   Runs TerminAttr with the given arguments, without a shell, recording how long it took,
+   and returns its output. It is killed past `timeout` seconds, by default
+   TERMINATTR_TIMEOUT, which is reported as return code 124 like the `timeout` command
+   does.
+   """
+   def execute(cmd):
+      timedOut = []
+      proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+      def kill():
+         timedOut.append(True)
+         proc.kill()
+      watchdog = threading.Timer(TERMINATTR_TIMEOUT if timeout is None else timeout, kill)
+      watchdog.daemon = True
+      watchdog.start()
+      try:
+         output = proc.communicate()[0]
+      finally:
+         watchdog.cancel()
+      if timedOut or proc.returncode:
+         raise subprocess.CalledProcessError(124 if timedOut else proc.returncode, cmd,
+                                             output)
+      return output
+
+   with metrics.timer("terminAttr", name):
+      return traced("terminAttr", name, execute, ([TERMINATTR_BINARY] + args,))
+
+
+class TerminAttrCapabilities(collections.namedtuple("TerminAttrCapabilities",
+                                                     ["version", "flags"])):
+   """
+   Version, as a tuple of integers, and flags of the TerminAttr binary, either being None
+   when it could not be determined
+   """
+   __slots__ = ()
+
+   @classmethod
+   def probe(cls):
+      """
+      Reads the version from `-version` and the flags from the usage printed by `-help`.
+      TerminAttr versions without -version print their usage instead, which is used as is.
+      """
+      import re
+
+      def run(flag):
+         try:
+            return runTerminAttr(flag, ["-" + flag], timeout=TERMINATTR_PROBE_TIMEOUT)
+         except subprocess.CalledProcessError as e:
+            # The usage comes with exit code 2 from older Go flag packages
+            return e.output if e.returncode != 124 else ""
+         except OSError as e:
+            log("Could not run TerminAttr, err: %s", e, level=logging.WARNING)
+            return ""
+
+      version = None
+      usage = run("version")
+      if "Usage" not in usage:
+         match = re.search(r"(\d+)\.(\d+)\.(\d+)", usage)
+         if match:
+            version = tuple(int(part) for part in match.groups())
+         usage = run("help")
+      flags = re.findall(r"^\s+-(\w+)", usage, re.MULTILINE)
+      return cls(version, sorted(set(flags)) or None)
+
+   @classmethod
+   def fromState(cls, value):
+      """Returns the capabilities saved with toState, None if they do not apply anymore"""
+      if not value or value.get("binary") != terminAttrSignature():
+         return None
+      version = value.get("version")
+      return cls(tuple(version) if version else None, value.get("flags"))
+
+   def toState(self):
+      return {"binary": terminAttrSignature(), "version": self.version, "flags": self.flags}
+
+   def supports(self, flag):
+      """
+      Whether the flag is supported, from the usage or else from the version. None when
+      neither tells.
+      """
+      if self.flags is not None:
+         return flag in self.flags
+      if self.version is not None and flag in TERMINATTR_FLAG_VERSIONS:
+         return self.version >= TERMINATTR_FLAG_VERSIONS[flag]
+      return None
+
+   def describe(self):
+      if self.version is None:
+         return "TerminAttr"
+      return "TerminAttr {version}".format(version=".".join(str(part)
+                                                            for part in self.version))
+
+
+def terminAttrSignature():
+   """Size and modification time of the TerminAttr binary, which an EOS upgrade changes"""
+   try:
+      stat = os.stat(TERMINATTR_BINARY)
+   except OSError:
+      return None
+   return "{size}:{mtime}".format(size=stat.st_size, mtime=int(stat.st_mtime))
+
+
+def monitorNtpSync(deadline=None):
+   """
+   Polls ntpstat until the clock is synchronized, raises if it is not within `deadline`
+   seconds, by default NTP_SYNC_DEADLINE bounded by the overall ZTP_DEADLINE. The
+   polling interval doubles after every attempt, capped at NTP_POLL_MAX_INTERVAL, and is
+   jittered so that a sync is noticed shortly after it happens.
+   """
+   import random
+
+   if deadline is None:
+      deadline = min(NTP_SYNC_DEADLINE, remainingTime())
+   startTime = time.time()
+   timeInterval = NTP_POLL_MIN_INTERVAL
+   polls = 0
+   while True:
+      log("Polling NTP status.", level=logging.DEBUG)
+      polls += 1
+      try:
+         ntpStatInfo = traced("ntpstat", "ntpstat", subprocess.call, ([NTPSTAT_BINARY],))
       except Exception as e:
          raise Exception("ntpstat command failed, err: {err}. Aborting".format(err=e))
-      log("NTP sync status - {ntpStatInfo}".format(ntpStatInfo=str(ntpStatInfo)))
+      log("NTP sync status - %s", ntpStatInfo, level=logging.DEBUG)
+      elapsed = time.time() - startTime
       if ntpStatInfo == 0:
-         log("NTP sync complete.")
+         log("NTP sync complete after %.1fs.", elapsed)
+         metrics.record("ntp", "ntpSync", startTime, elapsed, polls=polls)
          return
-      time.sleep(timeInterval)
-      timeInterval *= expo
+      if elapsed >= deadline:
+         break
+      time.sleep(min(random.uniform(timeInterval / 2, timeInterval), deadline - elapsed))
+      timeInterval = min(timeInterval * 2, NTP_POLL_MAX_INTERVAL)
+   metrics.record("ntp", "ntpSync", startTime, time.time() - startTime, polls=polls,
+                  error="timeout")
    raise Exception("NTP sync failed. Timing out.")
 
 
-def getExpiryFromToken(token):
+class TokenError(Exception):
+   pass
+
+
+def decodeTokenClaims(token):
+   """Decodes the claims of a JWT, raises TokenError saying what is wrong with it"""
+   # jwt token has 3 parts (header, payload, sign) separated by a '.'
+   parts = token.split(".")
+   if len(parts) != 3:
+      raise TokenError("the enrollment token has {count} parts, instead of the 3 of a "
+                       "JWT".format(count=len(parts)))
+   payload = parts[1]
    try:
-      # jwt token has 3 parts (header, payload, sign) separated by a '.'
-      # payload has 'exp' field which contains the token expiry time in epoch
-      token_payload = token.split(".")[1]
-      token_payload_decoded = str(base64.b64decode(token_payload + "==").decode("utf-8"))
-      payload = json.loads(token_payload_decoded)
-      return payload["exp"], True
-   except Exception as e:
-      log("Could not parse the enrollment token, err: {err}".format(err=e))
-      log("Continuing with ZTP.")
-      return -1, False
+      # base64url without padding
+      payload = base64.urlsafe_b64decode(str(payload + "=" * (-len(payload) % 4)))
+      claims = json.loads(payload.decode("utf-8"))
+   except (TypeError, ValueError, binascii.Error) as e:
+      raise TokenError("the enrollment token payload is not base64url encoded JSON, "
+                       "err: {err}".format(err=e))
+   if not isinstance(claims, dict):
+      raise TokenError("the enrollment token payload is not a JSON object")
+   for claim in ("exp", "nbf", "iat"):
+      if claim in claims and (isinstance(claims[claim], bool) or
+                              not isinstance(claims[claim], (int, float))):
+         raise TokenError("the {claim} claim of the enrollment token is not a "
+                          "timestamp: {value!r}".format(claim=claim, value=claims[claim]))
+   return claims
+
+
+tokenClaims = None
+
+def getTokenClaims():
+   """
+   Returns the claims of the enrollment token, decoded once. Tokens that are not JWTs
+   have none.
+   """
+   global tokenClaims
+   if tokenClaims is None:
+      try:
+         tokenClaims = decodeTokenClaims(enrollmentToken)
+      except TokenError as e:
+         log("Could not parse the enrollment token, err: %s", e, level=logging.WARNING)
+         log("Continuing with ZTP.")
+         tokenClaims = {}
+   return tokenClaims
+
+
+def formatTimestamp(epoch):
+   return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def checkTokenValidity():
+   """
+   Raises TokenError if the enrollment token is expired or not valid yet, allowing for
+   TOKEN_CLOCK_SKEW seconds of clock difference with CVaaS for the latter
+   """
+   claims = getTokenClaims()
+   now = time.time()
+   if "exp" in claims and now > claims["exp"]:
+      raise TokenError("enrollment token expired. expired on: {expiry} GMT".format(
+         expiry=formatTimestamp(claims["exp"])))
+   if "nbf" in claims and now + TOKEN_CLOCK_SKEW < claims["nbf"]:
+      raise TokenError("enrollment token not valid before {nbf} GMT, the clock is at "
+                       "{now} GMT".format(nbf=formatTimestamp(claims["nbf"]),
+                                          now=formatTimestamp(now)))
+
+
+def comparableHost(addr):
+   """Host of a CVP address or URL, without its `www.` or `apiserver.` prefix"""
+   host = (buildBootstrapURL(addr, False).hostname or "").lower()
+   for prefix in ("www.", "apiserver."):
+      if host.startswith(prefix):
+         return host[len(prefix):]
+   return host
+
+
+def checkTokenAudience():
+   """
+   Warns if the audience of the token names hosts and `cvAddr` is not one of them, as
+   when the token is for another cluster. This is not an error: the cluster may also be
+   reached by IP address, by VIP or by the name of another node. Cloud addresses are not
+   checked, the redirector finds the cluster of the tenant.
+   """
+   if isCloudAddr(cvAddr):
+      return
+   audience = getTokenClaims().get("aud")
+   if not isinstance(audience, list):
+      audience = [audience]
+   hosts = [comparableHost(aud) for aud in audience
+            if isinstance(aud, (type(u""), str)) and "." in aud]
+   if hosts and comparableHost(cvAddr) not in hosts:
+      log("The enrollment token is for %s, not for cvAddr %s, enrollment may fail",
+          ", ".join(str(aud) for aud in audience), cvAddr, level=logging.WARNING)
+
+
+class CliSessionError(Exception):
+   pass
+
+
+class CliSession(object):
+   """
+   A FastCli process kept open over a pipe. Each command written to it is followed by
+   a `bash echo` of a unique marker, which delimits the output of that command in the
+   stream read back.
+   """
+   HANDSHAKE_TIMEOUT = 10
+
+   def __init__(self, fastCliBinary):
+      self.markerPrefix = "ZTP-CLI-{id}".format(
+         id=binascii.hexlify(os.urandom(8)).decode("ascii"))
+      self.markerCount = 0
+      self.lines = queue.Queue()
+      self.proc = subprocess.Popen([fastCliBinary], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+      reader = threading.Thread(target=self._readLines, name="fastCliReader")
+      reader.daemon = True
+      reader.start()
+      # Privileged mode is needed for `bash`, it also confirms the session responds
+      self.runCommand("enable", CliSession.HANDSHAKE_TIMEOUT)
+
+   def _readLines(self):
+      for line in iter(self.proc.stdout.readline, ""):
+         self.lines.put(line.rstrip("\n"))
+      self.lines.put(None)
+
+   def runCommand(self, cmd, timeout):
+      """Runs a single command and returns its output"""
+      if "\n" in cmd:
+         raise ValueError("Multi-line CLI command: {cmd!r}".format(cmd=cmd))
+      self.markerCount += 1
+      marker = "{prefix}-{count}".format(prefix=self.markerPrefix, count=self.markerCount)
+      try:
+         self.proc.stdin.write("{cmd}\nbash echo {marker}\n".format(cmd=cmd, marker=marker))
+         self.proc.stdin.flush()
+      except (IOError, OSError) as e:
+         raise CliSessionError("Could not write to FastCli, err: {err}".format(err=e))
+
+      output = []
+      deadline = time.time() + timeout
+      while True:
+         remaining = deadline - time.time()
+         if remaining <= 0:
+            raise CliSessionError("Timed out after {timeout}s waiting for [{cmd}]".format(
+               timeout=timeout, cmd=cmd))
+         try:
+            line = self.lines.get(timeout=remaining)
+         except queue.Empty:
+            continue
+         if line is None:
+            raise CliSessionError("FastCli exited with return code {rc}, output: {out}".format(
+               rc=self.proc.wait(), out="\n".join(output)))
+         if line.strip() == marker:
+            return "\n".join(output)
+         output.append(line)
+
+   def close(self):
+      try:
+         self.proc.stdin.close()
+      except (IOError, OSError):
+         pass
+      if self.proc.poll() is None:
+         self.proc.kill()
+      self.proc.wait()
 
 
 class CliManager(object):
    """
    Used to execute commands in EOS shell.
+   Use CliManager.getInstance() to share a single instance, and hence a single FastCli
+   session in CLI_SESSION_MODE, across the script.
    """
    FAST_CLI_BINARY = "/usr/bin/FastCli"
+   _instance = None
+   _instanceLock = threading.Lock()
 
    def __init__(self):
       self.fastCliBinary = CliManager.FAST_CLI_BINARY
       self.confidenceCheck()
+      self.lock = threading.Lock()
+      self.session = None
+      self.sessionUnavailable = False
+
+   @classmethod
+   def getInstance(cls):
+      with cls._instanceLock:
+         if cls._instance is None:
+            cls._instance = cls()
+         return cls._instance
 
    def confidenceCheck(self):
-      assert os.path.isfile(self.fastCliBinary), "FastCli Binary Not Found"
+      # Replayed commands do not need FastCli
+      if trace is None or not trace.replaying:
+         assert os.path.isfile(self.fastCliBinary), "FastCli Binary Not Found"
+
+   def getSession(self):
+      """
+      Returns the open FastCli session, starting it if needed. Returns None if the
+      session cannot be established, in which case commands run in one-shot processes.
+      """
+      if self.session is None and not self.sessionUnavailable:
+         try:
+            self.session = CliSession(self.fastCliBinary)
+         except (CliSessionError, OSError) as e:
+            log("FastCli session unavailable, running commands in separate processes, err: %s",
+                e)
+            self.sessionUnavailable = True
+      return self.session
+
+   def closeSession(self):
+      if self.session is not None:
+         self.session.close()
+         self.session = None
 
    def runCommands(self, cmdList):
+      """Runs the commands in FastCli, returns their return code and output"""
+      return traced("fastCli", " \\n ".join(cmdList), self.executeCommands, (cmdList,),
+                    decode=tuple)
+
+   def executeCommands(self, cmdList):
       cmdStr = ""
       cmdOutput = ""
       rc = 0
@@ -141,43 +1175,74 @@ class CliManager(object):
       # The delimiter `\n` is shown in console logging in its octal representation(#012).
       # It makes the log hard to read. The delimiter is updated to ` \\n `.
       delimiter = " \\n "
-      try:
-         cmds = "\n".join(cmdList)
-         cmdStr = delimiter.join(cmdList)
-
-         log("Executing the commands: [{cmdStr}]".format(cmdStr=cmdStr))
-         cmdOutput = subprocess.check_output(
-            "echo -e '" + cmds + "' | " + self.fastCliBinary, shell=True,
-            stderr=subprocess.STDOUT, universal_newlines=True )
-      except subprocess.CalledProcessError as e:
-         rc = e.returncode
-         err = e.output
-         log("Error running commands: [{cmdStr}], err: {err}".format(cmdStr=cmdStr, err=err))
+      cmds = "\n".join(cmdList)
+      cmdStr = delimiter.join(cmdList)
+
+      log("Executing the commands: [%s]", cmdStr)
+      with self.lock, metrics.timer("fastCli", cmdStr) as attrs:
+         if CLI_SESSION_MODE and self.getSession() is not None:
+            attrs["session"] = True
+            return self.runCommandsInSession(cmdList, cmdStr)
+
+         # The commands are written to the FastCli stdin, no shell is involved
+         proc = subprocess.Popen([self.fastCliBinary], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+         cmdOutput, _ = proc.communicate(cmds + "\n")
+         attrs["rc"] = proc.returncode
+      if proc.returncode:
+         rc = proc.returncode
+         err = cmdOutput
+         log("Error running commands: [%s], err: %s", cmdStr, err, level=logging.ERROR)
          return (rc, err)
 
       if cmdOutput:
          for line in cmdOutput.split("\n"):
             if line.startswith("%"):
                err = cmdOutput
-               log("Error running commands: [{cmdStr}], err: {err}".format(
-                  cmdStr=cmdStr, err=err))
+               log("Error running commands: [%s], err: %s", cmdStr, err,
+                   level=logging.ERROR)
                return(1, err)
 
       return (0, cmdOutput)
 
+   def runCommandsInSession(self, cmdList, cmdStr):
+      """
+      Runs the commands one by one in the FastCli session, stopping at the first one that
+      fails. The session is restarted for the next batch after a failure, so that no
+      batch starts in the mode a failed one left behind.
+      """
+      cmdOutputs = []
+      for cmd in cmdList:
+         try:
+            cmdOutput = self.session.runCommand(cmd, CLI_COMMAND_TIMEOUT)
+         except CliSessionError as e:
+            self.closeSession()
+            err = str(e)
+            log("Error running commands: [%s], err: %s", cmdStr, err, level=logging.ERROR)
+            return (1, err)
+         if any(line.startswith("%") for line in cmdOutput.split("\n")):
+            self.closeSession()
+            err = "[{cmd}] {cmdOutput}".format(cmd=cmd, cmdOutput=cmdOutput)
+            log("Error running commands: [%s], err: %s", cmdStr, err, level=logging.ERROR)
+            return (1, err)
+         if cmdOutput:
+            cmdOutputs.append(cmdOutput)
+      return (0, "\n".join(cmdOutputs))
+
 
 def configureAndRestartNTP(ntpServer):
    """
    Stops and restarts ntp with a specified ntp server.
    """
-   cli = CliManager()
+   cli = CliManager.getInstance()
 
    # Command to stop the ntp process
    stopNtpCmds = ["en", "configure", "no ntp", "exit"]
    rc, cmdOut = cli.runCommands(stopNtpCmds)
    if rc:
       err = "NTP server could not be stopped, err: {cmdOut}. Aborting".format(cmdOut=cmdOut)
-      log(err)
+      log(err, level=logging.ERROR)
       raise Exception(err)
 
    # Command to configure and restart ntp process.
@@ -187,57 +1252,506 @@ def configureAndRestartNTP(ntpServer):
    rc, cmdOut = cli.runCommands(configureNtpCmds)
    if rc:
       err = "Could not restart NTP server, err: {cmdOut}. Aborting".format(cmdOut=cmdOut)
-      log(err)
+      log(err, level=logging.ERROR)
       raise Exception(err)
 
    # Polls and monitors ntpstat command for synchronization status with intervals
    monitorNtpSync()
 
 
-def getKeyValueFromFile(filename, key):
+def synchronizeClock(state, ntpServer):
    """
-   Given a filepath and a key, getKeyValueFromFile searches for key=VALUE in it
-   and returns the found value without any whitespaces. In case no/empty key specified,
-   gives the first string in the first line of the file.
+   Configures ntp with the ntpServer unless an earlier attempt already did and the clock
+   is still synchronized, and checkpoints the step
    """
-   if not key:
-      with open(filename, "r") as f:
-         return f.readline().split()[0]
-   else:
-      with open(filename, "r") as f:
-         lines = f.readlines()
-         for line in lines:
-            if key in line :
-               return line.split("=")[1].rstrip("\n")
+   if state.checkpointOf("ntp").get("ntpServer") == ntpServer:
+      try:
+         synchronized = traced("ntpstat", "ntpstat", subprocess.call,
+                               ([NTPSTAT_BINARY],)) == 0
+      except Exception:
+         synchronized = False
+      if synchronized:
+         log("NTP already configured with %s and synchronized", ntpServer)
+         return
+   configureAndRestartNTP(ntpServer)
+   state.checkpoint("ntp", {"ntpServer": ntpServer})
+
+
+def getExpectedDigest(headers):
+   """
+   Returns the (hashlib algorithm name, base64 digest) pair advertised by the server
+   through the `Repr-Digest` (RFC 9530) or `Digest` (RFC 3230) response header,
+   None if there is none with a supported algorithm.
+   """
+   algorithms = {"sha-512": "sha512", "sha-256": "sha256"}
+   for header in ("Repr-Digest", "Digest"):
+      for value in headers.get(header, "").split(","):
+         algorithm, _, digest = value.strip().partition("=")
+         algorithm = algorithms.get(algorithm.strip().lower())
+         if algorithm and digest:
+            return algorithm, digest.strip().strip(":")
    return None
 
 
+def getResumeValidator(headers):
+   """
+   Returns the validator sent as If-Range to resume the download of a response: its strong
+   ETag, or else its Last-Modified date, None if it has neither. Weak ETags cannot be used
+   with range requests.
+   """
+   etag = headers.get("ETag", "")
+   if etag and not etag.startswith("W/"):
+      return etag
+   return headers.get("Last-Modified") or None
+
+
+class BackgroundTask(object):
+   """
+   Runs a callable in a daemon thread. The result is returned, or the exception
+   raised by the callable is re-raised, when the task is joined.
+   """
+
+   def __init__(self, name, func, *args):
+      self.result = None
+      self.errors = []
+      self.thread = threading.Thread(target=self._run, name=name, args=(func, args))
+      self.thread.daemon = True
+      self.thread.start()
+
+   def _run(self, func, args):
+      try:
+         self.result = func(*args)
+      except Exception as e:
+         self.errors.append(e)
+
+   def join(self, timeout=None):
+      self.thread.join(timeout)
+      if self.thread.is_alive():
+         raise Exception("{name} did not complete within {timeout}s".format(
+            name=self.thread.name, timeout=timeout))
+      if self.errors:
+         raise self.errors[0]
+      return self.result
+
+
+def parseKeyValueFile(filename):
+   """
+   Reads a file of KEY=VALUE lines at once, returning the values by key. The first word
+   of the file is also returned under the "" key, for files holding a single value.
+   """
+   with open(filename, "r") as f:
+      content = f.read()
+   words = content.split()
+   values = {"": words[0] if words else None}
+   for line in content.splitlines():
+      key, sep, value = line.partition("=")
+      if sep:
+         values[key.strip()] = value.strip()
+   return values
+
+
+class DeviceInventory(collections.namedtuple("DeviceInventory", [
+      "serialNum", "systemMacAddr", "modelName", "hardwareRev", "tpmApi", "tpmFwVersion",
+      "secureZtp", "softwareVersion", "architecture"])):
+   """
+   Snapshot of the device identity, sent to the redirector and along with the bootstrap
+   script request. The TPM fields are None when the TPM status cannot be read.
+   """
+   __slots__ = ()
+
+   @staticmethod
+   def readEntmib(pathHelper):
+      """Returns the fields read from entmib, the serial number among them"""
+      mibStatus = pathHelper.getEntity("hardware/entmib")
+      return {"serialNum": mibStatus.root.serialNum,
+              "systemMacAddr": mibStatus.systemMacAddr,
+              "modelName": mibStatus.root.modelName,
+              "hardwareRev": mibStatus.root.hardwareRev}
+
+   @classmethod
+   def collect(cls, pathHelper, cellID, entmib=None):
+      """
+      Reads entmib, unless its fields are given, the TPM status and the version files
+      concurrently
+      """
+      def readTpmStatus():
+         try:
+            tpmStatus = pathHelper.getEntity("cell/{cellID}/hardware/tpm/status".format(
+               cellID=cellID))
+            return {"tpmApi": tpmStatus.tpmVersion,
+                    "tpmFwVersion": tpmStatus.firmwareVersion,
+                    "secureZtp": str(tpmStatus.boardValidated)}
+         except Exception as e:
+            log("Exception while getting device tpmStatus: %s", e, level=logging.WARNING)
+            return {}
+
+      def readVersionFiles():
+         return {"softwareVersion": parseKeyValueFile(SWI_VERSION_FILE).get("SWI_VERSION"),
+                 "architecture": parseKeyValueFile(ARCH_FILE)[""]}
+
+      with metrics.timer("inventory", "device"):
+         tasks = [BackgroundTask("deviceInventory", func)
+                  for func in (readTpmStatus, readVersionFiles)]
+         if entmib is None:
+            tasks.append(BackgroundTask("deviceInventory", cls.readEntmib, pathHelper))
+         fields = dict.fromkeys(cls._fields)
+         fields.update(entmib or {})
+         for task in tasks:
+            fields.update(task.join())
+      return cls(**fields)
+
+   def headers(self):
+      """Device identity headers of the bootstrap script request"""
+      headers = {
+         "X-Arista-SystemMAC": self.systemMacAddr,
+         "X-Arista-ModelName": self.modelName,
+         "X-Arista-HardwareVersion": self.hardwareRev,
+         "X-Arista-Serial": self.serialNum,
+         "X-Arista-SoftwareVersion": self.softwareVersion,
+         "X-Arista-Architecture": self.architecture,
+         "X-Arista-CustomBootScriptVersion": VERSION,
+      }
+      if self.tpmApi is not None:
+         headers["X-Arista-TpmApi"] = self.tpmApi
+         headers["X-Arista-TpmFwVersion"] = self.tpmFwVersion
+         headers["X-Arista-SecureZtp"] = self.secureZtp
+      return headers
+
+   def dump(self):
+      return json.dumps(dict(self._asdict()), sort_keys=True, default=str)
+
+
+def getCertificateExpiry(certFile):
+   """Returns the expiry epoch of the given certificate, or None if it cannot be read"""
+   # Replayed expiries are shifted by the time elapsed since the recording
+   def decode(expiry):
+      return expiry + trace.timeOffset if expiry else expiry
+   return traced("openssl", certFile, readCertificateExpiry, (certFile,), decode=decode)
+
+
+def readCertificateExpiry(certFile):
+   cmd = [OPENSSL_BINARY, "x509", "-enddate", "-noout", "-in", certFile]
+   try:
+      output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True)
+      # e.g. notAfter=Jun  4 12:00:00 2027 GMT
+      import calendar
+      notAfter = output.strip().split("=", 1)[1]
+      return calendar.timegm(time.strptime(notAfter, "%b %d %H:%M:%S %Y %Z"))
+   except (subprocess.CalledProcessError, OSError, IndexError, ValueError) as e:
+      log("Could not read the expiry of %s, err: %s", certFile, e, level=logging.WARNING)
+      return None
+
+
+def fileSha256(path):
+   """Returns the SHA-256 hex digest of the file, None if it cannot be read"""
+   import hashlib
+   hasher = hashlib.sha256()
+   try:
+      with open(path, "rb") as f:
+         for chunk in iter(lambda: f.read(65536), b""):
+            hasher.update(chunk)
+   except (IOError, OSError):
+      return None
+   return hasher.hexdigest()
+
+
+class BootstrapState(object):
+   """
+   Results of the completed steps, persisted as JSON in STATE_CACHE_PATH: a checkpoint
+   of the outputs of every completed step, and the results of probes worth keeping. The
+   state is tied to a fingerprint of the enrollment token and cvAddr, and discarded when
+   either changes.
+   """
+
+   def __init__(self, path):
+      import hashlib
+      self.path = path
+      self.fingerprint = hashlib.sha256("{cvAddr}\n{token}".format(
+         cvAddr=cvAddr, token=enrollmentToken).encode("utf-8")).hexdigest()
+      self.values = {}
+      self.loaded = False
+
+   def load(self):
+      self.loaded = True
+      if not STATE_CACHE_ENABLED or not os.path.exists(self.path):
+         return
+      try:
+         with open(self.path, "r") as f:
+            state = json.load(f)
+      except (IOError, OSError, ValueError) as e:
+         log("Ignoring unreadable state cache %s, err: %s", self.path, e,
+             level=logging.WARNING)
+         return
+      if state.get("fingerprint") != self.fingerprint:
+         log("Token or cvAddr changed, discarding the state of earlier attempts")
+         self.clear()
+         return
+      self.values = state.get("values", {})
+
+   def get(self, key):
+      return self.values.get(key)
+
+   def update(self, **values):
+      self.values.update(values)
+      self.save()
+
+   def checkpointOf(self, step):
+      """Outputs recorded by the last completion of the step, empty if there are none"""
+      return (self.values.get("checkpoints") or {}).get(step) or {}
+
+   def checkpoint(self, step, outputs, dropping=()):
+      """
+      Records the outputs of a completed step along with its completion time, and drops
+      the checkpoints of the given steps, in a single atomic write
+      """
+      checkpoints = dict(self.values.get("checkpoints") or {})
+      for name in dropping:
+         checkpoints.pop(name, None)
+      checkpoints[step] = dict(outputs, time=time.time())
+      self.update(checkpoints=checkpoints)
+
+   def dropCheckpoints(self, *steps):
+      checkpoints = dict(self.values.get("checkpoints") or {})
+      for step in steps:
+         checkpoints.pop(step, None)
+      self.update(checkpoints=checkpoints)
+
+   def clear(self):
+      self.values = {}
+      try:
+         os.remove(self.path)
+      except OSError:
+         pass
+
+   def save(self):
+      """Writes the state to a temporary file, atomically renamed over the previous one"""
+      if not STATE_CACHE_ENABLED:
+         return
+      tmpPath = self.path + ".tmp"
+      try:
+         with open(tmpPath, "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "values": self.values}, f)
+            f.flush()
+            os.fsync(f.fileno())
+         os.rename(tmpPath, self.path)
+      except (IOError, OSError) as e:
+         log("Could not save the state cache to %s, err: %s", self.path, e,
+             level=logging.WARNING)
+
+
+class ImagePrestageCancelled(Exception):
+   pass
+
+
+class ImagePrestage(object):
+   """
+   Downloads the `eosUrl` image into PRESTAGED_IMAGE_PATH in a background task. Only the
+   standard library is used, since the upgrade may be needed precisely because requests
+   cannot be imported.
+   """
+
+   def __init__(self, url):
+      self.url = url
+      self.cancelled = threading.Event()
+      self.task = BackgroundTask("imagePrestage", self.prestage)
+
+   def wait(self):
+      """Returns the path of the verified image, raises if it could not be prestaged"""
+      return self.task.join()
+
+   def discard(self):
+      """Stops the download and removes the prestaged image, which is not needed"""
+      self.cancelled.set()
+      try:
+         self.task.join()
+      except Exception:
+         pass
+      for path in (PRESTAGED_IMAGE_PATH + ".part", PRESTAGED_IMAGE_PATH):
+         if os.path.exists(path):
+            os.remove(path)
+
+   def open(self, url, headers=None):
+      try:
+         from urllib.request import Request, urlopen
+      except ImportError:
+         from urllib2 import Request, urlopen
+      return urlopen(Request(url, headers=headers or {}), timeout=HTTP_READ_TIMEOUT)
+
+   def prestage(self):
+      with metrics.timer("prestage", "eosImage") as attrs:
+         response = self.open(self.url + EOS_IMAGE_CHECKSUM_SUFFIX)
+         try:
+            # sha512sum format: "<hex digest>  <file name>"
+            expected = response.read().decode("ascii").split()[0].lower()
+         finally:
+            response.close()
+         for path in (EOS_IMAGE_PATH, PRESTAGED_IMAGE_PATH):
+            if os.path.exists(path) and self.sha512(path) == expected:
+               log("%s already holds the image at %s", path, self.url)
+               attrs["skipped"] = True
+               return path
+
+         partPath = PRESTAGED_IMAGE_PATH + ".part"
+         attrs["bytes"], attrs["connections"] = self.download(partPath)
+         digest = self.sha512(partPath)
+         if digest != expected:
+            os.remove(partPath)
+            raise Exception("EOS image sha512 mismatch, expected {expected}, got "
+                            "{digest}".format(expected=expected, digest=digest))
+         os.rename(partPath, PRESTAGED_IMAGE_PATH)
+         log("EOS image prestaged at %s", PRESTAGED_IMAGE_PATH)
+         return PRESTAGED_IMAGE_PATH
+
+   def download(self, path):
+      """Downloads the image, returns its size and the number of connections used"""
+      response = self.open(self.url, {"Range": "bytes=0-0"})
+      try:
+         contentRange = response.info().get("Content-Range", "")
+         if response.getcode() != 206 or "/" not in contentRange:
+            # No range support, the whole image is in this response
+            with open(path, "wb") as f:
+               size = self.copy(response, f, None)
+               os.fsync(f.fileno())
+            return size, 1
+      finally:
+         response.close()
+
+      size = int(contentRange.rsplit("/", 1)[1])
+      with open(path, "wb") as f:
+         f.truncate(size)
+      segmentSize = max(-(-size // PRESTAGE_CONNECTIONS), 1)
+      tasks = [BackgroundTask("imagePrestageRange", self.downloadRange, path, start,
+                              min(start + segmentSize, size) - 1)
+               for start in range(0, size, segmentSize)]
+      errors = []
+      for task in tasks:
+         try:
+            task.join()
+         except Exception as e:
+            errors.append(e)
+      if errors:
+         # Those of the segments cancelled because another one failed are not the cause
+         raise ([e for e in errors if not isinstance(e, ImagePrestageCancelled)] + errors)[0]
+      with open(path, "r+b") as f:
+         os.fsync(f.fileno())
+      return size, len(tasks)
+
+   def downloadRange(self, path, start, end):
+      """
+      Downloads bytes `start` to `end` included, resuming after failures. When it gives
+      up, the other segments are cancelled, rather than left to compete for the link with
+      the `install source` the upgrade falls back to.
+      """
+      retryPolicy = RetryPolicy("imagePrestage",
+                                isRetryable=lambda e: not isinstance(e, ImagePrestageCancelled),
+                                cancelled=self.cancelled)
+      offset = start
+      attempt = 1
+      try:
+         while offset <= end:
+            try:
+               response = self.open(self.url, {"Range": "bytes={start}-{end}".format(
+                  start=offset, end=end)})
+               try:
+                  if response.getcode() != 206:
+                     raise IOError("Range request not honoured")
+                  with open(path, "r+b") as f:
+                     f.seek(offset)
+                     offset += self.copy(response, f, end + 1 - offset)
+               finally:
+                  response.close()
+               if offset <= end:
+                  raise IOError("Connection closed after {size} bytes".format(
+                     size=offset - start))
+            except (IOError, OSError, socket.error) as e:
+               retryPolicy.sleepBeforeRetry(attempt, e)
+               attempt += 1
+      except Exception:
+         self.cancelled.set()
+         raise
+
+   def copy(self, response, f, size):
+      """Copies up to `size` bytes, all of them if None, of the response into `f`"""
+      copied = 0
+      while size is None or copied < size:
+         if self.cancelled.is_set():
+            raise ImagePrestageCancelled("EOS image prestaging cancelled")
+         toRead = DOWNLOAD_CHUNK_SIZE if size is None else min(DOWNLOAD_CHUNK_SIZE,
+                                                                size - copied)
+         chunk = response.read(toRead)
+         if not chunk:
+            break
+         f.write(chunk)
+         copied += len(chunk)
+      return copied
+
+   def sha512(self, path):
+      import hashlib
+      hasher = hashlib.sha512()
+      with open(path, "rb") as f:
+         for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            if self.cancelled.is_set():
+               raise ImagePrestageCancelled("EOS image prestaging cancelled")
+            hasher.update(chunk)
+      return hasher.hexdigest()
+
+imagePrestage = None
+
+def startImagePrestage():
+   global imagePrestage
+   if PRESTAGE_EOS_IMAGE and eosUrl != "" and imagePrestage is None:
+      log("Prestaging the EOS image from %s", eosUrl)
+      imagePrestage = ImagePrestage(eosUrl)
+
+
+def discardImagePrestage():
+   if imagePrestage is not None:
+      imagePrestage.discard()
+
+
 def tryImageUpgrade(e):
    """
    Try to perform an EOS image upgrade to the EOS image version specified in the `eosUrl`.
    Raises the received exception back if `eosUrl` is not specified
    """
-   cli = CliManager()
+   cli = CliManager.getInstance()
    if eosUrl == "":
       # Raise the received exception if eosUrl is empty
       log("Specify 'eosUrl' for EOS version upgrade")
       raise e
 
-   # Install new image
-   cmdList = ["enable", "install source {eosUrl} destination flash:/EOS.swi".format(eosUrl=eosUrl)]
+   imagePath = None
+   if imagePrestage is not None:
+      log("Waiting for the EOS image prestaged from %s", eosUrl)
+      try:
+         imagePath = imagePrestage.wait()
+      except Exception as err:
+         log("Failed to prestage the EOS image, installing it instead, err: %s", err,
+             level=logging.WARNING)
+
+   if imagePath:
+      # Boot the verified image already on flash
+      if imagePath != EOS_IMAGE_PATH:
+         os.rename(imagePath, EOS_IMAGE_PATH)
+      cmdList = ["enable", "configure", "boot system flash:/EOS.swi", "end"]
+   else:
+      # Install new image
+      cmdList = ["enable",
+                 "install source {eosUrl} destination flash:/EOS.swi".format(eosUrl=eosUrl)]
    rc, cmdOut = cli.runCommands(cmdList)
    if rc:
       err = "Failed to upgrade EOS from {eosUrl}, err: {err}. Aborting.".format(
          eosUrl=eosUrl, err=cmdOut)
-      log(err)
+      log(err, level=logging.ERROR)
       raise Exception(err)
 
-   # Reboot device
+   # Reboot device, nothing logged afterwards is kept
+   flushLogger()
    cmdList = ["enable", "reload all now"]
    rc, cmdOut = cli.runCommands(cmdList)
    if rc:
       err = "Failed to reboot for image upgrade, err: {err}. Aborting.".format(err=cmdOut)
-      log(err)
+      log(err, level=logging.ERROR)
       raise Exception(err)
 
 
@@ -248,17 +1762,38 @@ def tryImageUpgrade(e):
 # in python2 environment starting EOS 4.30.1 If that is the case, we try to run the
 # script with python3. In case we cannot recover, the script will require "eosUrl" to
 # perform an upgrade before it can proceed.
-try:
-   import Cell
-   import requests
-   from SysdbHelperUtils import SysdbPathHelper
-except ImportError as e:
+# The imports are deferred until the step needing them, see INTERPRETER SELECTION for
+# the early switch to python3.
+requests = None
+
+def handleImportError(e):
    if sys.version_info < (3,) and os.path.exists("/usr/bin/python3"):
-      os.execl("/usr/bin/python3", "python3", os.path.abspath(__file__ ))
+      os.execl("/usr/bin/python3", "python3", os.path.abspath(__file__), *sys.argv[1:])
    else:
       log("Python3 not found. Attempting EOS version upgrade")
       tryImageUpgrade(e)
 
+
+def importEosModules():
+   """Imports the EOS modules giving access to Sysdb, returns (Cell, SysdbPathHelper)"""
+   try:
+      import Cell
+      from SysdbHelperUtils import SysdbPathHelper
+   except ImportError as e:
+      handleImportError(e)
+   return Cell, SysdbPathHelper
+
+
+def importRequests():
+   """Imports requests, only needed once the script starts talking to CVaaS"""
+   global requests
+   if requests is None:
+      try:
+         import requests
+         import requests.adapters
+      except ImportError as e:
+         handleImportError(e)
+
 try:
    # This import will fail for EOS < 4.30.1, where #!/usr/bin/python
    # will run this in a Python2 environment
@@ -267,13 +1802,37 @@ except ImportError:
    from urlparse import urlparse
 
 
+def buildBootstrapURL(addr, cloud):
+   """
+   Parses a CVP address into the URL of its bootstrap endpoint. Cloud addresses default
+   to https and are normalised to their `www` host, on-prem ones default to http.
+   """
+   # urlparse in py3 parses correctly only if the url is properly introduced by //
+   if not (addr.startswith("//") or addr.startswith("http://") or
+            addr.startswith("https://")):
+      addr = "//" + addr
+   if cloud:
+      addr = addr.replace("apiserver", "www")
+   addrURL = urlparse( addr )
+   if addrURL.netloc == "":
+      addrURL = addrURL._replace(path="", netloc=addrURL.path)
+   if addrURL.path == "":
+      addrURL = addrURL._replace(path="/ztp/bootstrap")
+   if addrURL.scheme == "":
+      if cloud:
+         addrURL = addrURL._replace(scheme="https")
+      else:
+         addrURL = addrURL._replace(scheme="http")
+   return addrURL
+
+
 class BootstrapManager(object):
    """
    Bootstrap Manager class to perform enrollment to download and execute the
    bootstrap script.
    """
 
-   def __init__(self):
+   def __init__(self, state=None):
       super(BootstrapManager, self).__init__()
       self.bootstrapURL = None
       self.redirectorURL = None
@@ -281,99 +1840,360 @@ class BootstrapManager(object):
       self.enrollAddr = None
       self.certificate = ""
       self.key = ""
+      # DeviceInventory, collected once, in the background when pipelining. The entmib
+      # fields are then read first, as the redirector only needs the serial number.
+      self.inventory = None
+      self.inventoryTask = None
+      self.entmibTask = None
+      # TerminAttrCapabilities, probed once, in the background when pipelining
+      self.terminAttr = None
+      self.terminAttrTask = None
+      # certsconfig lookup run alongside the enrollment, with the enrollAddr it is for
+      self.certsconfigTask = None
+      # Created by the first request, which the redirector probes may send concurrently
+      self.httpSession = None
+      self.httpSessionLock = threading.Lock()
+      self.assignmentHosts = []
+      self.state = state if state is not None else BootstrapState(STATE_CACHE_PATH)
+      # Steps completed by an earlier attempt, see restoreState
+      self.restoredStages = set()
+
+      # The device inventory is replayed without Sysdb
+      self.pathHelper = None
+      self.cellID = None
+      if trace is not None and trace.replaying:
+         return
 
       # setting Sysdb access variables
+      Cell, SysdbPathHelper = importEosModules()
       sysname = os.environ.get("SYSNAME", "ar")
       self.pathHelper = SysdbPathHelper(sysname)
 
       # sysdb paths accessed
       self.cellID = str(Cell.cellId())
-      self.mibStatus = self.pathHelper.getEntity("hardware/entmib")
+
+   def readEntmib(self):
+      return traced("sysdb", "entmib", DeviceInventory.readEntmib, (self.pathHelper,))
+
+   def getEntmib(self):
+      """Returns the entmib fields read in the background, None if they could not be"""
+      if self.entmibTask is None:
+         return None
+      try:
+         return self.entmibTask.join()
+      except Exception as e:
+         log("Failed to read entmib in the background, err: %s", e, level=logging.WARNING)
+         self.entmibTask = None
+         return None
+
+   def collectInventory(self):
+      inventory = traced("sysdb", "inventory", DeviceInventory.collect,
+                         (self.pathHelper, self.cellID, self.getEntmib()),
+                         encode=lambda inventory: json.loads(inventory.dump()),
+                         decode=lambda fields: DeviceInventory(**fields))
+      log("Device inventory: %s", inventory.dump())
+      return inventory
+
+   def getInventory(self):
+      """Returns the device inventory, waiting for it if it is being collected"""
+      if self.inventory is None and self.inventoryTask is not None:
+         task, self.inventoryTask = self.inventoryTask, None
+         try:
+            self.inventory = task.join()
+         except Exception as e:
+            # Collected again, on the critical path
+            log("Failed to collect the device inventory in the background, err: %s", e,
+                level=logging.WARNING)
+      if self.inventory is None:
+         self.inventory = self.collectInventory()
+      return self.inventory
+
+   def getSerialNum(self):
+      """
+      Returns the serial number of the device without waiting for the rest of the
+      inventory being collected, the TPM status being slow to read
+      """
+      if self.inventory is None:
+         entmib = self.getEntmib()
+         if entmib is not None:
+            return entmib["serialNum"]
+      return self.getInventory().serialNum
+
+   def probeTerminAttr(self):
+      capabilities = TerminAttrCapabilities.fromState(self.state.get("terminAttr"))
+      if capabilities is None:
+         capabilities = TerminAttrCapabilities.probe()
+      log("%s supports %s", capabilities.describe(),
+          ", ".join(capabilities.flags) if capabilities.flags else "unknown flags")
+      return capabilities
+
+   def getTerminAttrCapabilities(self):
+      """Returns the TerminAttr capabilities, waiting for them if they are being probed"""
+      if self.terminAttr is None and self.terminAttrTask is not None:
+         task, self.terminAttrTask = self.terminAttrTask, None
+         try:
+            self.terminAttr = task.join()
+         except Exception as e:
+            log("Failed to probe TerminAttr in the background, err: %s", e,
+                level=logging.WARNING)
+      if self.terminAttr is None:
+         self.terminAttr = self.probeTerminAttr()
+      if self.terminAttr.version is not None or self.terminAttr.flags is not None:
+         self.state.update(terminAttr=self.terminAttr.toState())
+      return self.terminAttr
 
    def getBootstrapURL(self, addr):
-      # urlparse in py3 parses correctly only if the url is properly introduced by //
-      if not (addr.startswith("//") or addr.startswith("http://") or
-               addr.startswith("https://")):
-         addr = "//" + addr
-      if isinstance(self, CloudBootstrapManager):
-         addr = addr.replace("apiserver", "www")
-      addrURL = urlparse( addr )
-      if addrURL.netloc == "":
-         addrURL = addrURL._replace(path="", netloc=addrURL.path)
-      if addrURL.path == "":
-         addrURL = addrURL._replace(path="/ztp/bootstrap")
-      if addrURL.scheme == "":
-         if isinstance(self, CloudBootstrapManager):
-            addrURL = addrURL._replace(scheme="https")
-         else:
-            addrURL = addrURL._replace(scheme="http")
-      return addrURL
+      return buildBootstrapURL(addr, isinstance(self, CloudBootstrapManager))
+
+   def getHttpSession(self):
+      """
+      Returns the HTTP session shared by all the requests made to CVaaS. Connections are
+      pooled and kept alive, hence the TCP and TLS handshakes, and the CONNECT through
+      cvproxy, happen once per host instead of once per request.
+      """
+      with self.httpSessionLock:
+         if self.httpSession is None:
+            importRequests()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE,
+                                                    pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Connection"] = "keep-alive"
+            self.httpSession = session
+         return self.httpSession
+
+   def closeHttpSession(self):
+      with self.httpSessionLock:
+         if self.httpSession is not None:
+            self.httpSession.close()
+            self.httpSession = None
+
+   def httpRequest(self, method, url, **kwargs):
+      """
+      Sends a request through the shared HTTP session, recording its status, time to
+      first byte and, unless the response is streamed, its size. Requests time out after
+      HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT unless told otherwise.
+      The proxies are passed with each request rather than set on the session, whose
+      proxies the environment ones would override: cvproxy is used, and an empty one
+      means a direct connection, whatever HTTPS_PROXY says.
+      """
+      kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+      kwargs.setdefault("proxies", proxies)
+      addr = urlparse(url)
+      name = "{method} {path}".format(method=method, path=addr.path)
+      with metrics.timer("http", name, host=addr.netloc) as attrs:
+         def send():
+            return self.getHttpSession().request(method, url, **kwargs)
+         response = traced("http", "{method} {url}".format(method=method, url=url), send,
+                           encode=encodeHttpResponse, decode=decodeHttpResponse)
+         attrs["status"] = response.status_code
+         attrs["ttfb"] = round(response.elapsed.total_seconds(), 3)
+         if not kwargs.get("stream"):
+            attrs["bytes"] = len(response.content)
+         return response
 
    ##################################################################################
    # Step 0: Redirect to the correct cluster url
    ##################################################################################
    def checkWithRedirector(self):
       if not self.redirectorURL:
+         self.checkpoint("redirector", enrollAddr=self.enrollAddr)
          return
 
-      try:
+      # Needed by the queries, which may be made concurrently
+      self.getSerialNum()
+      if PARALLEL_REDIRECTOR_PROBE:
+         self.assignmentHosts = self.rankHostsByLatency(self.probeRedirectors())
+      else:
+         self.assignmentHosts = self.queryRedirector(self.redirectorURL)
+      self.useAssignmentHost(self.assignmentHosts[0])
+      self.checkpointAssignment()
 
-         payload = '{{"key": {{"system_id": "{serialNum}"}}}}'.format(
-            serialNum=self.mibStatus.root.serialNum)
+      log("Step 0 done, redirected to the correct cluster URL")
+      log("enrollAddr - %s", self.enrollAddr)
+
+   def queryRedirector(self, redirectorURL, cancelled=None):
+      """
+      Returns the hosts of all the clusters the device is assigned to, in order. Setting
+      `cancelled` stops the retries, and the query then fails without logging an error.
+      """
+      def fail(err):
+         if cancelled is None or not cancelled.is_set():
+            log(err, level=logging.ERROR)
+         raise Exception(err)
 
+      try:
+         payload = json.dumps({"key": {"system_id": self.getSerialNum()}})
          headers = {"redirector_token": enrollmentToken}
-         response = requests.post(self.redirectorURL.geturl(), data=payload,
-                                    headers=headers, proxies=proxies)
-         response.raise_for_status()
+         def post():
+            response = self.httpRequest("POST", redirectorURL.geturl(), data=payload,
+                                        headers=headers)
+            response.raise_for_status()
+            return response
+         response = RetryPolicy("redirector", cancelled=cancelled).run(post)
       except Exception as e:
-         err = "No assignment found. Error talking to redirector: {err}".format(err=e)
-         log(err)
-         raise Exception(err)
+         fail("No assignment found. Error talking to redirector: {err}".format(err=e))
 
       clusters = response.json()[0]["value"]["clusters"]["values"]
-      assignment = clusters[0]["hosts"]["values"][0]
+      hosts = [host for cluster in clusters for host in cluster["hosts"]["values"]]
+      if not hosts:
+         fail("No assignment found. Redirector {url} returned no hosts".format(
+            url=redirectorURL.geturl()))
+      return hosts
+
+   def probeRedirectors(self):
+      """
+      Queries the redirector through `cvAddr` and all REDIRECTOR_FRONT_DOORS concurrently,
+      returning the hosts of the first valid assignment received. The other queries are
+      cancelled then.
+      """
+      urls = []
+      for addr in [cvAddr] + REDIRECTOR_FRONT_DOORS:
+         url = self.getBootstrapURL(addr)._replace(path=REDIRECTOR_PATH)
+         if url not in urls:
+            urls.append(url)
+
+      results = queue.Queue()
+      cancelled = threading.Event()
+      def probe(url):
+         try:
+            results.put((url, self.queryRedirector(url, cancelled), None))
+         except Exception as e:
+            results.put((url, None, e))
+
+      for url in urls:
+         worker = threading.Thread(target=probe, name="redirectorProbe", args=(url,))
+         worker.daemon = True
+         worker.start()
+
+      errors = []
+      for _ in urls:
+         url, hosts, err = results.get()
+         if hosts:
+            cancelled.set()
+            log("Using the assignment from redirector %s", url.netloc)
+            return hosts
+         errors.append("{url}: {err}".format(url=url.netloc, err=err))
+      err = "No assignment found from any redirector: {errors}".format(
+         errors="; ".join(errors))
+      log(err, level=logging.ERROR)
+      raise Exception(err)
+
+   def rankHostsByLatency(self, hosts):
+      """
+      Orders the hosts by the time a TCP connect to them takes, unreachable hosts last.
+      The order is kept as is when going through cvproxy, as only the proxy is reachable.
+      """
+      if cvproxy != "" or len(hosts) < 2:
+         return hosts
+
+      def connectLatency(host):
+         addr = self.getBootstrapURL(host)
+         startTime = time.time()
+         try:
+            sock = socket.create_connection((addr.hostname, addr.port or int(SECURE_HTTPS_PORT)),
+                                            CONNECT_PROBE_TIMEOUT)
+            sock.close()
+         except (socket.error, socket.timeout) as e:
+            log("Connect probe to %s failed, err: %s", host, e, level=logging.WARNING)
+            return float("inf")
+         return time.time() - startTime
+
+      tasks = [(host, BackgroundTask("connectProbe", traced, "connect", host, connectLatency,
+                                     (host,)))
+               for host in hosts]
+      latencies = [(task.join(), i, host) for i, (host, task) in enumerate(tasks)]
+      latencies.sort()
+      log("Assigned hosts by connect latency: %s", ", ".join(
+         "{host}={latency:.3f}s".format(host=host, latency=latency)
+         for latency, _, host in latencies))
+      return [host for _, _, host in latencies]
+
+   def checkpointAssignment(self):
+      self.checkpoint("redirector", assignmentHosts=self.assignmentHosts,
+                      bootstrapURL=self.bootstrapURL.geturl(), enrollAddr=self.enrollAddr)
+
+   def useAssignmentHost(self, assignment):
       self.bootstrapURL = self.getBootstrapURL(assignment)
       self.enrollAddr = self.bootstrapURL.netloc
       if not self.enrollAddr.endswith(SECURE_HTTPS_PORT):
          self.enrollAddr += ":" + SECURE_HTTPS_PORT
       self.enrollAddr = self.enrollAddr.replace("www", "apiserver")
 
-      log("Step 0 done, redirected to the correct cluster URL")
-      log("enrollAddr - {enrollAddr}".format(enrollAddr=self.enrollAddr))
+   def enrollWithFallback(self):
+      """
+      Runs Step 1 against the assigned host in use, falling back to the other hosts of
+      the assignment, in order, if the enrollment fails.
+      """
+      for host in self.assignmentHosts[1:]:
+         try:
+            return self.getClientCertificates()
+         except subprocess.CalledProcessError:
+            log("Enrollment against %s failed, falling back to %s", self.enrollAddr, host,
+                level=logging.WARNING)
+            self.useAssignmentHost(host)
+            log("enrollAddr - %s", self.enrollAddr)
+            self.checkpointAssignment()
+      return self.getClientCertificates()
 
    ##################################################################################
    # Step 1: Get client certificate using the enrollment token
    ##################################################################################
    def getClientCertificates( self ):
+      capabilities = self.getTerminAttrCapabilities()
+      # Use cvproxy only when it is specified, this is to ensure that if we are on
+      # older version of EOS that doesn't support cvproxy flag, the script won't fail
+      required = ["enrollonly", "cvproxy"] if cvproxy != "" else ["enrollonly"]
+      missing = [flag for flag in required if capabilities.supports(flag) is False]
+      if missing:
+         err = "{terminAttr} does not support -{flags}".format(
+            terminAttr=capabilities.describe(), flags=", -".join(missing))
+         log(err, level=logging.ERROR)
+         log("Attempting EOS version upgrade")
+         tryImageUpgrade(Exception(err))
+         return
+
       with open(TOKEN_FILE_PATH, "w") as f:
          f.write(enrollmentToken)
 
-      # A timeout of 60 seconds is used with TerminAttr commands since in most
-      # versions of TerminAttr, the command execution does not finish if a wrong
-      # flag is specified leading to the catch block being never executed
-      cmd = "timeout 60s /usr/bin/TerminAttr"
-      cmd += " -cvauth {tokenType},{tokenFilePath}".format(
-         tokenType=self.tokenType, tokenFilePath=TOKEN_FILE_PATH)
-      cmd += " -cvaddr {enrollAddr}".format(enrollAddr=self.enrollAddr)
-      cmd += " -enrollonly"
-
-      # Use cvproxy only when it is specified, this is to ensure that if we are on
-      # older version of EOS that doesn't support cvproxy flag, the script won't fail
+      args = ["-cvauth", "{tokenType},{tokenFilePath}".format(
+                 tokenType=self.tokenType, tokenFilePath=TOKEN_FILE_PATH),
+              "-cvaddr", self.enrollAddr, "-enrollonly"]
       if cvproxy != "":
-         cmd += " -cvproxy={cvproxy}".format(cvproxy=cvproxy)
+         args.append("-cvproxy={cvproxy}".format(cvproxy=cvproxy))
+
+      # The certsconfig lookup only depends on enrollAddr, it runs alongside the
+      # enrollment rather than as a second TerminAttr launch after it
+      self.certsconfigTask = None
+      if PIPELINED_RUN and capabilities.supports("certsconfig"):
+         self.certsconfigTask = (self.enrollAddr,
+                                 BackgroundTask("certsconfig", self.queryCertificatePaths,
+                                                self.enrollAddr))
+
+      # A timeout of TERMINATTR_TIMEOUT seconds is used with TerminAttr since in most
+      # versions of TerminAttr, the command execution does not finish if a wrong flag is
+      # specified. With cvproxy and unknown capabilities, a timeout most likely means that
+      # the -cvproxy flag is not supported, which no retry fixes. Otherwise the enrollment
+      # was merely slow.
+      def isRetryable(e):
+         return isRetryableError(e) and isinstance(e, subprocess.CalledProcessError) and (
+            e.returncode != 124 or cvproxy == "" or capabilities.supports("cvproxy"))
 
       try:
-         subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+         RetryPolicy("enroll", isRetryable=isRetryable).run(runTerminAttr, "enrollonly", args)
+         self.checkpoint("enroll", enrollAddr=self.enrollAddr)
       except subprocess.CalledProcessError as e:
          # If the above subprocess call times out, it means that -cvproxy
          # flag is not present in the TerminAttr version running on that device
          # Hence we have to do an image upgrade in this case.
-         if e.returncode == 124: # timeout
-            log("TerminAttr enrollment timed out, err: {err}".format(err=e.output))
+         if e.returncode == 124 and not capabilities.supports("cvproxy"): # timeout
+            log("TerminAttr enrollment timed out, err: %s", e.output, level=logging.ERROR)
             log("Attempting EOS version upgrade")
             tryImageUpgrade(e)
+            return
          else:
-            log("Failed to retrieve certs, err: {err}".format(err=e.output))
+            log("Failed to retrieve certs, err: %s", e.output, level=logging.ERROR)
             raise e
 
       log("Step 1 done, exchanged enrollment token for client certificates")
@@ -381,69 +2201,167 @@ class BootstrapManager(object):
    ##################################################################################
    # Step 2: Get the path of stored client certificate
    ##################################################################################
-   def getCertificatePaths( self ):
-      # Timeout added for TerminAttr
-      cmd = "timeout 60s /usr/bin/TerminAttr"
-      cmd += " -cvaddr {enrollAddr}".format(enrollAddr=self.enrollAddr)
-      cmd += " -certsconfig"
+   def queryCertificatePaths(self, enrollAddr):
+      """Returns the certificate and key paths TerminAttr uses for enrollAddr"""
+      response = runTerminAttr("certsconfig", ["-cvaddr", enrollAddr, "-certsconfig"])
+      json_response = json.loads(response)
+      return (str(json_response[enrollAddr]["certFile"]),
+              str(json_response[enrollAddr]["keyFile"]))
 
-      try:
-         response = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT,
-                                             universal_newlines=True)
-         json_response = json.loads(response)
-         self.certificate = str(json_response[self.enrollAddr]["certFile"])
-         self.key = str( json_response[self.enrollAddr]["keyFile"])
-      except subprocess.CalledProcessError as e:
-         log("Failed to get the path of the stored client certs, err: {err}".format(
-            err=e.output))
-         log("Using fallback paths for client certs")
+   def getCertificatePaths( self ):
+      paths = None
+      if self.certsconfigTask is not None:
+         (enrollAddr, task), self.certsconfigTask = self.certsconfigTask, None
+         try:
+            if enrollAddr == self.enrollAddr:
+               paths = task.join()
+         except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            # Looked up again, now that the enrollment is complete
+            log("certsconfig lookup alongside the enrollment failed, err: %s",
+                getattr(e, "output", e), level=logging.DEBUG)
+
+      if paths is None and self.getTerminAttrCapabilities().supports("certsconfig") is False:
+         log("%s does not support -certsconfig", self.terminAttr.describe(),
+             level=logging.WARNING)
+      elif paths is None:
+         try:
+            paths = self.queryCertificatePaths(self.enrollAddr)
+         except subprocess.CalledProcessError as e:
+            log("Failed to get the path of the stored client certs, err: %s", e.output,
+                level=logging.WARNING)
+
+      if paths is None:
+         log("Using fallback paths for client certs", level=logging.WARNING)
          basePath = "/persist/secure/ssl/terminattr/primary"
-         self.certificate = "{basePath}/certs/client.crt".format(basePath=basePath)
-         self.key = "{basePath}/keys/client.key".format(basePath=basePath)
+         paths = ("{basePath}/certs/client.crt".format(basePath=basePath),
+                  "{basePath}/keys/client.key".format(basePath=basePath))
+      self.certificate, self.key = paths
+      self.checkpoint("certsconfig", certificate=self.certificate, key=self.key,
+                      certExpiry=getCertificateExpiry(self.certificate))
 
       log("Step 2 done, obtained client certs location")
-      log("certificate location - {certificate}".format(certificate=self.certificate))
-      log("key location - {key}".format(key=self.key))
+      log("certificate location - %s", self.certificate)
+      log("key location - %s", self.key)
 
    ##################################################################################
    # Step 3.1: Get bootstrap script using the certificates
    ##################################################################################
    def getBootstrapScript( self ):
       # Setting header information
-      headers = {}
-      headers["X-Arista-SystemMAC"] = self.mibStatus.systemMacAddr
-      headers["X-Arista-ModelName"] = self.mibStatus.root.modelName
-      headers["X-Arista-HardwareVersion"] = self.mibStatus.root.hardwareRev
-      headers["X-Arista-Serial"] = self.mibStatus.root.serialNum
-
-      try:
-         tpmStatus = self.pathHelper.getEntity("cell/{cellID}/hardware/tpm/status".format(
-            cellID=self.cellID))
-         headers["X-Arista-TpmApi"] = tpmStatus.tpmVersion
-         headers["X-Arista-TpmFwVersion"] = tpmStatus.firmwareVersion
-         headers["X-Arista-SecureZtp"] = str(tpmStatus.boardValidated)
-      except Exception as e:
-         log("Exception while getting device tpmStatus: {err}".format(err=e))
-
-      headers["X-Arista-SoftwareVersion"] = getKeyValueFromFile("/etc/swi-version",
-                                                                  "SWI_VERSION")
-      headers["X-Arista-Architecture"] = getKeyValueFromFile("/etc/arch", "")
-      headers["X-Arista-CustomBootScriptVersion"] = VERSION
+      headers = self.getInventory().headers()
 
       # Making the request and writing to file
-      response = requests.get(self.bootstrapURL.geturl(), headers=headers,
-                              cert=(self.certificate, self.key), proxies=proxies)
-      response.raise_for_status()
-      with open(BOOT_SCRIPT_PATH, "w") as f:
-         f.write(response.text)
-
-      log("Step 3.1 done, bootstrap script fetched and stored at {bootScriptPath}".format(
-         bootScriptPath=BOOT_SCRIPT_PATH))
+      importRequests()
+      try:
+         if STREAM_BOOTSTRAP_DOWNLOAD:
+            self.downloadBootstrapScript(headers)
+         else:
+            def get():
+               response = self.httpRequest("GET", self.bootstrapURL.geturl(), headers=headers,
+                                           cert=(self.certificate, self.key))
+               response.raise_for_status()
+               return response
+            response = RetryPolicy("fetch").run(get)
+            with open(BOOT_SCRIPT_PATH, "w") as f:
+               f.write(response.text)
+      except requests.exceptions.HTTPError as e:
+         # The client certificates were rejected, the next attempt enrolls again
+         if e.response is not None and e.response.status_code in (401, 403):
+            self.state.dropCheckpoints("enroll", "certsconfig", "fetch")
+         raise
+      self.checkpoint("fetch", path=BOOT_SCRIPT_PATH, sha256=fileSha256(BOOT_SCRIPT_PATH))
+
+      log("Step 3.1 done, bootstrap script fetched and stored at %s", BOOT_SCRIPT_PATH)
+
+   def downloadBootstrapScript(self, headers):
+      """
+      Streams the bootstrap script into a temporary file, which is fsynced and atomically
+      renamed to BOOT_SCRIPT_PATH once complete. After a retryable failure, the transfer
+      is resumed from where it stopped with an HTTP Range request, conditional on the
+      ETag or Last-Modified date of the first response so that a script regenerated in
+      between is downloaded in full instead of being stitched together. Without either, the
+      download restarts from the beginning. The content is checked against the digest
+      supplied by the server, if any.
+      """
+      retryPolicy = RetryPolicy("fetch", attempts=DOWNLOAD_ATTEMPTS)
+      startTime = time.time()
+      partPath = BOOT_SCRIPT_PATH + ".part"
+      headers = dict(headers)
+      # Range offsets and digests are computed over the unencoded content
+      headers["Accept-Encoding"] = "identity"
+      offset = 0
+      hasher = None
+      expectedDigest = None
+      validator = None
+      attempt = 1
+      while True:
+         if offset:
+            headers["Range"] = "bytes={offset}-".format(offset=offset)
+            headers["If-Range"] = validator
+         else:
+            # Nothing to resume, e.g. after a server ignored the range request
+            headers.pop("Range", None)
+            headers.pop("If-Range", None)
+         try:
+            response = self.httpRequest("GET", self.bootstrapURL.geturl(), headers=headers,
+                                        cert=(self.certificate, self.key), stream=True)
+            try:
+               response.raise_for_status()
+               if offset and response.status_code != 206:
+                  log("Server ignored the range request or the script changed, restarting "
+                      "the download", level=logging.WARNING)
+                  offset = 0
+               if not offset:
+                  validator = getResumeValidator(response.headers)
+                  hasher = None
+                  expectedDigest = getExpectedDigest(response.headers)
+                  if expectedDigest:
+                     import hashlib
+                     hasher = hashlib.new(expectedDigest[0])
+               with open(partPath, "ab" if offset else "wb") as f:
+                  for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                     f.write(chunk)
+                     offset += len(chunk)
+                     if hasher:
+                        hasher.update(chunk)
+                  f.flush()
+                  os.fsync(f.fileno())
+            finally:
+               response.close()
+            break
+         except Exception as e:
+            retryPolicy.sleepBeforeRetry(attempt, e)
+            attempt += 1
+            if offset and not validator:
+               log("Restarting the bootstrap script download, which has neither ETag nor "
+                   "Last-Modified to resume it with", level=logging.WARNING)
+               offset = 0
+            elif offset:
+               log("Resuming the bootstrap script download after %d bytes", offset)
+
+      if expectedDigest:
+         digest = base64.b64encode(hasher.digest()).decode("ascii")
+         if digest != expectedDigest[1]:
+            os.remove(partPath)
+            err = "Bootstrap script {algorithm} digest mismatch, expected {expected}, " \
+                  "got {digest}. Aborting".format(algorithm=expectedDigest[0],
+                                                  expected=expectedDigest[1], digest=digest)
+            log(err, level=logging.ERROR)
+            raise Exception(err)
+         log("Bootstrap script %s digest verified", expectedDigest[0])
+      os.rename(partPath, BOOT_SCRIPT_PATH)
+      metrics.record("http", "bootstrapDownload", startTime, time.time() - startTime,
+                     bytes=offset, attempts=attempt)
+      log("Downloaded %d bytes of bootstrap script", offset)
 
    ##################################################################################
    # Step 3.2: Execute the downloaded bootstrap script
    ##################################################################################
    def executeBootstrap( self ):
+      if STREAM_BOOTSTRAP_OUTPUT:
+         self.runBootstrapScript()
+         return
+
       proc = None
       def handleSigterm(signum, frame):
          if proc is not None:
@@ -457,7 +2375,7 @@ class BootstrapManager(object):
       try:
          subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
       except subprocess.CalledProcessError as e:
-         log(e.output)
+         log(e.output, level=logging.ERROR)
          raise e
       log("Step 3.2.1 done, execution permissions for bootstrap script setup")
 
@@ -468,19 +2386,268 @@ class BootstrapManager(object):
          proc = subprocess.Popen([cmd], shell=True, stderr=subprocess.STDOUT, env=os.environ)
          proc.communicate()
          if proc.returncode:
-            log("Bootstrap script failed with return code {rc}".format(rc=proc.returncode))
+            log("Bootstrap script failed with return code %d", proc.returncode,
+                level=logging.ERROR)
             sys.exit(proc.returncode)
       except subprocess.CalledProcessError as e:
-         log(e.output)
+         log(e.output, level=logging.ERROR)
          raise e
       log("Step 3.2.2 done, executed the fetched bootstrap script")
 
+   def runBootstrapScript(self):
+      """
+      Runs the bootstrap script directly, streaming its output into the log with the time
+      elapsed since its start, which profiles the steps it goes through. Exits with the
+      return code of the script if it fails, or 124 if it times out.
+      """
+      os.chmod(BOOT_SCRIPT_PATH, os.stat(BOOT_SCRIPT_PATH).st_mode | 0o111)
+      log("Step 3.2.1 done, execution permissions for bootstrap script setup")
+
+      os.environ["CVPROXY"] = cvproxy
+      startTime = time.time()
+      tail = collections.deque(maxlen=BOOTSTRAP_OUTPUT_TAIL)
+      counts = {"lines": 0, "bytes": 0}
+      lock = threading.Lock()
+      stopped = []
+
+      def readOutput(stream, name):
+         for line in iter(lambda: stream.readline(BOOTSTRAP_OUTPUT_LINE_MAX), b""):
+            if not isinstance(line, str):
+               line = line.decode("utf-8", "replace")
+            line = line.rstrip("\r\n")
+            elapsed = time.time() - startTime
+            with lock:
+               counts["lines"] += 1
+               counts["bytes"] += len(line)
+               tail.append([round(elapsed, 3), name, line])
+            log("bootstrap [+%.3fs] %s: %s", elapsed, name, line)
+         stream.close()
+
+      def stop(reason):
+         if proc.poll() is not None:
+            return
+         stopped.append(reason)
+         log("Stopping the bootstrap script, %s", reason, level=logging.WARNING)
+         proc.terminate()
+         deadline = time.time() + BOOTSTRAP_TERMINATE_GRACE
+         while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+         if proc.poll() is None:
+            log("Bootstrap script still running, killing it", level=logging.WARNING)
+            proc.kill()
+
+      proc = None
+      pendingSigterm = []
+
+      def handleSigterm(signum, frame):
+         if proc is None:
+            # The script is being started, it is stopped as soon as it is
+            pendingSigterm.append(signum)
+            return
+         stop("received SIGTERM")
+         sys.exit(127 + signal.SIGTERM)
+
+      with metrics.timer("exec", "bootstrapScript") as attrs:
+         signal.signal(signal.SIGTERM, handleSigterm)
+         cmd = [BOOT_SCRIPT_PATH]
+         try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=os.environ, close_fds=True)
+         except OSError as e:
+            # No shebang line, run it the way a shell would
+            if e.errno != errno.ENOEXEC:
+               raise
+            cmd = ["/bin/sh", BOOT_SCRIPT_PATH]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=os.environ, close_fds=True)
+         if pendingSigterm:
+            handleSigterm(signal.SIGTERM, None)
+         readers = [BackgroundTask("bootstrapStdout", readOutput, proc.stdout, "stdout"),
+                    BackgroundTask("bootstrapStderr", readOutput, proc.stderr, "stderr")]
+         watchdog = None
+         if BOOTSTRAP_EXEC_TIMEOUT:
+            watchdog = threading.Timer(BOOTSTRAP_EXEC_TIMEOUT, stop, [
+               "timed out after {timeout}s".format(timeout=BOOTSTRAP_EXEC_TIMEOUT)])
+            watchdog.daemon = True
+            watchdog.start()
+         try:
+            proc.wait()
+         finally:
+            if watchdog:
+               watchdog.cancel()
+         # Processes left in the background by the script may hold its output open,
+         # what is already in the pipes is read within a second
+         for reader in readers:
+            reader.thread.join(1)
+
+         with lock:
+            attrs.update(counts)
+            attrs["tail"] = list(tail)
+         attrs["rc"] = proc.returncode
+         if stopped:
+            attrs["stopped"] = stopped[0]
+            log("Bootstrap script %s", stopped[0], level=logging.ERROR)
+            sys.exit(124)
+         if proc.returncode:
+            log("Bootstrap script failed with return code %d", proc.returncode,
+                level=logging.ERROR)
+            sys.exit(proc.returncode)
+      log("Step 3.2.2 done, executed the fetched bootstrap script")
+
+   def timeStage(self, stage, func, *args):
+      """Runs a single step and records how long it took"""
+      if stage in self.restoredStages:
+         log("Stage %s skipped, completed by an earlier attempt", stage)
+         metrics.record("stage", stage, time.time(), 0.0, restored=True)
+         return None
+      startTime = time.time()
+      try:
+         with metrics.timer("stage", stage):
+            return func(*args)
+      finally:
+         log("Stage %s took %.3fs", stage, time.time() - startTime)
+
+   def logStageTimings(self, startTime):
+      """
+      Logs the timings of the stages of the run started at `startTime`, those run before
+      it such as the pre-flight checks not being part of its wall time. With overlapping
+      stages, the sum of stage timings exceeds the wall time and the difference is the
+      time saved by pipelining.
+      """
+      wallTime = time.time() - startTime
+      stageTimings = metrics.stageTimings(since=startTime)
+      stageTime = sum(elapsed for _, elapsed in stageTimings)
+      log("Stage timings: %s", ", ".join(
+         "{stage}={elapsed:.3f}s".format(stage=stage, elapsed=elapsed)
+         for stage, elapsed in stageTimings))
+      log("Stages took %.3fs in %.3fs of wall time, saved %.3fs", stageTime, wallTime,
+          max(stageTime - wallTime, 0.0))
+
+   def steps(self):
+      """
+      The steps of the run up to the bootstrap script execution, in order, as (name,
+      function, restore function) triples. A restore function validates the checkpoint
+      of an earlier completion of the step and restores its outputs from it.
+      """
+      return [("redirector", self.checkWithRedirector, self.restoreAssignment),
+              ("enroll", self.enrollWithFallback, self.restoreEnrollment),
+              ("certsconfig", self.getCertificatePaths, self.restoreCertificatePaths),
+              ("fetch", self.getBootstrapScript, self.restoreBootstrapScript)]
+
+   def checkpoint(self, step, **outputs):
+      """
+      Records the outputs of a completed step. The checkpoints of the steps after it are
+      dropped, as they depend on it.
+      """
+      names = [name for name, _, _ in self.steps()]
+      self.state.checkpoint(step, outputs, dropping=names[names.index(step) + 1:])
+
+   def restoreAssignment(self, checkpoint):
+      if not self.redirectorURL:
+         return checkpoint.get("enrollAddr") == self.enrollAddr
+      if not (checkpoint.get("bootstrapURL") and checkpoint.get("enrollAddr")):
+         return False
+      self.assignmentHosts = checkpoint.get("assignmentHosts") or []
+      self.bootstrapURL = urlparse(checkpoint["bootstrapURL"])
+      self.enrollAddr = checkpoint["enrollAddr"]
+      log("Restored the redirector assignment, enrollAddr - %s", self.enrollAddr)
+      return True
+
+   def restoreEnrollment(self, checkpoint):
+      """The enrollment holds while the certificates it produced are usable"""
+      return checkpoint.get("enrollAddr") == self.enrollAddr and \
+         self.usableCertificates(self.state.checkpointOf("certsconfig"))
+
+   def restoreCertificatePaths(self, checkpoint):
+      if not self.usableCertificates(checkpoint):
+         return False
+      self.certificate = checkpoint["certificate"]
+      self.key = checkpoint["key"]
+      log("Reusing the client certs of an earlier attempt, certificate location - %s",
+          self.certificate)
+      return True
+
+   def usableCertificates(self, checkpoint):
+      """
+      Whether the client certificates exist and are far enough from their expiry, given
+      the certsconfig checkpoint
+      """
+      def exists(path):
+         return traced("fs", path, os.path.exists, (path,))
+      certificate = checkpoint.get("certificate")
+      key = checkpoint.get("key")
+      certExpiry = checkpoint.get("certExpiry")
+      if not (certificate and key and certExpiry and exists(certificate) and exists(key)):
+         return False
+      if certExpiry - time.time() < CERT_EXPIRY_MARGIN:
+         log("Client certificate %s is about to expire, enrolling again", certificate)
+         return False
+      return True
+
+   def restoreBootstrapScript(self, checkpoint):
+      """
+      The fetched bootstrap script is reused, for BOOTSTRAP_SCRIPT_MAX_AGE seconds, if it
+      is still in place and unchanged
+      """
+      if checkpoint.get("path") != BOOT_SCRIPT_PATH or \
+            time.time() - checkpoint.get("time", 0) > BOOTSTRAP_SCRIPT_MAX_AGE:
+         return False
+      sha256 = traced("fs", "sha256 " + BOOT_SCRIPT_PATH, fileSha256, (BOOT_SCRIPT_PATH,))
+      if sha256 is None or sha256 != checkpoint.get("sha256"):
+         log("Bootstrap script %s is missing or changed, fetching it again", BOOT_SCRIPT_PATH)
+         return False
+      log("Reusing the bootstrap script fetched by an earlier attempt")
+      return True
+
+   def restoreState(self):
+      """
+      Validates the checkpoints of the earlier attempts in step order, restoring the
+      outputs of the steps up to the first one without a valid checkpoint, which is where
+      the run resumes
+      """
+      if not self.state.loaded:
+         self.state.load()
+      for step, _, restore in self.steps():
+         checkpoint = self.state.checkpointOf(step)
+         if not checkpoint or not restore(checkpoint):
+            break
+         self.restoredStages.add(step)
+      if self.restoredStages:
+         log("Resuming after steps completed by an earlier attempt: %s",
+             ", ".join(step for step, _, _ in self.steps() if step in self.restoredStages))
+
    def run(self):
-      self.checkWithRedirector()
-      self.getClientCertificates()
-      self.getCertificatePaths()
-      self.getBootstrapScript()
-      self.executeBootstrap()
+      """
+      Runs the steps as a state machine, from the first one without a valid checkpoint
+      of an earlier attempt, then executes the bootstrap script.
+      When pipelining, the device inventory is collected in a worker thread while the
+      first steps are in progress, only the bootstrap script request waiting for it. The
+      redirector query only waits for the serial number, read from entmib first.
+      TerminAttr is probed meanwhile too, and the certsconfig lookup runs alongside the
+      enrollment.
+      """
+      startTime = time.time()
+      self.restoreState()
+      if PIPELINED_RUN:
+         self.entmibTask = BackgroundTask("entmib", self.readEntmib)
+         self.inventoryTask = BackgroundTask("deviceInventory", self.timeStage, "inventory",
+                                             self.collectInventory)
+         if "enroll" not in self.restoredStages:
+            self.terminAttrTask = BackgroundTask("terminAttrProbe", self.probeTerminAttr)
+      else:
+         self.timeStage("inventory", self.getInventory)
+      for step, func, _ in self.steps():
+         self.timeStage(step, func)
+      # No more requests to CVaaS, release the pooled connections
+      self.closeHttpSession()
+      # No upgrade was needed
+      discardImagePrestage()
+      # The bootstrap script does not return on failure, timings are logged beforehand
+      self.logStageTimings(startTime)
+      self.timeStage("exec", traced, "exec", "bootstrapScript", self.executeBootstrap)
+      # A later ZTP fetches the bootstrap script afresh
+      self.state.dropCheckpoints("fetch")
+      metrics.status = "success"
 
 
 class CloudBootstrapManager(BootstrapManager):
@@ -488,8 +2655,8 @@ class CloudBootstrapManager(BootstrapManager):
    Bootstrap Manager class for cloud deployments.
    """
 
-   def __init__(self):
-      super(CloudBootstrapManager, self).__init__()
+   def __init__(self, state=None):
+      super(CloudBootstrapManager, self).__init__(state)
       self.bootstrapURL = self.getBootstrapURL(cvAddr)
       self.redirectorURL = self.bootstrapURL._replace(path=REDIRECTOR_PATH)
       self.tokenType = SECURE_TOKEN
@@ -501,46 +2668,202 @@ class OnPremBootstrapManager(BootstrapManager):
    Bootstrap Manager class for on-prem deployments.
    """
 
-   def __init__(self):
-      super(OnPremBootstrapManager, self).__init__()
+   def __init__(self, state=None):
+      super(OnPremBootstrapManager, self).__init__(state)
       self.bootstrapURL = self.getBootstrapURL(cvAddr)
       self.redirectorURL = None
       self.tokenType = INGEST_TOKEN
       self.enrollAddr = self.bootstrapURL.netloc
 
 
-if __name__ == "__main__":
+def isCloudAddr(addr):
+   return addr.find("arista.io") != -1
+
+
+def findExecutable(binary):
+   """
+   Returns the path of the executable, looking bare names up in PATH as they are when
+   run, or None if there is none. shutil.which is not available in python2.
+   """
+   if os.path.dirname(binary):
+      return binary if os.access(binary, os.X_OK) else None
+   for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+      path = os.path.join(directory or os.curdir, binary)
+      if os.path.isfile(path) and os.access(path, os.X_OK):
+         return path
+   return None
+
+
+def checkBinaries():
+   """Raises if an executable the steps run is missing"""
+   binaries = [TERMINATTR_BINARY, CliManager.FAST_CLI_BINARY]
+   if ntpServer != "":
+      binaries.append(NTPSTAT_BINARY)
+   missing = [binary for binary in binaries if findExecutable(binary) is None]
+   if missing:
+      raise Exception("missing {binaries}".format(binaries=", ".join(missing)))
+
+
+def checkReachability(addr):
+   """Resolves the host of the URL and opens a TCP connection to it"""
+   with metrics.timer("preflight", "dns", host=addr.hostname) as attrs:
+      # getaddrinfo takes no timeout, it is bounded by running it in a thread
+      resolver = BackgroundTask("preflightDns", socket.getaddrinfo, addr.hostname,
+                                addr.port, 0, socket.SOCK_STREAM)
+      try:
+         addrInfo = resolver.join(PREFLIGHT_TIMEOUT)
+      except socket.gaierror as e:
+         raise Exception("could not resolve {host}: {err}".format(host=addr.hostname, err=e))
+      except Exception:
+         if resolver.thread.is_alive():
+            raise Exception("could not resolve {host} within {timeout}s".format(
+               host=addr.hostname, timeout=PREFLIGHT_TIMEOUT))
+         raise
+      attrs["addresses"] = len(addrInfo)
+   family, socktype, proto, _, sockaddr = addrInfo[0]
+   with metrics.timer("preflight", "connect", host=addr.netloc):
+      sock = socket.socket(family, socktype, proto)
+      sock.settimeout(PREFLIGHT_TIMEOUT)
+      try:
+         sock.connect(sockaddr)
+      except (socket.error, socket.timeout) as e:
+         raise Exception("could not connect to {addr}: {err}".format(addr=addr.netloc,
+                                                                     err=e))
+      finally:
+         sock.close()
+
+
+def preflightTarget():
+   """
+   URL of the first hop of the requests to CVaaS: cvproxy when set, cvAddr otherwise.
+   cvAddr is not resolved behind a proxy, which may be the only one able to.
+   """
+   if cvproxy != "":
+      addr = buildBootstrapURL(cvproxy, False)
+   else:
+      addr = buildBootstrapURL(cvAddr, isCloudAddr(cvAddr))
+   if addr.port is None:
+      port = 443 if addr.scheme == "https" else 80
+      addr = addr._replace(netloc="{host}:{port}".format(host=addr.netloc, port=port))
+   return addr
+
+
+def runPreflightChecks():
+   """
+   Checks, in parallel and before any slow step, what would otherwise only fail late:
+   the enrollment token, the resolution and reachability of cvAddr or cvproxy, and the
+   binaries the steps run. Returns the reasons of the failed checks. The validity period
+   of the token is only checked here when the clock is not about to be set by NTP.
+   """
+   def checkToken():
+      getTokenClaims()
+      checkTokenAudience()
+      if ntpServer == "":
+         checkTokenValidity()
+
+   def runCheck(name, func, *args):
+      with metrics.timer("preflight", name):
+         traced("preflight", name, func, args)
+
+   checks = [("token", checkToken), ("binaries", checkBinaries),
+             ("reachability", checkReachability, preflightTarget())]
+   startTime = time.time()
+   with metrics.timer("stage", "preflight"):
+      tasks = [(check[0], BackgroundTask("preflight", runCheck, *check)) for check in checks]
+      failures = []
+      for name, task in tasks:
+         try:
+            # The resolution and the connect are each bounded by PREFLIGHT_TIMEOUT, the
+            # extra second lets them fail with their own error
+            task.join(2 * PREFLIGHT_TIMEOUT + 1)
+         except Exception as e:
+            failures.append("{name}: {err}".format(name=name, err=e))
+   log("Stage %s took %.3fs", "preflight", time.time() - startTime)
+   return failures
+
+
+def parseArgs(argv):
+   import argparse
+   parser = argparse.ArgumentParser(description="CloudVision ZTP bootstrap script")
+   parser.add_argument("--replay", metavar="TRACE",
+                       help="replay a trace recorded with RECORD_TRACE instead of talking "
+                            "to the device and CVaaS")
+   parser.add_argument("--speed", type=float, default=1.0,
+                       help="replay the recorded interactions that many times faster, "
+                            "without waiting at all with 0")
+   return parser.parse_args(argv)
+
+
+def main(argv=()):
+   args = parseArgs(argv)
+   replayDir = startReplay(args.replay, args.speed) if args.replay else None
    setupLogger()
+   if replayDir:
+      log("Replaying %s, files are written to %s", args.replay, replayDir)
+   elif RECORD_TRACE:
+      startTrace()
 
    # Logging the current version of the custom bootstrap script
-   log("Current Custom Bootstrap Script Version: {version}".format(version=VERSION))
+   log("Current Custom Bootstrap Script Version: %s", VERSION)
 
    if cvAddr == "":
       err = "Error: address to CVP missing"
-      log(err)
+      log(err, level=logging.ERROR)
       sys.exit(err)
    if enrollmentToken == "":
       err = "Error: enrollment token missing"
-      log(err)
+      log(err, level=logging.ERROR)
       sys.exit(err)
 
+   # Fail fast, before NTP and the slow steps, on what would only fail later
+   if PREFLIGHT_CHECKS:
+      failures = runPreflightChecks()
+      if failures:
+         err = "Error: pre-flight checks failed: {failures}".format(
+            failures="; ".join(failures))
+         log(err, level=logging.ERROR)
+         sys.exit(err)
+      log("Pre-flight checks passed")
+
+   # The image is fetched while the other steps run, in case an upgrade is needed
+   startImagePrestage()
+
+   if not replayDir:
+      importEosModules()
+
+   # The checkpoints of earlier attempts, which the steps below resume from
+   state = BootstrapState(STATE_CACHE_PATH)
+   state.load()
+
    # Restart ntp process in case a ntpServer value is passed.
    if ntpServer != "":
-      configureAndRestartNTP(ntpServer)
-
-   # Check for enrollment token expiry
-   expiryEpoch, parseSuccess = getExpiryFromToken(enrollmentToken)
-   if parseSuccess and time.time() > expiryEpoch:
-      expiry = datetime.datetime.fromtimestamp(expiryEpoch)
-      err = "Error: enrollment token expired. expired on: {expiry} GMT".format(expiry=str(expiry))
-      log(err)
-      sys.exit(err)
+      synchronizeClock(state, ntpServer)
+
+   # Check for enrollment token expiry, now that the clock is synchronized. Replayed
+   # tokens are redacted.
+   if not replayDir:
+      try:
+         checkTokenValidity()
+      except TokenError as e:
+         err = "Error: {err}".format(err=e)
+         log(err, level=logging.ERROR)
+         sys.exit(err)
 
    # Check whether it is cloud or on prem
-   if cvAddr.find("arista.io") != -1:
-      bm = CloudBootstrapManager()
+   if isCloudAddr(cvAddr):
+      bm = CloudBootstrapManager(state)
    else:
-      bm = OnPremBootstrapManager()
+      bm = OnPremBootstrapManager(state)
 
    # Run the script
    bm.run()
+
+
+if __name__ == "__main__":
+   # The prestaged image not booted is removed, the metrics are exported, then the queued
+   # logs written out, however the script exits, including sys.exit and uncaught
+   # exceptions
+   atexit.register(stopLogger)
+   atexit.register(metrics.export)
+   atexit.register(discardImagePrestage)
+   main(sys.argv[1:])
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc.  All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+"""
+Caching enrollment proxy, to be run on the ZTP/DHCP host and used as `cvproxy` by the
+bootstrap script during fleet-scale ZTP bursts.
+
+- Redirector queries sent as plain HTTP (`cvAddr = "http://www.arista.io"`) are answered
+  from a per-tenant cache with a TTL, the device key echoed by the redirector being
+  rewritten for each device. Queries in flight are coalesced into a single upstream
+  request, made over HTTPS through a pooled session.
+- Other plain HTTP requests, such as EOS image downloads, are passed through over pooled
+  upstream connections.
+- CONNECT requests, used for the mutual TLS bootstrap fetches and by TerminAttr, are
+  tunnelled as is, to the HTTPS port.
+
+Requests are only forwarded to the CVaaS hosts and to the EOS image hosts given with
+--eos-url, so that the proxy cannot be used to reach anything else.
+- GET /stats returns the cache hit/miss statistics as JSON.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+BOOTSTRAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                              "BootstrapScriptWithToken", "bootstrap.py")
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = frozenset([
+   "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+   "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+])
+TUNNEL_BUFFER_SIZE = 64 * 1024
+# Requests are only forwarded to these domains and their subdomains, on the HTTP port for
+# plain HTTP requests and on these ports for CONNECT requests
+ALLOWED_DOMAINS = ["arista.io"]
+HTTP_PORT = 80
+TUNNEL_PORTS = [443]
+# Scopes of the cached redirector assignments: shared by the devices of a tenant, or not
+CACHE_SCOPES = ["tenant", "device"]
+
+logger = logging.getLogger("enrollmentProxy")
+
+
+def loadBootstrapModule():
+   """Loads the bootstrap script, for its URL handling logic and constants"""
+   spec = importlib.util.spec_from_file_location("bootstrap", BOOTSTRAP_FILE)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+bootstrap = loadBootstrapModule()
+
+
+class ProxyStats(object):
+   """Thread safe counters reported by GET /stats"""
+
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.counters = dict.fromkeys(["hits", "misses", "coalesced", "upstreamRequests",
+                                     "upstreamErrors", "passthrough", "tunnels"], 0)
+
+   def increment(self, counter):
+      with self.lock:
+         self.counters[counter] += 1
+
+   def snapshot(self):
+      with self.lock:
+         return dict(self.counters)
+
+
+class CachedResponse(object):
+   def __init__(self, status, headers, body):
+      self.status = status
+      self.headers = headers
+      self.body = body
+
+
+def assignmentFor(body, query):
+   """
+   Returns the cached redirector response `body` with the device key it echoes replaced by
+   that of the redirector `query`, the response being shared by the devices of a tenant
+   """
+   try:
+      key = json.loads(query)["key"]
+      assignment = json.loads(body)
+   except (ValueError, KeyError, TypeError):
+      return body
+   echoed = False
+   for entry in assignment if isinstance(assignment, list) else [assignment]:
+      value = entry.get("value") if isinstance(entry, dict) else None
+      if isinstance(value, dict) and "key" in value:
+         value["key"] = key
+         echoed = True
+   return json.dumps(assignment).encode() if echoed else body
+
+
+class AssignmentCache(object):
+   """
+   Caches the successful redirector responses per (redirector URL, tenant token) for `ttl`
+   seconds, or also per query when they are scoped to a device. Concurrent lookups of a key
+   being fetched wait for that fetch instead of starting their own.
+   """
+
+   def __init__(self, ttl, stats):
+      self.ttl = ttl
+      self.stats = stats
+      self.lock = threading.Lock()
+      self.entries = {}
+      self.inflight = {}
+
+   def get(self, key, fetch):
+      """Returns the cached response for `key`, calling `fetch()` on a miss"""
+      with self.lock:
+         entry = self.entries.get(key)
+         if entry is not None and entry[0] > time.time():
+            self.stats.increment("hits")
+            return entry[1]
+         event = self.inflight.get(key)
+         leader = event is None
+         if leader:
+            event = self.inflight[key] = threading.Event()
+
+      if not leader:
+         self.stats.increment("coalesced")
+         event.wait()
+         with self.lock:
+            entry = self.entries.get(key)
+         if entry is not None:
+            return entry[1]
+         # The leading fetch failed, its error is not shared, try on our own
+         return self.get(key, fetch)
+
+      self.stats.increment("misses")
+      try:
+         response = fetch()
+         if response.status == 200:
+            with self.lock:
+               self.entries[key] = (time.time() + self.ttl, response)
+         return response
+      finally:
+         with self.lock:
+            del self.inflight[key]
+         event.set()
+
+   def size(self):
+      with self.lock:
+         return len(self.entries)
+
+
+class EnrollmentProxyServer(ThreadingHTTPServer):
+   """Forward proxy caching redirector assignments"""
+   daemon_threads = True
+
+   def __init__(self, address, ttl=300, upstreamScheme="https", upstreamProxy="",
+                poolSize=16, timeout=30, allowedDomains=None, tunnelPorts=None, eosUrls=None,
+                cacheScope="tenant"):
+      ThreadingHTTPServer.__init__(self, address, EnrollmentProxyHandler)
+      self.allowedDomains = [domain.lower().strip(".")
+                             for domain in allowedDomains or ALLOWED_DOMAINS]
+      self.tunnelPorts = tunnelPorts or TUNNEL_PORTS
+      self.imageHosts = [urlsplit(url).netloc.lower() for url in eosUrls or []]
+      self.cacheScope = cacheScope
+      self.stats = ProxyStats()
+      self.cache = AssignmentCache(ttl, self.stats)
+      self.upstreamScheme = upstreamScheme
+      self.upstreamTimeout = timeout
+      self.session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+      self.session.mount("https://", adapter)
+      self.session.mount("http://", adapter)
+      if upstreamProxy:
+         self.session.proxies.update({"https": upstreamProxy, "http": upstreamProxy})
+
+   def redirectorURL(self, host):
+      """Upstream redirector URL for a front door host, as the bootstrap script builds it"""
+      url = bootstrap.buildBootstrapURL(host, True)._replace(path=bootstrap.REDIRECTOR_PATH)
+      return url._replace(scheme=self.upstreamScheme).geturl()
+
+   def allowsHost(self, host):
+      """Whether host is one of the allowed domains or of their subdomains"""
+      host = host.lower().rstrip(".")
+      return any(host == domain or host.endswith("." + domain)
+                 for domain in self.allowedDomains)
+
+   def allowsTunnel(self, host, port):
+      """Whether CONNECT requests to host:port may be tunnelled"""
+      return port in self.tunnelPorts and self.allowsHost(host)
+
+   def allowsURL(self, url):
+      """Whether plain HTTP requests to url may be forwarded"""
+      url = urlsplit(url)
+      if url.netloc.lower() in self.imageHosts:
+         return True
+      try:
+         port = url.port or HTTP_PORT
+      except ValueError:
+         return False
+      return url.scheme == "http" and port == HTTP_PORT and \
+         self.allowsHost(url.hostname or "")
+
+   def statistics(self):
+      stats = self.stats.snapshot()
+      lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+      stats["cacheEntries"] = self.cache.size()
+      stats["hitRatio"] = round(float(stats["hits"] + stats["coalesced"]) / lookups, 3) \
+         if lookups else 0.0
+      return stats
+
+
+class EnrollmentProxyHandler(BaseHTTPRequestHandler):
+   protocol_version = "HTTP/1.1"
+
+   def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      logger.debug("%s %s", self.address_string(), format % args)
+
+   def sendResponse(self, status, headers, body):
+      self.send_response(status)
+      for name, value in headers.items():
+         if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "content-length":
+            self.send_header(name, value)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def readBody(self):
+      return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+   def forwardedHeaders(self):
+      return dict((name, value) for name, value in self.headers.items()
+                  if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "host")
+
+   def do_CONNECT(self):  # pylint: disable=invalid-name
+      """Tunnels the connection to the requested host:port"""
+      host, _, port = self.path.rpartition(":")
+      if not port.isdigit() or not self.server.allowsTunnel(host, int(port)):
+         self.send_error(403, "Tunnelling to {target} is not allowed".format(target=self.path))
+         return
+      try:
+         upstream = socket.create_connection((host, int(port)), self.server.upstreamTimeout)
+      except (socket.error, ValueError) as e:
+         self.send_error(502, "Cannot connect to {target}: {err}".format(target=self.path,
+                                                                          err=e))
+         return
+      self.server.stats.increment("tunnels")
+      self.send_response(200, "Connection Established")
+      self.end_headers()
+      self.close_connection = True
+      sockets = [self.connection, upstream]
+      try:
+         while True:
+            readable, _, errored = select.select(sockets, [], sockets,
+                                                 self.server.upstreamTimeout)
+            if errored or not readable:
+               break
+            for sock in readable:
+               data = sock.recv(TUNNEL_BUFFER_SIZE)
+               if not data:
+                  return
+               (upstream if sock is self.connection else self.connection).sendall(data)
+      except socket.error:
+         pass
+      finally:
+         upstream.close()
+
+   def do_GET(self):  # pylint: disable=invalid-name
+      if self.path == "/stats":
+         body = json.dumps(self.server.statistics(), sort_keys=True).encode()
+         self.sendResponse(200, {"Content-Type": "application/json"}, body)
+         return
+      self.passThrough("GET")
+
+   def do_POST(self):  # pylint: disable=invalid-name
+      url = urlsplit(self.path)
+      if url.path.lstrip("/") == bootstrap.REDIRECTOR_PATH and url.netloc:
+         if not self.server.allowsHost(url.hostname or ""):
+            self.send_error(403, "Forwarding to {host} is not allowed".format(host=url.netloc))
+            return
+         self.redirect(url.netloc)
+      else:
+         self.passThrough("POST")
+
+   def do_HEAD(self):  # pylint: disable=invalid-name
+      self.passThrough("HEAD")
+
+   def do_PUT(self):  # pylint: disable=invalid-name
+      self.passThrough("PUT")
+
+   def redirect(self, host):
+      """Answers a redirector query from the cache"""
+      body = self.readBody()
+      token = self.headers.get("redirector_token", "")
+      upstreamURL = self.server.redirectorURL(host)
+      key = (upstreamURL, hashlib.sha256(token.encode()).hexdigest())
+      if self.server.cacheScope == "device":
+         # The query holds the serial number of the device
+         key += (hashlib.sha256(body).hexdigest(),)
+
+      def fetch():
+         self.server.stats.increment("upstreamRequests")
+         try:
+            response = self.server.session.post(upstreamURL, data=body,
+                                                headers=self.forwardedHeaders(),
+                                                timeout=self.server.upstreamTimeout)
+         except requests.exceptions.RequestException as e:
+            self.server.stats.increment("upstreamErrors")
+            logger.warning("Redirector request to %s failed: %s", upstreamURL, e)
+            return CachedResponse(502, {}, str(e).encode())
+         # The body has been decoded, so its encoding must not be advertised again
+         headers = dict((name, value) for name, value in response.headers.items()
+                        if name.lower() != "content-encoding")
+         return CachedResponse(response.status_code, headers, response.content)
+
+      response = self.server.cache.get(key, fetch)
+      responseBody = response.body
+      if response.status == 200:
+         responseBody = assignmentFor(responseBody, body)
+      self.sendResponse(response.status, response.headers, responseBody)
+
+   def passThrough(self, method):
+      """Forwards a plain HTTP request over the pooled upstream connections"""
+      if not urlsplit(self.path).netloc:
+         self.send_error(400, "Absolute URL expected")
+         return
+      if not self.server.allowsURL(self.path):
+         self.send_error(403, "Forwarding to {url} is not allowed".format(url=self.path))
+         return
+      self.server.stats.increment("passthrough")
+      body = self.readBody() if method in ("POST", "PUT") else None
+      try:
+         response = self.server.session.request(method, self.path, data=body,
+                                                headers=self.forwardedHeaders(), stream=True,
+                                                allow_redirects=False,
+                                                timeout=self.server.upstreamTimeout)
+      except requests.exceptions.RequestException as e:
+         self.server.stats.increment("upstreamErrors")
+         self.send_error(502, str(e))
+         return
+      with response:
+         self.send_response(response.status_code)
+         for name, value in response.headers.items():
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+               self.send_header(name, value)
+         if "Content-Length" not in response.headers:
+            # The end of the body is marked by closing the connection
+            self.close_connection = True
+         self.end_headers()
+         if method != "HEAD":
+            for chunk in response.raw.stream(TUNNEL_BUFFER_SIZE, decode_content=False):
+               self.wfile.write(chunk)
+
+
+def parseArgs(argv):
+   parser = argparse.ArgumentParser(description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--listen", default="127.0.0.1",
+                       help="address to listen on, that of the interface facing the devices")
+   parser.add_argument("--port", type=int, default=3128, help="port to listen on")
+   parser.add_argument("--ttl", type=float, default=300,
+                       help="seconds a redirector assignment is cached for")
+   parser.add_argument("--upstream-scheme", default="https",
+                       help="scheme used to reach the redirector upstream")
+   parser.add_argument("--upstream-proxy", default="",
+                       help="proxy to reach CVaaS through, for plain HTTP requests")
+   parser.add_argument("--pool-size", type=int, default=16,
+                       help="upstream connections kept alive per host")
+   parser.add_argument("--timeout", type=float, default=30,
+                       help="upstream connect and read timeout in seconds")
+   parser.add_argument("--cache-scope", choices=CACHE_SCOPES, default="tenant",
+                       help="whether a redirector assignment is shared by the devices of "
+                            "a tenant or cached per device")
+   parser.add_argument("--allow-domain", action="append", dest="allowed_domains",
+                       help="domain, along with its subdomains, requests may be forwarded "
+                            "to, can be repeated (default: {domains})".format(
+                               domains=", ".join(ALLOWED_DOMAINS)))
+   parser.add_argument("--tunnel-port", action="append", type=int, dest="tunnel_ports",
+                       help="port CONNECT requests may be tunnelled to, can be repeated "
+                            "(default: {ports})".format(
+                               ports=", ".join(str(port) for port in TUNNEL_PORTS)))
+   parser.add_argument("--eos-url", action="append", dest="eos_urls",
+                       help="eosUrl of the bootstrap script, plain HTTP requests to its host "
+                            "being forwarded, can be repeated")
+   parser.add_argument("--stats-interval", type=float, default=60,
+                       help="seconds between statistics log lines, 0 to disable")
+   return parser.parse_args(argv)
+
+
+def main(argv=None):
+   args = parseArgs(argv)
+   logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+   server = EnrollmentProxyServer((args.listen, args.port), ttl=args.ttl,
+                                  upstreamScheme=args.upstream_scheme,
+                                  upstreamProxy=args.upstream_proxy,
+                                  poolSize=args.pool_size, timeout=args.timeout,
+                                  allowedDomains=args.allowed_domains,
+                                  tunnelPorts=args.tunnel_ports, eosUrls=args.eos_urls,
+                                  cacheScope=args.cache_scope)
+   if args.stats_interval:
+      def logStats():
+         while True:
+            time.sleep(args.stats_interval)
+            logger.info("stats %s", json.dumps(server.statistics(), sort_keys=True))
+      statsThread = threading.Thread(target=logStats, name="stats")
+      statsThread.daemon = True
+      statsThread.start()
+   logger.info("Enrollment proxy listening on %s:%d", args.listen, args.port)
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+      logger.info("stats %s", json.dumps(server.statistics(), sort_keys=True))
+
+
+if __name__ == "__main__":
+   sys.exit(main())
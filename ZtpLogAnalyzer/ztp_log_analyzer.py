@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc.  All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+"""
+Reports the stage latencies and failures of a ZTP rollout from the messages of the
+bootstrap script, as collected from the devices: syslog files, plain or gzip compressed,
+with RFC 3164 or RFC 3339 timestamps, or the JSON lines logs of the script
+(/mnt/flash/ztp-bootstrap-log.jsonl), named after their device.
+
+   ztp_log_analyzer.py /var/log/remote/*.gz -j 8 --timelines attempts.jsonl
+
+Every file is read in a single streaming pass by one of the parallel workers, which
+folds the messages of the bootstrap script into the ZTP attempts of every device, the host
+of the syslog lines, as they are read. An attempt starts at the version banner every run
+starts with, and may span rotated files.
+The stage durations of an attempt are taken from its "ZTP metrics" summary or its
+"Stage ... took" messages when the script version logs them, and otherwise from the time
+between its "Step ... done" messages. The region of a device is the CloudVision cluster it
+enrolled with, its EOS version the one of its inventory.
+"""
+
+import argparse
+import calendar
+import collections
+import datetime
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Stages in the order they run, the others are reported after them
+STAGES = ["preflight", "ntp", "inventory", "redirector", "enroll", "certsconfig", "fetch",
+          "exec"]
+# Stage ending with each "Step ... done" message, timed from the previous one. Step 3.2.1
+# only sets the executable bit, and is counted in the execution.
+STEP_STAGES = {"0": "redirector", "1": "enroll", "2": "certsconfig", "3.1": "fetch",
+               "3.2.1": None, "3.2.2": "exec"}
+PERCENTILES = [50, 90, 99]
+UNKNOWN = "unknown"
+
+# Cheap test run on every line, before the messages of the script are told apart
+MARKERS = re.compile(r"Bootstrap Script Version|Step [\d.]+ done|Stage \w+ |NTP sync|"
+                     r"enrollAddr - |Device inventory|ZTP metrics|EOS version upgrade|"
+                     r"Error|[Ff]ail|Abort|Could not|timed out")
+# (kind, pattern) of the messages of the script, the first match wins
+MESSAGES = [
+   ("version", re.compile(r"Current Custom Bootstrap Script Version: (\S+)")),
+   ("metrics", re.compile(r"ZTP metrics: (\{.*\})")),
+   ("inventory", re.compile(r"Device inventory: (\{.*\})")),
+   ("step", re.compile(r"Step ([\d.]+) done")),
+   ("stage", re.compile(r"Stage (\w+) took ([\d.]+)s")),
+   ("restored", re.compile(r"Stage (\w+) skipped, completed by an earlier attempt")),
+   ("ntp", re.compile(r"NTP sync complete after ([\d.]+)s")),
+   ("enrollAddr", re.compile(r"enrollAddr - (\S+)")),
+   ("upgrade", re.compile(r"Attempting EOS version upgrade")),
+]
+FAILURE = re.compile(r"\b(?:Error|[Ff]ailed|Aborting|Could not|timed out)\b")
+# Failures the script recovers from
+RECOVERED = re.compile(r"retrying|falling back|[Ii]gnoring|installing it instead")
+
+# Optional priority, timestamp, host and message of a syslog line
+RFC3339_LINE = re.compile(r"(?:<\d+>)?(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:\.\d+)?)"
+                          r"(Z|[+-]\d\d:?\d\d)?\s+(\S+)\s+(.*)")
+RFC3164_LINE = re.compile(r"(?:<\d+>)?([A-Z][a-z]{2} +\d{1,2} \d\d:\d\d:\d\d)\s+(\S+)\s+(.*)")
+LOG_SUFFIXES = (".gz", ".jsonl", ".json", ".log")
+
+
+def openLog(path):
+   """Opens the log for reading as text, decompressing it if it is gzip compressed"""
+   with open(path, "rb") as f:
+      compressed = f.read(2) == b"\x1f\x8b"
+   if compressed:
+      return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+   return open(path, encoding="utf-8", errors="replace")
+
+
+def deviceOfFile(path):
+   """Name of the device a JSON lines log is for, its file name without the suffixes"""
+   name = os.path.basename(path)
+   while name.endswith(LOG_SUFFIXES):
+      name = os.path.splitext(name)[0]
+   return name
+
+
+def parseTimestamp(timestamp, zone, year):
+   """
+   Returns the epoch of a syslog timestamp, in UTC unless it has an offset. RFC 3164
+   timestamps have no year, it is given.
+   """
+   if zone is None and not timestamp[0].isdigit():
+      parsed = datetime.datetime.strptime("{year} {timestamp}".format(
+         year=year, timestamp=timestamp), "%Y %b %d %H:%M:%S")
+      return float(calendar.timegm(parsed.timetuple()))
+   if zone in (None, "Z"):
+      zone = "+00:00"
+   elif ":" not in zone:
+      zone = zone[:3] + ":" + zone[3:]
+   return datetime.datetime.fromisoformat(timestamp.replace(" ", "T") + zone).timestamp()
+
+
+def parseLine(line, defaultDevice, year):
+   """
+   Returns the (device, epoch, message, level) of a syslog or JSON lines log line, None
+   if it is neither. Only the JSON lines logs have a level.
+   """
+   if line.startswith("{"):
+      try:
+         record = json.loads(line)
+         return defaultDevice, float(record["time"]), record["message"], record.get("level")
+      except (ValueError, KeyError, TypeError):
+         return None
+   match = RFC3339_LINE.match(line)
+   if match:
+      timestamp, zone, host, message = match.groups()
+   else:
+      match = RFC3164_LINE.match(line)
+      if not match:
+         return None
+      (timestamp, host, message), zone = match.groups(), None
+   try:
+      return host, parseTimestamp(timestamp, zone, year), message, None
+   except ValueError:
+      return None
+
+
+def classify(message, level):
+   """Returns the (kind, value) of a message of the script, None for any other message"""
+   for kind, pattern in MESSAGES:
+      match = pattern.search(message)
+      if not match:
+         continue
+      if kind == "stage":
+         return kind, (match.group(1), float(match.group(2)))
+      if kind == "ntp":
+         return kind, float(match.group(1))
+      if kind == "upgrade":
+         return kind, None
+      if kind == "metrics":
+         try:
+            summary = json.loads(match.group(1))
+         except ValueError:
+            return None
+         return kind, {key: summary.get(key)
+                       for key in ("version", "status", "wallTime", "stages")}
+      if kind == "inventory":
+         try:
+            inventory = json.loads(match.group(1))
+         except ValueError:
+            return None
+         return kind, {key: inventory.get(key)
+                       for key in ("serialNum", "modelName", "softwareVersion")}
+      return kind, match.group(1)
+   if level is not None and level != "ERROR":
+      return None
+   if FAILURE.search(message) and not RECOVERED.search(message):
+      return "failure", message.strip()[:200]
+   return None
+
+
+def scanFile(path, year=None):
+   """
+   Reads the log in a streaming pass, adding the messages of the bootstrap script to the
+   attempt of their device as they are read. Returns the (device, epoch, line number,
+   attempt) of every attempt begun in the file, and of the continuations of the attempts
+   begun in an earlier one, made of the messages of a device before its first version
+   banner in the file.
+   """
+   year = year or time.gmtime().tm_year
+   defaultDevice = deviceOfFile(path)
+   attempts = []
+   current = {}
+   with openLog(path) as f:
+      for lineNo, line in enumerate(f):
+         if not MARKERS.search(line):
+            continue
+         parsed = parseLine(line.rstrip("\n"), defaultDevice, year)
+         if parsed is None:
+            continue
+         device, epoch, message, level = parsed
+         event = classify(message, level)
+         if event is None:
+            continue
+         kind, value = event
+         if kind == "version" or device not in current:
+            current[device] = Attempt(device, epoch, value if kind == "version" else None)
+            attempts.append((device, epoch, lineNo, current[device]))
+         if kind != "version":
+            current[device].add(epoch, kind, value)
+   return attempts
+
+
+def regionOf(enrollAddr):
+   """
+   The CloudVision cluster of an enrollment address, e.g. cv-prod-us-central1-b for
+   apiserver.cv-prod-us-central1-b.arista.io, or the host of an on-prem one
+   """
+   host = enrollAddr.split("://")[-1].split("/")[0].rsplit(":", 1)[0]
+   labels = host.split(".")
+   if host.endswith(".arista.io") and len(labels) > 3:
+      return ".".join(labels[1:-2])
+   return host
+
+
+def failureReason(message):
+   """The cause of a failure message, without the details that differ between devices"""
+   reason = message.split(", err:")[0]
+   if reason.startswith("Error: "):
+      reason = reason[len("Error: "):]
+   return reason.split(": ")[0].strip()
+
+
+class Attempt(object):
+   """
+   A run of the bootstrap script on a device, rebuilt from its messages. Without a
+   version, it is the continuation of an attempt begun in an earlier file.
+   """
+
+   def __init__(self, device, start, version):
+      self.device = device
+      self.start = start
+      self.end = start
+      self.version = version
+      self.continuation = version is None
+      self.region = UNKNOWN
+      self.eosVersion = UNKNOWN
+      self.serial = None
+      self.completed = False
+      self.summary = None
+      self.wallTime = None
+      self.failure = None
+      self.upgrade = False
+      # Durations logged by the script, and the (step, epoch) of the steps reached
+      self.stages = {}
+      self.restored = []
+      self.steps = []
+
+   def add(self, epoch, kind, value):
+      self.end = max(self.end, epoch)
+      if kind == "step":
+         self.steps.append((value, epoch))
+         if value == "3.2.2":
+            self.completed = True
+      elif kind == "stage":
+         self.stages[value[0]] = value[1]
+      elif kind == "restored":
+         self.restored.append(value)
+      elif kind == "ntp":
+         self.stages["ntp"] = value
+      elif kind == "enrollAddr":
+         self.region = regionOf(value)
+      elif kind == "inventory":
+         self.serial = value.get("serialNum")
+         self.eosVersion = value.get("softwareVersion") or UNKNOWN
+      elif kind == "upgrade":
+         # The device reboots into the new image, the failure leading there aside
+         self.upgrade = True
+         self.failure = None
+      elif kind == "failure":
+         self.failure = value
+      elif kind == "metrics":
+         self.version = value.get("version") or self.version
+         self.summary = value
+         self.wallTime = value.get("wallTime")
+         self.stages.update(value.get("stages") or {})
+
+   def merge(self, continuation):
+      """Adds the messages of the continuation of the attempt, read from a later file"""
+      self.end = max(self.end, continuation.end)
+      self.steps.extend(continuation.steps)
+      self.completed = self.completed or continuation.completed
+      self.stages.update(continuation.stages)
+      self.restored.extend(continuation.restored)
+      if continuation.region != UNKNOWN:
+         self.region = continuation.region
+      if continuation.serial is not None:
+         self.serial = continuation.serial
+      if continuation.eosVersion != UNKNOWN:
+         self.eosVersion = continuation.eosVersion
+      if continuation.upgrade:
+         self.upgrade = True
+         self.failure = continuation.failure
+      elif continuation.failure:
+         self.failure = continuation.failure
+      if continuation.summary is not None:
+         self.version = continuation.version or self.version
+         self.summary = continuation.summary
+         self.wallTime = continuation.wallTime
+
+   def outcome(self):
+      """success, failed, upgrade when it ended with an EOS upgrade, or incomplete"""
+      if self.summary is not None:
+         if self.summary.get("status"):
+            return self.summary["status"]
+      elif self.completed:
+         return "success"
+      if self.failure:
+         return "failed"
+      return "upgrade" if self.upgrade else "incomplete"
+
+   def reason(self):
+      if self.outcome() != "failed":
+         return None
+      return failureReason(self.failure) if self.failure else UNKNOWN
+
+   def durations(self):
+      """Duration of every stage the attempt went through, restored ones excluded"""
+      durations = {}
+      # Steps are timed from the previous one, stages logged by the script prevail
+      lastStep = self.start
+      for step, epoch in self.steps:
+         if STEP_STAGES.get(step):
+            durations[STEP_STAGES[step]] = epoch - lastStep
+         lastStep = epoch
+      durations.update(self.stages)
+      for stage in self.restored:
+         durations.pop(stage, None)
+      if self.outcome() == "success":
+         durations["total"] = self.wallTime if self.wallTime is not None else \
+            self.end - self.start
+      return durations
+
+   def timeline(self):
+      return {"device": self.device, "serial": self.serial, "version": self.version,
+              "start": self.start, "status": self.outcome(), "reason": self.reason(),
+              "region": self.region, "eosVersion": self.eosVersion,
+              "stages": {stage: round(duration, 3)
+                         for stage, duration in self.durations().items()},
+              "restored": self.restored,
+              "steps": [(step, round(epoch - self.start, 3)) for step, epoch in self.steps]}
+
+
+def percentile(values, fraction):
+   """Linearly interpolated percentile of the sorted values"""
+   position = (len(values) - 1) * fraction
+   lower = int(position)
+   upper = min(lower + 1, len(values) - 1)
+   return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class RolloutReport(object):
+   """Stage latencies and failures of the attempts of a rollout"""
+
+   def __init__(self, attempts):
+      self.attempts = attempts
+
+   def outcomes(self):
+      return dict(collections.Counter(attempt.outcome() for attempt in self.attempts))
+
+   def latencies(self):
+      """Count, percentiles and maximum of the duration of every stage"""
+      durations = collections.defaultdict(list)
+      for attempt in self.attempts:
+         for stage, duration in attempt.durations().items():
+            durations[stage].append(duration)
+      order = STAGES + sorted(set(durations) - set(STAGES) - {"total"}) + ["total"]
+      latencies = {}
+      for stage in order:
+         values = sorted(durations.get(stage, []))
+         if not values:
+            continue
+         latency = {"count": len(values), "max": round(values[-1], 3)}
+         for p in PERCENTILES:
+            latency["p{p}".format(p=p)] = round(percentile(values, p / 100.0), 3)
+         latencies[stage] = latency
+      return latencies
+
+   def breakdown(self, attribute):
+      """Attempts, failures and failure reasons for every value of the attribute"""
+      rows = {}
+      for attempt in self.attempts:
+         row = rows.setdefault(getattr(attempt, attribute),
+                               {"attempts": 0, "failed": 0, "reasons": collections.Counter()})
+         row["attempts"] += 1
+         if attempt.outcome() == "failed":
+            row["failed"] += 1
+            row["reasons"][attempt.reason()] += 1
+      for row in rows.values():
+         row["reasons"] = dict(row["reasons"].most_common())
+      return dict(sorted(rows.items()))
+
+   def reasons(self):
+      return dict(collections.Counter(attempt.reason() for attempt in self.attempts
+                                      if attempt.outcome() == "failed").most_common())
+
+   def asDict(self):
+      return {"devices": len({attempt.device for attempt in self.attempts}),
+              "attempts": len(self.attempts), "outcomes": self.outcomes(),
+              "latencies": self.latencies(), "reasons": self.reasons(),
+              "byRegion": self.breakdown("region"),
+              "byEosVersion": self.breakdown("eosVersion"),
+              "byScriptVersion": self.breakdown("version")}
+
+   def format(self):
+      report = self.asDict()
+      lines = ["{attempts} attempts of {devices} devices: {outcomes}".format(
+         attempts=report["attempts"], devices=report["devices"],
+         outcomes=", ".join("{count} {outcome}".format(count=count, outcome=outcome)
+                            for outcome, count in sorted(report["outcomes"].items())))]
+      lines += ["", "Stage latency (s)", "{:<14}{:>8}".format("stage", "count") +
+                "".join("{:>10}".format("p{p}".format(p=p)) for p in PERCENTILES) +
+                "{:>10}".format("max")]
+      for stage, latency in report["latencies"].items():
+         lines.append("{:<14}{:>8}".format(stage, latency["count"]) +
+                      "".join("{:>10.3f}".format(latency["p{p}".format(p=p)])
+                              for p in PERCENTILES) +
+                      "{:>10.3f}".format(latency["max"]))
+      for title, key in (("Region", "byRegion"), ("EOS version", "byEosVersion"),
+                         ("Script version", "byScriptVersion")):
+         lines += ["", "{:<28}{:>10}{:>8}{:>8}  {}".format(title, "attempts", "failed",
+                                                           "rate", "top failure")]
+         for value, row in report[key].items():
+            top = next(iter(row["reasons"]), "")
+            lines.append("{:<28}{:>10}{:>8}{:>7.1f}%  {}".format(
+               value, row["attempts"], row["failed"],
+               100.0 * row["failed"] / row["attempts"], top))
+      lines += ["", "Failure reasons"]
+      for reason, count in report["reasons"].items():
+         lines.append("{:>8}  {}".format(count, reason))
+      return "\n".join(lines) + "\n"
+
+
+def analyze(paths, workers=1, year=None):
+   """
+   Scans the logs, with a pool of processes when there is more than one worker, and
+   gathers the attempts of every device from all of them, an attempt possibly spanning
+   rotated files
+   """
+   paths = list(paths)
+   # The largest files are scanned first, so that no worker is left with one at the end
+   order = sorted(range(len(paths)), key=lambda i: os.path.getsize(paths[i]), reverse=True)
+   if workers <= 1 or len(paths) <= 1:
+      scanned = map(scanFile, [paths[i] for i in order], itertools.repeat(year))
+      return collectAttempts(zip(order, scanned))
+
+   context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+   with ProcessPoolExecutor(min(workers, len(paths)), mp_context=context) as executor:
+      scanned = executor.map(scanFile, [paths[i] for i in order], itertools.repeat(year))
+      return collectAttempts(zip(order, scanned))
+
+
+def collectAttempts(scanned):
+   """
+   Groups the attempts of the (file index, attempts) of the scanned files by device, in
+   time order, merging the continuations into the attempt they follow
+   """
+   devices = collections.defaultdict(list)
+   for fileIndex, fileAttempts in scanned:
+      for device, epoch, lineNo, attempt in fileAttempts:
+         devices[device].append((epoch, fileIndex, lineNo, attempt))
+   attempts = []
+   for device in sorted(devices):
+      previous = None
+      for _, _, _, attempt in sorted(devices.pop(device), key=lambda entry: entry[:3]):
+         if not attempt.continuation:
+            attempts.append(attempt)
+            previous = attempt
+         elif previous is not None:
+            # That of an attempt begun before the oldest log is dropped
+            previous.merge(attempt)
+   return RolloutReport(attempts)
+
+
+def parseArgs(argv):
+   parser = argparse.ArgumentParser(description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("logs", nargs="+", help="syslog or JSON lines logs, possibly gzipped")
+   parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                       help="number of processes scanning the logs")
+   parser.add_argument("--year", type=int,
+                       help="year of the RFC 3164 timestamps, the current one by default")
+   parser.add_argument("--json", action="store_true", help="print the report as JSON")
+   parser.add_argument("--timelines",
+                       help="file the stage timeline of every attempt is written to, "
+                            "as JSON lines")
+   return parser.parse_args(argv)
+
+
+def main(argv=None):
+   args = parseArgs(argv)
+   try:
+      report = analyze(args.logs, workers=args.workers, year=args.year)
+   except OSError as e:
+      sys.exit("Error: {err}".format(err=e))
+
+   if args.timelines:
+      with open(args.timelines, "w", encoding="utf-8") as f:
+         for attempt in report.attempts:
+            f.write(json.dumps(attempt.timeline(), sort_keys=True) + "\n")
+   if args.json:
+      print(json.dumps(report.asDict(), indent=2, sort_keys=True))
+   else:
+      sys.stdout.write(report.format())
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+import ast
+import json
+import os
+import tempfile
+import unittest
+
+from ztpsim import load_module
+
+GENERATOR_FILE = os.path.join("BootstrapGenerator", "bootstrap_generator.py")
+BOOTSTRAP_FILE = os.path.join("BootstrapScriptWithToken", "bootstrap.py")
+CSV_HEADER = "name,mac,cvAddr,enrollmentToken,cvproxy,eosUrl,ntpServer\n"
+
+bootstrap_generator = load_module("bootstrap_generator", GENERATOR_FILE)
+
+
+def user_input(script: str) -> dict[str, str]:
+    '''Returns the USER INPUT values assigned by a rendered script'''
+    values = {}
+    for node in ast.parse(script).body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name) and \
+                node.targets[0].id in bootstrap_generator.PARAMETERS:
+            values[node.targets[0].id] = ast.literal_eval(node.value)
+    return values
+
+
+class BootstrapGeneratorTest(unittest.TestCase):
+    '''Tests the bootstrap script generator'''
+
+    def setUp(self):
+        self.workdir = self.enterContext(tempfile.TemporaryDirectory(prefix="bootgen-"))
+        self.output_dir = os.path.join(self.workdir, "out")
+
+    def write_inventory(self, name: str, content: str) -> str:
+        path = os.path.join(self.workdir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def generate(self, path: str, workers: int = 1):
+        return bootstrap_generator.generate(bootstrap_generator.readInventory(path),
+                                            self.output_dir, workers=workers)
+
+    def read_script(self, name: str) -> str:
+        with open(os.path.join(self.output_dir, name), encoding="utf-8") as f:
+            return f.read()
+
+    def test_render_empty(self):
+        '''Tests that rendering empty values gives back the bootstrap script'''
+        with open(BOOTSTRAP_FILE, encoding="utf-8") as f:
+            self.assertEqual(bootstrap_generator.BootstrapGenerator().render({}), f.read())
+
+    def test_render_quoting(self):
+        '''Tests that the values are rendered as Python string literals'''
+        params = {"cvAddr": "www.arista.io", "enrollmentToken": 'a"b\\c',
+                  "ntpServer": "ntp.example.com"}
+        script = bootstrap_generator.BootstrapGenerator().render(params)
+        self.assertEqual(user_input(script), {"cvAddr": "www.arista.io",
+                                              "enrollmentToken": 'a"b\\c', "cvproxy": "",
+                                              "eosUrl": "", "ntpServer": "ntp.example.com"})
+        with self.assertRaises(bootstrap_generator.InventoryError):
+            bootstrap_generator.quote("tökén")
+
+    def test_render_control_characters(self):
+        '''Tests that control characters are escaped the same way for python2 and python3'''
+        token = "a\x01b\tc\x7f"
+        self.assertEqual(bootstrap_generator.quote(token), '"a\\x01b\\x09c\\x7f"')
+        script = bootstrap_generator.BootstrapGenerator().render({"enrollmentToken": token})
+        self.assertEqual(user_input(script)["enrollmentToken"], token)
+
+    def test_content_addressed_output(self):
+        '''Tests that identical scripts are shared and only changed ones are written'''
+        rows = [f"leaf{i},,www.arista.io,token{i % 2},,,\n" for i in range(4)]
+        path = self.write_inventory("inventory.csv", CSV_HEADER + "".join(rows))
+        result = self.generate(path)
+        self.assertEqual((result.devices, len(result.scripts), result.written), (4, 2, 2))
+        for entry, script in result.mapping:
+            self.assertEqual(user_input(self.read_script(script))["enrollmentToken"],
+                             entry["enrollmentToken"])
+
+        self.assertEqual(self.generate(path).written, 0)
+        rows[0] = "leaf0,,www.arista.io,token0,http://proxy:3128,,\n"
+        path = self.write_inventory("inventory.csv", CSV_HEADER + "".join(rows))
+        result = self.generate(path)
+        self.assertEqual((len(result.scripts), result.written), (3, 1))
+        self.assertEqual(bootstrap_generator.pruneScripts(self.output_dir, result.scripts), 0)
+        result = self.generate(self.write_inventory("inventory.csv", CSV_HEADER + rows[0]))
+        self.assertEqual(bootstrap_generator.pruneScripts(self.output_dir, result.scripts), 2)
+        self.assertEqual(os.listdir(self.output_dir), list(result.scripts))
+
+    def test_parallel_workers(self):
+        '''Tests that parallel workers produce the same scripts and mapping as one'''
+        rows = [f"leaf{i},,www.arista.io,token{i % 300},,,\n" for i in range(1000)]
+        path = self.write_inventory("inventory.csv", CSV_HEADER + "".join(rows))
+        result = self.generate(path, workers=3)
+        self.assertEqual((result.devices, result.written), (1000, 300))
+        self.assertEqual([entry["name"] for entry, _ in result.mapping],
+                         [f"leaf{i}" for i in range(1000)])
+        serial = self.generate(path)
+        self.assertEqual(serial.written, 0)
+        self.assertEqual(serial.mapping, result.mapping)
+
+    def test_yaml_inventory(self):
+        '''Tests a YAML inventory with defaults'''
+        path = self.write_inventory("inventory.yaml", """
+defaults:
+  cvAddr: www.arista.io
+  ntpServer: ntp.example.com
+devices:
+  - name: leaf1
+    mac: "00:1c:73:00:00:01"
+    enrollmentToken: token1
+  - name: leaf2
+    enrollmentToken: token2
+    ntpServer:
+""")
+        result = self.generate(path)
+        values = [user_input(self.read_script(script)) for _, script in result.mapping]
+        self.assertEqual([(v["enrollmentToken"], v["ntpServer"]) for v in values],
+                         [("token1", "ntp.example.com"), ("token2", "")])
+
+    def test_invalid_inventory(self):
+        '''Tests that entries missing required fields or with duplicate names are rejected'''
+        for rows in ["leaf1,,www.arista.io,,,,\n",
+                     "leaf1,,www.arista.io,t,,,\nleaf1,,www.arista.io,t,,,\n"]:
+            path = self.write_inventory("inventory.csv", CSV_HEADER + rows)
+            with self.assertRaises(bootstrap_generator.InventoryError):
+                self.generate(path)
+
+    def test_bootfile_mapping(self):
+        '''Tests the DHCP bootfile mapping formats'''
+        mapping = [({"name": "leaf1", "mac": "00:1c:73:00:00:01"}, "bootstrap-1.py"),
+                   ({"name": "leaf2"}, "bootstrap-2.py")]
+        base_url = "http://ztp.example.com/"
+        self.assertEqual(json.loads(bootstrap_generator.bootfileMapping(mapping, base_url)), {
+            "leaf1": {"mac": "00:1c:73:00:00:01",
+                      "bootfile": "http://ztp.example.com/bootstrap-1.py"},
+            "leaf2": {"mac": "", "bootfile": "http://ztp.example.com/bootstrap-2.py"},
+        })
+        self.assertEqual(bootstrap_generator.bootfileMapping(mapping, base_url, "isc"),
+                         'host leaf1 { hardware ethernet 00:1c:73:00:00:01; '
+                         'option bootfile-name "http://ztp.example.com/bootstrap-1.py"; }\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,18 +7,21 @@
 import unittest
 
 import jinja2
+from ztpsim import load_module
 
 BOOTSTRAP_DIR = "BootstrapScriptWithToken"
 BOOTSTRAP_TEMPLATE_FILE = "bootstrap_template.j2"
 BOOTSTRAP_FILE = "bootstrap.py"
+GENERATOR_FILE = "BootstrapGenerator/bootstrap_generator.py"
+
+bootstrap_generator = load_module("bootstrap_generator", GENERATOR_FILE)
 
 
 def generate_bootstrap_file(params: dict[str, str]) -> str:
     '''Generates the bootstrap file by rendering the given parameters'''
-    template_loader = jinja2.FileSystemLoader(searchpath=BOOTSTRAP_DIR)
-    template_env = jinja2.Environment(loader=template_loader, keep_trailing_newline=True)
-    template = template_env.get_template(BOOTSTRAP_TEMPLATE_FILE)
-    return template.render(params)
+    template = bootstrap_generator.loadTemplate(f"{BOOTSTRAP_DIR}/{BOOTSTRAP_TEMPLATE_FILE}")
+    values = {name: value.encode("utf-8") for name, value in params.items()}
+    return template.render(values).decode("utf-8")
 
 
 class BootstrapTest(unittest.TestCase):
@@ -41,6 +44,28 @@ class BootstrapTest(unittest.TestCase):
             file_content = f.read()
             self.assertEqual(gen_file_content, file_content)
 
+    def test_compiled_template_matches_jinja(self):
+        '''Tests that the compiled template renders the template the way Jinja does'''
+        params = {
+            "enrollmentToken": '"a\\"b\\\\c"',
+            "eosUrl": '"http://10.0.0.1/EOS.swi"',
+            "cvproxy": '"{{ cvAddr }}"',
+            "cvAddr": '"www.arista.io"',
+            "ntpServer": '""',
+        }
+        loader = jinja2.FileSystemLoader(searchpath=BOOTSTRAP_DIR)
+        env = jinja2.Environment(loader=loader, keep_trailing_newline=True)
+        expected = env.get_template(BOOTSTRAP_TEMPLATE_FILE).render(params)
+        self.assertEqual(generate_bootstrap_file(params), expected)
+
+        source = "a {{ x }} {% raw %}{{ y }}{% endraw %} {{x}}\n"
+        template = bootstrap_generator.CompiledTemplate(source)
+        self.assertEqual(template.render({"x": b"1"}), jinja2.Template(
+            source, keep_trailing_newline=True).render(x="1").encode())
+        for source in ["{% if x %}{% endif %}", "{# comment #}", "{{ x | upper }}"]:
+            with self.assertRaises(bootstrap_generator.TemplateError):
+                bootstrap_generator.CompiledTemplate(source)
+
 
 if __name__ == "__main__":
     unittest.main()
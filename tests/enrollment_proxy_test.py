@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+import json
+import os
+import socket
+import threading
+import time
+import unittest
+import urllib.request
+
+from ztpsim import CvaasStub, StubBehaviour, load_module
+
+PROXY_FILE = os.path.join("EnrollmentProxy", "enrollment_proxy.py")
+REDIRECTOR_URL = ("http://www.arista.io"
+                  "/api/v3/services/arista.redirector.v1.AssignmentService/GetOne")
+
+enrollment_proxy = load_module("enrollment_proxy", PROXY_FILE)
+
+
+class EnrollmentProxyTest(unittest.TestCase):
+    '''Tests the caching enrollment proxy, with the CVaaS stub as its upstream'''
+
+    def start_proxy(self, behaviour: StubBehaviour | None = None, ttl: float = 60,
+                    **params):
+        '''Starts the stub and a proxy using it to reach CVaaS'''
+        stub = CvaasStub(behaviour)
+        stub.__enter__()
+        self.addCleanup(stub.__exit__)
+        proxy = enrollment_proxy.EnrollmentProxyServer(("127.0.0.1", 0), ttl=ttl,
+                                                       upstreamScheme="http",
+                                                       upstreamProxy=stub.url, timeout=5,
+                                                       allowedDomains=["arista.io",
+                                                                       "127.0.0.1"],
+                                                       tunnelPorts=[stub.server_port],
+                                                       **params)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        self.addCleanup(proxy.server_close)
+        self.addCleanup(proxy.shutdown)
+        self.proxy_url = f"http://127.0.0.1:{proxy.server_port}"
+        return stub, proxy
+
+    def query(self, token: str = "token", serial: str = "SN1",
+              url: str = REDIRECTOR_URL) -> tuple[int, bytes]:
+        '''Sends a redirector query through the proxy, the way the bootstrap script does'''
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({"http": self.proxy_url}))
+        body = json.dumps({"key": {"system_id": serial}}).encode()
+        request = urllib.request.Request(url, data=body, method="POST",
+                                         headers={"redirector_token": token})
+        try:
+            with opener.open(request, timeout=5) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(self.proxy_url + "/stats", timeout=5) as response:
+            return json.load(response)
+
+    def test_cache_per_tenant(self):
+        '''Tests that assignments are cached per token'''
+        stub, _ = self.start_proxy()
+        first = self.query()
+        self.assertEqual(first[0], 200)
+        self.assertEqual(self.query(), first)
+        self.assertEqual(self.query("other")[0], 200)
+        self.assertEqual(stub.stats, {"redirector": 2})
+        stats = self.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(stats["cacheEntries"], 2)
+
+    def test_cache_shared_by_devices(self):
+        '''Tests that the devices of a tenant share an assignment, their key echoed in it'''
+        stub, _ = self.start_proxy()
+        for serial in ["SN1", "SN2", "SN3"]:
+            status, body = self.query(serial=serial)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)[0]["value"]["key"], {"system_id": serial})
+        self.assertEqual(stub.stats, {"redirector": 1})
+        self.assertEqual(stub.redirector_payload, {"key": {"system_id": "SN1"}})
+
+    def test_cache_per_device(self):
+        '''Tests that the assignments are cached apart when scoped to a device'''
+        stub, _ = self.start_proxy(cacheScope="device")
+        self.assertEqual(self.query(serial="SN1")[0], 200)
+        self.assertEqual(self.query(serial="SN2")[0], 200)
+        self.assertEqual(self.query(serial="SN1")[0], 200)
+        self.assertEqual(stub.stats, {"redirector": 2})
+        self.assertEqual(stub.redirector_payload, {"key": {"system_id": "SN2"}})
+
+    def test_concurrent_queries_coalesced(self):
+        '''Tests that identical queries in flight result in a single upstream request'''
+        stub, _ = self.start_proxy(StubBehaviour(redirector_latency=0.3))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.query()))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([status for status, _ in results], [200] * 8)
+        self.assertEqual(stub.stats, {"redirector": 1})
+        stats = self.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"] + stats["coalesced"], 7)
+
+    def test_ttl_expiry(self):
+        '''Tests that assignments are fetched again once expired'''
+        stub, _ = self.start_proxy(ttl=0.1)
+        self.query()
+        time.sleep(0.2)
+        self.query()
+        self.assertEqual(stub.stats, {"redirector": 2})
+
+    def test_errors_not_cached(self):
+        '''Tests that failed queries are passed on and not cached'''
+        stub, _ = self.start_proxy(StubBehaviour(redirector_failures=1))
+        self.assertEqual(self.query()[0], 503)
+        self.assertEqual(self.query()[0], 200)
+        self.assertEqual(self.query()[0], 200)
+        self.assertEqual(stub.stats, {"redirector": 2})
+
+    def test_passthrough(self):
+        '''Tests that other plain HTTP requests are forwarded upstream'''
+        behaviour = StubBehaviour(script=b"#!/bin/sh\necho ok\n")
+        stub, _ = self.start_proxy(behaviour)
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({"http": self.proxy_url}))
+        with opener.open("http://www.cv-sim.arista.io/ztp/bootstrap", timeout=5) as response:
+            self.assertEqual(response.read(), behaviour.script)
+        self.assertEqual(stub.stats, {"bootstrap": 1})
+        self.assertEqual(self.stats()["passthrough"], 1)
+
+    def test_forwarding_restricted(self):
+        '''Tests that plain HTTP requests are only forwarded to CVaaS and the image hosts'''
+        stub, _ = self.start_proxy(StubBehaviour(image=b"image"),
+                                   eosUrls=["http://images.example.com/EOS.swi"])
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({"http": self.proxy_url}))
+        for url in ["http://example.com/ztp/bootstrap", "http://www.arista.io:8080/",
+                    "http://images.example.com:8080/images/EOS.swi",
+                    "http://www.arista.io.example.com/"]:
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                opener.open(url, timeout=5)
+            self.assertEqual(error.exception.code, 403)
+        foreign_redirector = REDIRECTOR_URL.replace("www.arista.io", "example.com")
+        self.assertEqual(self.query(url=foreign_redirector)[0], 403)
+        with opener.open("http://images.example.com/images/EOS.swi", timeout=5) as response:
+            self.assertEqual(response.read(), b"image")
+        self.assertEqual(stub.stats, {"image": 1})
+        self.assertEqual(self.stats()["passthrough"], 1)
+
+    def connect(self, proxy, target: str) -> tuple[socket.socket, bytes]:
+        '''Sends a CONNECT request to the proxy, returning the socket and the reply'''
+        sock = socket.create_connection(("127.0.0.1", proxy.server_port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+        return sock, sock.recv(4096)
+
+    def test_connect_tunnel(self):
+        '''Tests that CONNECT requests are tunnelled to the target'''
+        stub, proxy = self.start_proxy()
+        sock, reply = self.connect(proxy, f"127.0.0.1:{stub.server_port}")
+        self.assertTrue(reply.startswith(b"HTTP/1.1 200"), reply)
+        sock.sendall(b"GET /ztp/bootstrap HTTP/1.1\r\nHost: cv\r\nConnection: close\r\n\r\n")
+        response = b""
+        while chunk := sock.recv(4096):
+            response += chunk
+        self.assertTrue(response.startswith(b"HTTP/1.1 200"), response)
+        self.assertTrue(response.endswith(StubBehaviour().script))
+        self.assertEqual(self.stats()["tunnels"], 1)
+
+    def test_connect_restricted(self):
+        '''Tests that CONNECT requests are only tunnelled to the CVaaS hosts'''
+        stub, proxy = self.start_proxy()
+        for target in [f"localhost:{stub.server_port}", "127.0.0.1:22", "127.0.0.1"]:
+            _, reply = self.connect(proxy, target)
+            self.assertTrue(reply.startswith(b"HTTP/1.1 403"), reply)
+        self.assertEqual(self.stats()["tunnels"], 0)
+
+        server = enrollment_proxy.EnrollmentProxyServer(("127.0.0.1", 0))
+        server.server_close()
+        self.assertTrue(server.allowsTunnel("apiserver.cv-prod-euwest-2.arista.io", 443))
+        self.assertTrue(server.allowsTunnel("arista.io", 443))
+        self.assertFalse(server.allowsTunnel("www.arista.io", 22))
+        self.assertFalse(server.allowsTunnel("notarista.io", 443))
+        self.assertFalse(server.allowsTunnel("arista.io.example.com", 443))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,738 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+import gzip
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from ztpsim import (SimConfig, StubBehaviour, load_bootstrap_module, make_token,
+                    replay_simulation, run_simulation)
+from ztpsim.harness import BIN_DIR
+
+STEPS = ["redirector", "enroll", "certsconfig", "fetch", "exec"]
+# Keeps the backoff between retries short
+FAST_RETRIES = {"RETRY_BASE_DELAY": 0.01, "RETRY_MAX_DELAY": 0.05}
+PRESTAGE = {"PRESTAGE_EOS_IMAGE": True}
+
+
+class SimulationTest(unittest.TestCase):
+    '''Runs the bootstrap script end to end against the ZTP simulation'''
+
+    def assertSucceeded(self, result):  # pylint: disable=invalid-name
+        '''Asserts that the run succeeded and went through all the steps'''
+        self.assertEqual(result.status, "success", result.error + "\n" + result.output)
+        for step in STEPS:
+            self.assertIn(step, result.stages)
+
+    def test_cloud_run(self):
+        '''Tests a cloud deployment, going through the redirector and cvproxy'''
+        result = run_simulation(SimConfig(deployment="cloud"))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats, {"redirector": 1, "bootstrap": 1})
+        self.assertEqual(result.redirector_payload, {"key": {"system_id": "SIM0000000001"}})
+        self.assertEqual(result.bootstrap_headers["X-Arista-Serial"], "SIM0000000001")
+        self.assertEqual(result.bootstrap_headers["X-Arista-SoftwareVersion"], "4.32.1F")
+        self.assertEqual(result.bootstrap_headers["X-Arista-Architecture"], "x86_64")
+        self.assertEqual(result.bootstrap_headers["X-Arista-SecureZtp"], "True")
+
+    def test_onprem_run(self):
+        '''Tests an on-prem deployment, which skips the redirector'''
+        result = run_simulation(SimConfig(deployment="onprem"))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats, {"bootstrap": 1})
+
+    def test_sequential_run(self):
+        '''Tests the run with pipelining disabled'''
+        result = run_simulation(SimConfig(overrides={"PIPELINED_RUN": False}))
+        self.assertSucceeded(result)
+        stages = [event for event in result.metrics["events"] if event["kind"] == "stage"]
+        self.assertEqual([stage["name"] for stage in stages[:2]], ["preflight", "inventory"])
+        for previous, stage in zip(stages, stages[1:]):
+            # Rounded to the millisecond
+            self.assertLessEqual(previous["start"] + previous["duration"], stage["start"] + 0.002)
+
+    def test_sequential_run_timings(self):
+        '''Tests that the pre-flight checks, run beforehand, are not counted as saved time'''
+        result = run_simulation(SimConfig(overrides={"PIPELINED_RUN": False,
+                                                     "checkBinaries": lambda: time.sleep(0.5)}))
+        self.assertSucceeded(result)
+        self.assertGreaterEqual(result.stages["preflight"], 0.5)
+        timings, = [record["message"] for record in result.log_records
+                    if record["message"].startswith("Stages took")]
+        self.assertTrue(timings.endswith("saved 0.000s"), timings)
+
+    def test_environment_proxy_ignored(self):
+        '''Tests that cvproxy prevails over the proxies of the environment'''
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            unused = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        with mock.patch.dict(os.environ, {"HTTP_PROXY": unused, "HTTPS_PROXY": unused}):
+            result = run_simulation(SimConfig())
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats, {"redirector": 1, "bootstrap": 1})
+
+    def test_ntp_sync(self):
+        '''Tests that NTP is polled until the clock synchronises'''
+        result = run_simulation(SimConfig(ntp_server="ntp.sim", ntp_sync_after=0.5))
+        self.assertSucceeded(result)
+        ntp = [event for event in result.metrics["events"] if event["kind"] == "ntp"]
+        self.assertEqual(len(ntp), 1)
+        self.assertGreater(ntp[0]["polls"], 1)
+
+    def test_cli_session_mode(self):
+        '''Tests that the FastCli commands of the whole run go through a single session'''
+        result = run_simulation(SimConfig(ntp_server="ntp.sim",
+                                          overrides={"CLI_SESSION_MODE": True}))
+        self.assertSucceeded(result)
+        fast_cli = [event for event in result.metrics["events"] if event["kind"] == "fastCli"]
+        self.assertEqual(len(fast_cli), 2)
+        self.assertTrue(all(event.get("session") for event in fast_cli))
+        # A single session, entering privileged mode once
+        self.assertEqual(result.cli_commands.count("enable"), 1)
+
+    def test_cli_session_command_outputs(self):
+        '''Tests that the output of every command of a batch is told apart in a session'''
+        module = load_bootstrap_module()
+        module.CLI_SESSION_MODE = True
+        module.CliManager.FAST_CLI_BINARY = os.path.join(BIN_DIR, "FastCli")
+        self.enterContext(mock.patch.dict(os.environ, {"ZTPSIM_FASTCLI_FAIL": "bad"}))
+        cli = module.CliManager()
+        self.addCleanup(cli.closeSession)
+        self.assertEqual(cli.runCommands(["bash echo one", "configure", "bash echo two"]),
+                         (0, "one\ntwo"))
+        session = cli.session
+        self.assertEqual(cli.runCommands(["bash echo three"]), (0, "three"))
+        self.assertIs(cli.session, session)
+
+        # The session is restarted after a failed command
+        self.assertEqual(cli.runCommands(["bash echo four", "bad command", "bash echo five"]),
+                         (1, "[bad command] % Invalid input"))
+        self.assertIsNone(cli.session)
+        self.assertEqual(cli.runCommands(["bash echo six"]), (0, "six"))
+        self.assertIsNot(cli.session, session)
+
+    def test_cli_session_failed_command(self):
+        '''Tests that a batch stops at the command failing in the middle of it'''
+        result = run_simulation(SimConfig(ntp_server="ntp.sim", fastcli_fail="ntp server",
+                                          overrides={"CLI_SESSION_MODE": True}))
+        self.assertEqual(result.status, "failed")
+        self.assertIn("Could not restart NTP server, err: [ntp server ntp.sim prefer iburst] "
+                      "% Invalid input", result.error)
+        # The command after the failed one is not run
+        self.assertEqual(result.cli_commands[-1], "ntp server ntp.sim prefer iburst")
+
+    def test_resumed_download(self):
+        '''Tests that a bootstrap download cut halfway through is resumed'''
+        script = b"#!/bin/sh\n" + b"#" * 200000 + b"\nexit 0\n"
+        result = run_simulation(SimConfig(stub=StubBehaviour(bootstrap_drops=1,
+                                                             script=script)))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats["bootstrap"], 2)
+
+    def test_download_resumed_if_unchanged(self):
+        '''Tests that a script regenerated between attempts is not stitched together'''
+        padding = b"#" * 200000 + b"\n"
+        stub = StubBehaviour(script=b"#!/bin/sh\nexit 3\n" + padding, digest=False,
+                             updated_script=b"#!/bin/sh\nexit 0\n" + padding,
+                             bootstrap_drops=1, bootstrap_cuts=[0.9])
+        result = run_simulation(SimConfig(stub=stub, overrides=FAST_RETRIES))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats["bootstrap"], 2)
+        self.assertIn("If-Range", result.bootstrap_headers)
+        self.assertIn("Server ignored the range request or the script changed, restarting "
+                      "the download", result.output)
+
+    def test_download_restarted_without_validator(self):
+        '''Tests that a download is restarted when it cannot be checked to be unchanged'''
+        script = b"#!/bin/sh\n" + b"#" * 200000 + b"\nexit 0\n"
+        stub = StubBehaviour(script=script, bootstrap_drops=1, etag=False)
+        result = run_simulation(SimConfig(stub=stub, overrides=FAST_RETRIES))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats["bootstrap"], 2)
+        self.assertNotIn("Range", result.bootstrap_headers)
+
+    def test_download_restarted_without_range(self):
+        '''Tests that a download restarted by a server ignoring ranges is retried in full'''
+        script = b"#!/bin/sh\n" + b"#" * 200000 + b"\nexit 0\n"
+        stub = StubBehaviour(script=script, bootstrap_drops=2, bootstrap_cuts=[0.5, 0.0],
+                             bootstrap_ignored_ranges=1)
+        result = run_simulation(SimConfig(stub=stub, overrides=FAST_RETRIES))
+        self.assertSucceeded(result)
+        self.assertEqual(result.server_stats["bootstrap"], 3)
+        self.assertNotIn("Range", result.bootstrap_headers)
+
+    def test_redirector_unavailable(self):
+        '''Tests that the run fails when the redirector keeps failing'''
+        result = run_simulation(SimConfig(stub=StubBehaviour(redirector_failures=100),
+                                          overrides=FAST_RETRIES))
+        self.assertEqual(result.status, "failed")
+        self.assertIn("No assignment found", result.error)
+        self.assertEqual(result.server_stats["redirector"], 4)
+
+    def test_transient_failures(self):
+        '''Tests that transient redirector and bootstrap endpoint failures are retried'''
+        stub = StubBehaviour(redirector_failures=2, bootstrap_failures=1)
+        result = run_simulation(SimConfig(stub=stub, overrides=FAST_RETRIES))
+        self.assertSucceeded(result)
+        retries = [event["name"] for event in result.metrics["events"]
+                   if event["kind"] == "retry"]
+        self.assertEqual(retries, ["redirector", "redirector", "fetch"])
+
+    def test_redirector_not_waiting_for_inventory(self):
+        '''Tests that the redirector is queried before the slow TPM status has been read'''
+        result = run_simulation(SimConfig(tpm_delay=0.5))
+        self.assertSucceeded(result)
+        self.assertEqual(result.redirector_payload, {"key": {"system_id": "SIM0000000001"}})
+        inventory = next(event for event in result.metrics["events"]
+                         if event["kind"] == "stage" and event["name"] == "inventory")
+        query = next(event for event in result.metrics["events"]
+                     if event["kind"] == "http" and event["name"].startswith("POST"))
+        self.assertLess(query["start"] + query["duration"],
+                        inventory["start"] + inventory["duration"])
+        self.assertEqual(result.bootstrap_headers["X-Arista-TpmApi"], "2.0")
+
+    def test_parallel_redirector_probe(self):
+        '''Tests that the first assignment received is used when the front doors are probed'''
+        stub = StubBehaviour(redirector_down_hosts=["www.arista.io"])
+        result = run_simulation(SimConfig(stub=stub, overrides={
+            "PARALLEL_REDIRECTOR_PROBE": True,
+            "REDIRECTOR_FRONT_DOORS": ["http://www.cv-sim-eu.arista.io"],
+            "RETRY_BASE_DELAY": 10, "RETRY_MAX_DELAY": 10}))
+        self.assertSucceeded(result)
+        messages = [record["message"] for record in result.log_records]
+        self.assertIn("Using the assignment from redirector www.cv-sim-eu.arista.io", messages)
+        # The query to the failing redirector is cancelled instead of being retried
+        self.assertFalse([record for record in result.log_records
+                          if record["level"] == "ERROR"])
+        self.assertEqual(result.server_stats["redirector"], 1)
+
+    def test_http_session_shared(self):
+        '''Tests that concurrent requests, as sent by the probes, create a single session'''
+        module = load_bootstrap_module()
+        module.cvAddr = "cvp.example.com"
+        manager = module.OnPremBootstrapManager()
+        module.importRequests()
+        session = module.requests.Session
+
+        def slow_session():
+            time.sleep(0.05)
+            return session()
+
+        sessions = []
+        with mock.patch.object(module.requests, "Session", side_effect=slow_session) as new:
+            threads = [threading.Thread(target=lambda: sessions.append(manager.getHttpSession()))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        manager.closeHttpSession()
+        self.assertEqual(new.call_count, 1)
+        self.assertEqual(len(set(map(id, sessions))), 1)
+
+    def test_retries_cancelled(self):
+        '''Tests that no attempt is made once the retries are cancelled'''
+        module = load_bootstrap_module()
+        module.RETRY_BASE_DELAY = module.RETRY_MAX_DELAY = 60
+        cancelled = threading.Event()
+        calls = []
+        def request():
+            calls.append(time.time())
+            raise ConnectionRefusedError("refused")
+        policy = module.RetryPolicy("redirector", isRetryable=lambda error: True,
+                                    cancelled=cancelled)
+        # Cancelled while waiting for the second attempt
+        threading.Timer(0.05, cancelled.set).start()
+        startTime = time.time()
+        with self.assertRaises(ConnectionRefusedError):
+            policy.run(request)
+        self.assertEqual(len(calls), 1)
+        self.assertLess(time.time() - startTime, 5)
+
+    def test_enrollment_fallback(self):
+        '''Tests that the next assigned host is enrolled with when the first one fails'''
+        stub = StubBehaviour(hosts=["http://www.cv-sim.arista.io",
+                                    "http://www.cv-sim-backup.arista.io"])
+        result = run_simulation(SimConfig(stub=stub, terminattr_fail="enrollonly@cv-sim.arista",
+                                          overrides=FAST_RETRIES))
+        self.assertSucceeded(result)
+        self.assertEqual(len(self.terminattr_events(result, "enrollonly")), 2)
+        messages = [record["message"] for record in result.log_records]
+        self.assertIn("enrollAddr - apiserver.cv-sim-backup.arista.io:443", messages)
+
+    def test_failed_enrollment(self):
+        '''Tests that an enrollment timing out is retried before giving up'''
+        result = run_simulation(SimConfig(terminattr_fail="enrollonly:124",
+                                          overrides=FAST_RETRIES))
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(len(self.terminattr_events(result, "enrollonly")), 4)
+
+    def test_rejected_enrollment(self):
+        '''Tests that an enrollment failing for good is not retried'''
+        result = run_simulation(SimConfig(terminattr_fail="enrollonly",
+                                          overrides=FAST_RETRIES))
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(len(self.terminattr_events(result, "enrollonly")), 1)
+
+    def test_transient_terminattr_errors(self):
+        '''Tests which TerminAttr failures are retried'''
+        module = load_bootstrap_module()
+        def error(returncode, output):
+            return subprocess.CalledProcessError(returncode, ["TerminAttr"], output)
+        self.assertTrue(module.isRetryableError(error(124, "")))
+        self.assertTrue(module.isRetryableError(
+            error(1, "rpc error: code = Unavailable desc = connection refused")))
+        self.assertFalse(module.isRetryableError(
+            error(1, "rpc error: code = Unauthenticated desc = invalid token")))
+        self.assertFalse(module.isRetryableError(error(2, None)))
+
+    def test_failing_bootstrap_script(self):
+        '''Tests that the return code of the bootstrap script is propagated'''
+        result = run_simulation(SimConfig(stub=StubBehaviour(script=b"#!/bin/sh\nexit 3\n")))
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(result.error, "3")
+
+    def assertPreflightFailed(self, result, reason):  # pylint: disable=invalid-name
+        '''Asserts that the run stopped at the pre-flight checks for the given reason'''
+        self.assertEqual(result.status, "failed")
+        self.assertIn("pre-flight checks failed", result.error)
+        self.assertIn(reason, result.error)
+        self.assertEqual(result.server_stats, {})
+        self.assertNotIn("redirector", result.stages)
+
+    def test_preflight_expired_token(self):
+        '''Tests that an expired token is rejected before anything else'''
+        result = run_simulation(SimConfig(token=make_token(lifetime=-60)))
+        self.assertPreflightFailed(result, "token: enrollment token expired")
+        self.assertLess(result.stages["preflight"], 1)
+
+    def test_preflight_token_not_valid_yet(self):
+        '''Tests that a token only valid in the future is rejected'''
+        result = run_simulation(SimConfig(token=make_token(nbf=int(time.time()) + 3600)))
+        self.assertPreflightFailed(result, "token: enrollment token not valid before")
+
+    def test_preflight_token_audience(self):
+        '''Tests that a token for another host than cvAddr, as by IP address, is let through'''
+        result = run_simulation(SimConfig(deployment="onprem",
+                                          token=make_token(aud="cvp.example.com")))
+        self.assertSucceeded(result)
+        self.assertIn("The enrollment token is for cvp.example.com, not for cvAddr",
+                      result.output)
+
+    def test_preflight_dns_timeout(self):
+        '''Tests that a hanging resolution fails the reachability check on its own'''
+        config = SimConfig(overrides={"PREFLIGHT_TIMEOUT": 0.2})
+        with mock.patch("socket.getaddrinfo", side_effect=lambda *args: time.sleep(1)):
+            result = run_simulation(config)
+        self.assertPreflightFailed(result, "reachability: could not resolve 127.0.0.1 within "
+                                           "0.2s")
+
+    def test_preflight_unreachable_proxy(self):
+        '''Tests that a proxy nothing listens on is reported'''
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        result = run_simulation(SimConfig(overrides={"cvproxy": f"http://127.0.0.1:{port}"}))
+        self.assertPreflightFailed(result,
+                                   f"reachability: could not connect to 127.0.0.1:{port}")
+
+    def test_preflight_missing_binary(self):
+        '''Tests that a missing TerminAttr is reported'''
+        result = run_simulation(SimConfig(
+            overrides={"TERMINATTR_BINARY": "/nonexistent/TerminAttr"}))
+        self.assertPreflightFailed(result, "binaries: missing /nonexistent/TerminAttr")
+
+    def test_preflight_ntpstat_in_path(self):
+        '''Tests that the default ntpstat binary, a bare name, is looked up in PATH'''
+        config = SimConfig(ntp_server="ntp.sim", overrides={"NTPSTAT_BINARY": "ntpstat"})
+        with mock.patch.dict(os.environ,
+                             {"PATH": self.enterContext(tempfile.TemporaryDirectory())}):
+            self.assertPreflightFailed(run_simulation(config), "binaries: missing ntpstat")
+        path = BIN_DIR + os.pathsep + os.environ.get("PATH", "")
+        with mock.patch.dict(os.environ, {"PATH": path}):
+            result = run_simulation(config)
+        self.assertSucceeded(result)
+
+    def test_preflight_token_not_jwt(self):
+        '''Tests that a token which is not a JWT is passed on as is'''
+        result = run_simulation(SimConfig(deployment="onprem", token="ingest-token"))
+        self.assertSucceeded(result)
+        self.assertIn("Could not parse the enrollment token, err: the enrollment token has 1 "
+                      "parts", result.output)
+
+    def terminattr_events(self, result, name):
+        '''Returns the metrics events of the TerminAttr invocations of the given mode'''
+        return [event for event in result.metrics["events"]
+                if event["kind"] == "terminAttr" and event["name"] == name]
+
+    def test_terminattr_certsconfig_alongside_enrollment(self):
+        '''Tests that the certsconfig lookup does not wait for the enrollment'''
+        result = run_simulation(SimConfig(terminattr_delay=0.3))
+        self.assertSucceeded(result)
+        enroll, = self.terminattr_events(result, "enrollonly")
+        certsconfig, = self.terminattr_events(result, "certsconfig")
+        self.assertLess(certsconfig["start"], enroll["start"] + enroll["duration"])
+        self.assertEqual(len(self.terminattr_events(result, "version")), 1)
+
+    def test_terminattr_without_cvproxy(self):
+        '''Tests that a TerminAttr lacking -cvproxy is not used to enroll'''
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy"))
+        self.assertEqual(result.status, "failed")
+        self.assertIn("TerminAttr 1.29.0 does not support -cvproxy", result.error)
+        self.assertEqual(self.terminattr_events(result, "enrollonly"), [])
+
+    def test_terminattr_version_only(self):
+        '''Tests that the supported flags are deduced from the version without usage'''
+        result = run_simulation(SimConfig(terminattr_version="1.18.2",
+                                          terminattr_fail="help:124"))
+        self.assertEqual(result.status, "failed")
+        self.assertIn("TerminAttr 1.18.2 does not support -cvproxy", result.error)
+
+    def test_terminattr_unknown_capabilities(self):
+        '''Tests that an enrollment timeout through cvproxy is not retried when unprobed'''
+        result = run_simulation(SimConfig(terminattr_fail="version:124,help:124,enrollonly:124"))
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(len(self.terminattr_events(result, "enrollonly")), 1)
+
+    def test_terminattr_probe_cached(self):
+        '''Tests that TerminAttr is probed once across the attempts of a device'''
+        config = SimConfig(token=make_token(), terminattr_fail="enrollonly",
+                           overrides=FAST_RETRIES)
+        config.persist_dir = self.enterContext(
+            tempfile.TemporaryDirectory(prefix="ztpsim-persist-"))
+        self.assertEqual(run_simulation(config).status, "failed")
+        config.terminattr_fail = ""
+        result = run_simulation(config)
+        self.assertSucceeded(result)
+        self.assertEqual(self.terminattr_events(result, "version"), [])
+        self.assertEqual(self.terminattr_events(result, "help"), [])
+
+    def run_twice(self, first: SimConfig, second: SimConfig, between=None):
+        '''
+        Runs two ZTP attempts of the same device, the bootstrap script of the first one
+        failing on its first execution only. `between` is called with the persist directory
+        before the second attempt.
+        '''
+        persist_dir = self.enterContext(tempfile.TemporaryDirectory(prefix="ztpsim-persist-"))
+        first.persist_dir = second.persist_dir = persist_dir
+        marker = os.path.join(persist_dir, "executed")
+        first.stub = StubBehaviour(
+            script=f"#!/bin/sh\n[ -f {marker} ] && exit 0\ntouch {marker}\nexit 3\n".encode())
+        self.assertEqual(run_simulation(first).status, "failed")
+        if between:
+            between(persist_dir)
+        return run_simulation(second)
+
+    def restored_stages(self, result):
+        '''Returns the stages skipped thanks to an earlier attempt'''
+        return [event["name"] for event in result.metrics["events"]
+                if event["kind"] == "stage" and event.get("restored")]
+
+    def test_state_reused(self):
+        '''Tests that a later attempt resumes at the execution of the fetched script'''
+        token = make_token()
+        result = self.run_twice(SimConfig(token=token), SimConfig(token=token))
+        self.assertSucceeded(result)
+        self.assertEqual(self.restored_stages(result),
+                         ["redirector", "enroll", "certsconfig", "fetch"])
+        self.assertEqual(result.server_stats, {})
+        self.assertFalse([event for event in result.metrics["events"]
+                          if event["kind"] == "terminAttr"])
+
+    def test_modified_script_fetched_again(self):
+        '''Tests that a bootstrap script changed since it was fetched is not executed'''
+        token = make_token()
+
+        def corrupt(persist_dir):
+            with open(os.path.join(persist_dir, "bootstrap-script"), "ab") as f:
+                f.write(b"exit 4\n")
+
+        result = self.run_twice(SimConfig(token=token), SimConfig(token=token),
+                                between=corrupt)
+        self.assertSucceeded(result)
+        self.assertEqual(self.restored_stages(result), ["redirector", "enroll", "certsconfig"])
+        self.assertEqual(result.server_stats, {"bootstrap": 1})
+
+    def test_ntp_not_reconfigured(self):
+        '''Tests that NTP configured by an earlier attempt and synchronized is kept'''
+        token = make_token()
+        result = self.run_twice(SimConfig(token=token, ntp_server="ntp.sim"),
+                                SimConfig(token=token, ntp_server="ntp.sim"))
+        self.assertSucceeded(result)
+        self.assertFalse([command for command in result.cli_commands
+                          if "ntp" in command])
+
+    def test_state_discarded_on_token_change(self):
+        '''Tests that the state of an attempt with another token is not used'''
+        result = self.run_twice(SimConfig(token=make_token()),
+                                SimConfig(token=make_token(lifetime=7200)))
+        self.assertSucceeded(result)
+        self.assertEqual(self.restored_stages(result), [])
+        self.assertEqual(result.server_stats, {"redirector": 1, "bootstrap": 1})
+
+    def test_expiring_certificate_not_reused(self):
+        '''Tests that the enrollment is done again when the certificate is about to expire'''
+        token = make_token()
+        result = self.run_twice(SimConfig(token=token, cert_validity=60),
+                                SimConfig(token=token))
+        self.assertSucceeded(result)
+        self.assertEqual(self.restored_stages(result), ["redirector"])
+
+    def exec_event(self, result):
+        '''Returns the metrics event of the bootstrap script execution'''
+        return next(event for event in result.metrics["events"] if event["kind"] == "exec")
+
+    def test_bootstrap_output_streamed(self):
+        '''Tests that the output of the bootstrap script is logged and kept in the metrics'''
+        script = b"#!/bin/sh\necho installing\necho warning >&2\necho done\n"
+        result = run_simulation(SimConfig(stub=StubBehaviour(script=script)))
+        self.assertSucceeded(result)
+        self.assertRegex(result.output, r"bootstrap \[\+\d+\.\d{3}s\] stdout: installing")
+        self.assertIn("stderr: warning", result.output)
+        event = self.exec_event(result)
+        self.assertEqual((event["rc"], event["lines"]), (0, 3))
+        self.assertEqual(sorted(line[1:] for line in event["tail"]),
+                         [["stderr", "warning"], ["stdout", "done"], ["stdout", "installing"]])
+
+    def test_interpreter_switch_arguments(self):
+        '''Tests that switching to python3 after a failed import keeps the arguments'''
+        module = load_bootstrap_module()
+        argv = ["bootstrap", "--replay", "trace.jsonl", "--speed", "0"]
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(sys, "version_info", (2, 7, 18)), \
+                mock.patch.object(module.os.path, "exists", return_value=True), \
+                mock.patch.object(module.os, "execl") as execl:
+            module.handleImportError(ImportError("No module named requests"))
+        execl.assert_called_once_with("/usr/bin/python3", "python3", mock.ANY, *argv[1:])
+
+    def test_metrics_export(self):
+        '''Tests that the events, output tails included, are left out of the metrics logged'''
+        module = load_bootstrap_module()
+        module.METRICS_FILE_PATH = os.path.join(
+            self.enterContext(tempfile.TemporaryDirectory()), "metrics.json")
+        module.metrics.record("stage", "exec", time.time(), 1.5)
+        module.metrics.record("exec", "bootstrap", time.time(), 1.5, rc=3,
+                              tail=[[0.1, "stdout", "installing"]], error="failed")
+        with mock.patch.object(module, "log") as log:
+            module.metrics.export()
+        message = log.call_args.args[0] % log.call_args.args[1:]
+        logged = json.loads(message[len("ZTP metrics: "):])
+        self.assertEqual((logged["stages"], logged["counts"], logged["errors"]),
+                         ({"exec": 1.5}, {"exec": 1}, 1))
+        self.assertNotIn("installing", message)
+        with open(module.METRICS_FILE_PATH, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["events"][1]["tail"], [[0.1, "stdout", "installing"]])
+
+    def test_bootstrap_without_shebang(self):
+        '''Tests that a bootstrap script without shebang line is run by the shell'''
+        result = run_simulation(SimConfig(stub=StubBehaviour(script=b"echo ok\n")))
+        self.assertSucceeded(result)
+        self.assertIn("stdout: ok", result.output)
+
+    def test_bootstrap_timeout(self):
+        '''Tests that a bootstrap script running for too long is terminated'''
+        script = b"#!/bin/sh\necho started\nexec sleep 30\n"
+        result = run_simulation(SimConfig(stub=StubBehaviour(script=script),
+                                          overrides={"BOOTSTRAP_EXEC_TIMEOUT": 0.5}))
+        self.assertEqual((result.status, result.error), ("failed", "124"))
+        self.assertLess(result.wall_time, 10)
+        self.assertEqual(self.exec_event(result)["stopped"], "timed out after 0.5s")
+
+    def test_bootstrap_sigterm(self):
+        '''Tests that the bootstrap script is terminated along with the ZTP process'''
+        script = b"#!/bin/sh\nkill -TERM $PPID\nexec sleep 30\n"
+        result = run_simulation(SimConfig(stub=StubBehaviour(script=script)))
+        self.assertEqual((result.status, result.error), ("failed", "142"))
+        self.assertLess(result.wall_time, 10)
+        self.assertIn("Stopping the bootstrap script, received SIGTERM", result.output)
+
+    def prestage_event(self, result):
+        '''Returns the metrics event of the EOS image prestaging'''
+        return next(event for event in result.metrics["events"] if event["kind"] == "prestage")
+
+    def test_prestaged_image_upgrade(self):
+        '''Tests that the upgrade boots the image prestaged over parallel range requests'''
+        image = os.urandom(256 * 1024 + 3)
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy",
+                                          stub=StubBehaviour(image=image), overrides=PRESTAGE))
+        self.assertSucceeded(result)
+        self.assertEqual(result.cli_commands, ["enable", "configure",
+                                               "boot system flash:/EOS.swi", "end",
+                                               "enable", "reload all now"])
+        messages = [record["message"] for record in result.log_records]
+        self.assertNotIn("Step 1 done, exchanged enrollment token for client certificates",
+                         messages)
+        event = self.prestage_event(result)
+        self.assertEqual((event["bytes"], event["connections"]), (len(image), 4))
+        # The range support probe, then one request per connection
+        self.assertEqual(result.server_stats["image"], 5)
+
+    def test_prestaged_image_without_ranges(self):
+        '''Tests prestaging from a server ignoring range requests'''
+        image = os.urandom(1024)
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy",
+                                          stub=StubBehaviour(image=image, image_ranges=False),
+                                          overrides=PRESTAGE))
+        self.assertSucceeded(result)
+        self.assertIn("boot system flash:/EOS.swi", result.cli_commands)
+        self.assertEqual(self.prestage_event(result)["connections"], 1)
+
+    def test_image_already_on_flash(self):
+        '''Tests that the image is not downloaded when flash:/EOS.swi already matches'''
+        image = os.urandom(1024)
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy", flash_image=image,
+                                          stub=StubBehaviour(image=image), overrides=PRESTAGE))
+        self.assertSucceeded(result)
+        self.assertIn("boot system flash:/EOS.swi", result.cli_commands)
+        self.assertTrue(self.prestage_event(result)["skipped"])
+        self.assertNotIn("image", result.server_stats)
+
+    def test_prestaged_image_reused(self):
+        '''Tests that an image prestaged by an interrupted run is booted without a download'''
+        image = os.urandom(1024)
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "EOS.swi.prestaged")
+        with open(path, "wb") as f:
+            f.write(image)
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy",
+                                          stub=StubBehaviour(image=image),
+                                          overrides=dict(PRESTAGE, PRESTAGED_IMAGE_PATH=path)))
+        self.assertSucceeded(result)
+        self.assertIn("boot system flash:/EOS.swi", result.cli_commands)
+        self.assertTrue(self.prestage_event(result)["skipped"])
+        self.assertNotIn("image", result.server_stats)
+        self.assertFalse(os.path.exists(path))
+
+    def test_prestaged_image_not_needed(self):
+        '''Tests that no upgrade happens when the enrollment succeeds'''
+        result = run_simulation(SimConfig(stub=StubBehaviour(image=os.urandom(1024)),
+                                          overrides=PRESTAGE))
+        self.assertSucceeded(result)
+        self.assertEqual(result.cli_commands, [])
+
+    def test_prestaged_image_removed_on_failure(self):
+        '''Tests that the image prestaged is removed when the run fails without upgrading'''
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "EOS.swi.prestaged")
+        result = run_simulation(SimConfig(terminattr_fail="enrollonly",
+                                          stub=StubBehaviour(image=os.urandom(256 * 1024)),
+                                          overrides=dict(PRESTAGE, PRESTAGED_IMAGE_PATH=path)))
+        self.assertEqual(result.status, "failed")
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_prestage_segments_cancelled(self):
+        '''Tests that the image segments still downloading are stopped when one fails'''
+        module = load_bootstrap_module()
+        module.PRESTAGE_CONNECTIONS = 2
+        module.RETRY_BASE_DELAY = module.RETRY_MAX_DELAY = 0.01
+        # Not started, only its download is run
+        prestage = module.ImagePrestage.__new__(module.ImagePrestage)
+        prestage.url, prestage.cancelled = "http://images.sim/EOS.swi", threading.Event()
+        size = 2 * 1024 * 1024
+
+        def read(count):
+            time.sleep(0.01)
+            return b"\0" * min(count, 1024)
+
+        def open_range(url, headers):
+            response = mock.Mock()
+            response.getcode.return_value = 206
+            response.info.return_value = {"Content-Range": f"bytes 0-0/{size}"}
+            response.read.side_effect = read
+            if not headers["Range"].startswith("bytes=0-"):
+                raise IOError("connection reset")
+            return response
+
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "EOS.swi")
+        start_time = time.time()
+        with mock.patch.object(prestage, "open", side_effect=open_range):
+            with self.assertRaisesRegex(IOError, "connection reset"):
+                prestage.download(path)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name == "imagePrestageRange"])
+
+    def test_prestage_disabled(self):
+        '''Tests that the image is only downloaded once an upgrade is needed by default'''
+        image = os.urandom(1024)
+        result = run_simulation(SimConfig(stub=StubBehaviour(image=image)))
+        self.assertSucceeded(result)
+        self.assertNotIn("image", result.server_stats)
+        result = run_simulation(SimConfig(terminattr_unsupported="cvproxy",
+                                          stub=StubBehaviour(image=image)))
+        self.assertSucceeded(result)
+        self.assertRegex(result.cli_commands[1],
+                         r"^install source http://\S+/EOS.swi destination flash:/EOS.swi$")
+        self.assertNotIn("prestage", [event["kind"] for event in result.metrics["events"]])
+
+    def test_logs(self):
+        '''Tests the JSON lines log file and its severity levels'''
+        result = run_simulation(SimConfig(
+            overrides=FAST_RETRIES, stub=StubBehaviour(redirector_failures=1)))
+        self.assertSucceeded(result)
+        levels = {record["message"]: record["level"] for record in result.log_records}
+        self.assertEqual(levels["Step 0 done, redirected to the correct cluster URL"], "INFO")
+        retries = [message for message, level in levels.items()
+                   if message.startswith("redirector attempt 1 failed") and level == "WARNING"]
+        self.assertEqual(len(retries), 1)
+        self.assertIn("Step 0 done, redirected to the correct cluster URL", result.output)
+        self.assertEqual(result.failure_log, "")
+
+    def test_failure_log(self):
+        '''Tests that the records kept in memory, debug ones included, are dumped on failure'''
+        result = run_simulation(SimConfig(ntp_server="ntp.sim", stub=StubBehaviour(
+            script=b"#!/bin/sh\nexit 3\n")))
+        self.assertEqual(result.status, "failed")
+        self.assertIn("DEBUG [MainThread] Polling NTP status.", result.failure_log)
+        self.assertIn("ERROR [MainThread] Bootstrap script failed with return code 3",
+                      result.failure_log)
+        self.assertNotIn("Polling NTP status.", result.output)
+
+    def record(self, config: SimConfig):
+        '''Runs the simulation recording a trace, returns the result and the trace path'''
+        workdir = self.enterContext(tempfile.TemporaryDirectory(prefix="ztpsim-trace-"))
+        path = os.path.join(workdir, "trace.jsonl.gz")
+        config.overrides = dict(config.overrides, RECORD_TRACE=True, TRACE_PATH=path)
+        return run_simulation(config), path
+
+    def event_names(self, metrics, kind):
+        return [event["name"] for event in metrics["events"] if event["kind"] == kind]
+
+    def test_trace_replay(self):
+        '''Tests that a recorded run is replayed without the device, faster if asked'''
+        token = make_token()
+        result, path = self.record(SimConfig(token=token, terminattr_delay=0.2))
+        self.assertSucceeded(result)
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.assertNotIn(token, f.read())
+
+        replay = replay_simulation(path, speed=0)
+        self.assertEqual(replay.status, "success", replay.error + "\n" + replay.output)
+        for kind in ("stage", "terminAttr", "http"):
+            self.assertEqual(sorted(self.event_names(replay.metrics, kind)),
+                             sorted(self.event_names(result.metrics, kind)))
+        self.assertLess(replay.wall_time, result.wall_time)
+
+        # The enrollment and the certsconfig lookup, run concurrently, take 0.2s each
+        replay = replay_simulation(path, speed=1)
+        self.assertEqual(replay.status, "success")
+        self.assertGreaterEqual(replay.metrics["stages"]["enroll"], 0.2)
+
+    def test_trace_replay_failure(self):
+        '''Tests that a failed run fails the same way when replayed'''
+        result, path = self.record(SimConfig(terminattr_unsupported="cvproxy"))
+        replay = replay_simulation(path)
+        self.assertEqual((replay.status, result.status), ("failed", "failed"))
+        self.assertIn("does not support -cvproxy", replay.error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+import calendar
+import gzip
+import json
+import os
+import tempfile
+import time
+import unittest
+from ztpsim import SimConfig, load_module, run_simulation
+
+ANALYZER_FILE = os.path.join("ZtpLogAnalyzer", "ztp_log_analyzer.py")
+
+ztp_log_analyzer = load_module("ztp_log_analyzer", ANALYZER_FILE)
+
+
+def rfc3164(epoch: float) -> str:
+    return time.strftime("%b %e %H:%M:%S", time.gmtime(epoch))
+
+
+def rfc3339(epoch: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch)) + \
+        f"{epoch % 1:.6f}"[1:] + "+00:00"
+
+
+def run_messages(version="1.0", region="cv-prod-us-central1-b", eos="4.30.1F",
+                 steps=(10, 20, 5, 3, 0, 40), failure=None):
+    '''
+    (offset, message) of a run of a script version logging no durations, with the given
+    time spent on the first steps, followed by the failure message if any
+    '''
+    messages = [(0, f"Current Custom Bootstrap Script Version: {version}"),
+                (1, 'Device inventory: {"serialNum": "SN1", "softwareVersion": "%s"}' % eos)]
+    offset = 0
+    for step, duration in zip(["0", "1", "2", "3.1", "3.2.1", "3.2.2"], steps):
+        offset += duration
+        messages.append((offset, f"Step {step} done, ..."))
+        if step == "0":
+            messages.append((offset, f"enrollAddr - apiserver.{region}.arista.io"))
+    if failure:
+        messages.append((offset + 1, failure))
+    return messages
+
+
+class ZtpLogAnalyzerTest(unittest.TestCase):
+    '''Tests of the rollout reports built from the logs of the bootstrap script'''
+
+    def setUp(self):
+        self.dir = self.enterContext(tempfile.TemporaryDirectory(prefix="ztplogs-"))
+
+    def write_syslog(self, name: str, lines: list[str]) -> str:
+        path = os.path.join(self.dir, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def syslog_lines(self, host: str, start: float, messages, timestamp=rfc3164):
+        return [f"{timestamp(start + offset)} {host} {message}" for offset, message in messages]
+
+    def test_step_timeline(self):
+        '''Tests that the stages are timed from the steps when no durations are logged'''
+        start = calendar.timegm((2026, 10, 1, 10, 0, 0))
+        lines = ["Oct  1 09:59:59 leaf1 Ebra: %LINEPROTO-5-UPDOWN: Line protocol is up"]
+        lines += self.syslog_lines("leaf1", start, run_messages())
+        report = ztp_log_analyzer.analyze([self.write_syslog("syslog.gz", lines)], year=2026)
+        attempt, = report.attempts
+        self.assertEqual((attempt.device, attempt.version, attempt.outcome()),
+                         ("leaf1", "1.0", "success"))
+        self.assertEqual((attempt.region, attempt.eosVersion),
+                         ("cv-prod-us-central1-b", "4.30.1F"))
+        self.assertEqual(attempt.durations(), {"redirector": 10, "enroll": 20,
+                                               "certsconfig": 5, "fetch": 3, "exec": 40,
+                                               "total": 78})
+        self.assertEqual(attempt.timeline()["steps"][-1], ("3.2.2", 78.0))
+
+    def test_simulated_run(self):
+        '''Tests that the durations logged by the current script version are used'''
+        result = run_simulation(SimConfig(ntp_server="ntp.sim", ntp_sync_after=0.2))
+        self.assertEqual(result.status, "success")
+        lines = [f"{rfc3339(record['time'])} leaf1 {record['message']}"
+                 for record in result.log_records]
+        path = self.write_syslog("leaf1.log", lines)
+        attempt, = ztp_log_analyzer.analyze([path]).attempts
+        self.assertEqual(attempt.outcome(), "success")
+        self.assertEqual(attempt.eosVersion, "4.32.1F")
+        durations = attempt.durations()
+        for stage, duration in result.stages.items():
+            self.assertAlmostEqual(durations[stage], duration, delta=0.002)
+        self.assertIn("ntp", durations)
+
+        # The JSON lines log of the script is named after its device
+        with open(os.path.join(self.dir, "leaf2.jsonl"), "w", encoding="utf-8") as f:
+            for record in result.log_records:
+                f.write(json.dumps(record) + "\n")
+        attempt, = ztp_log_analyzer.analyze([f.name]).attempts
+        self.assertEqual((attempt.device, attempt.outcome()), ("leaf2", "success"))
+        self.assertEqual(attempt.durations(), durations)
+
+    def test_failure_breakdown(self):
+        '''Tests the failures by region and EOS version, and their reasons'''
+        start = 1790000000.0
+        exec_failure = "Bootstrap script failed with return code 3"
+        runs = [("leaf1", run_messages(region="cv-prod-euwest-2", eos="4.30.1F")),
+                ("leaf2", run_messages(region="cv-prod-euwest-2", eos="4.31.0F",
+                                       steps=(10, 20, 5, 3, 0), failure=exec_failure)),
+                ("leaf3", run_messages(region="cv-prod-us-central1-b", eos="4.31.0F",
+                                       steps=(10, 20, 5, 3, 0), failure=exec_failure)),
+                ("leaf4", run_messages(region="cv-prod-us-central1-b", eos="4.31.0F",
+                                       steps=(10,),
+                                       failure="Failed to retrieve certs, err: exit 1"))]
+        lines = []
+        for host, messages in runs:
+            lines += self.syslog_lines(host, start, messages, timestamp=rfc3339)
+        # A later attempt of leaf4, only getting as far as the redirector
+        lines += self.syslog_lines("leaf4", start + 3600, run_messages(steps=(10,)),
+                                   timestamp=rfc3339)
+        report = ztp_log_analyzer.analyze([self.write_syslog("syslog", lines)]).asDict()
+        self.assertEqual((report["devices"], report["attempts"]), (4, 5))
+        self.assertEqual(report["outcomes"], {"success": 1, "failed": 3, "incomplete": 1})
+        self.assertEqual(report["reasons"], {exec_failure: 2, "Failed to retrieve certs": 1})
+        self.assertEqual({region: (row["attempts"], row["failed"])
+                          for region, row in report["byRegion"].items()},
+                         {"cv-prod-euwest-2": (2, 1), "cv-prod-us-central1-b": (3, 2)})
+        self.assertEqual(report["byEosVersion"]["4.31.0F"]["reasons"],
+                         {exec_failure: 2, "Failed to retrieve certs": 1})
+        self.assertEqual(report["latencies"]["redirector"]["count"], 5)
+        self.assertEqual(report["latencies"]["exec"]["count"], 1)
+
+    def test_metrics_summary(self):
+        '''Tests that the ZTP metrics summary of a run prevails'''
+        summary = {"version": "2.0.1", "status": "failed", "wallTime": 12.5,
+                   "stages": {"redirector": 1.5, "enroll": 0.0},
+                   "events": [{"kind": "stage", "name": "enroll", "error": "failed"}]}
+        messages = [(0, "Current Custom Bootstrap Script Version: 2.0.1"),
+                    (0, "Stage enroll skipped, completed by an earlier attempt"),
+                    (2, "Step 0 done, redirected to the correct cluster URL"),
+                    (2, "Connect probe to 10.0.0.1 failed, err: refused, retrying"),
+                    (12, f"ZTP metrics: {json.dumps(summary)}")]
+        lines = self.syslog_lines("leaf1", 1790000000.0, messages, timestamp=rfc3339)
+        attempt, = ztp_log_analyzer.analyze([self.write_syslog("syslog", lines)]).attempts
+        self.assertEqual((attempt.outcome(), attempt.reason()), ("failed", "unknown"))
+        self.assertEqual(attempt.durations(), {"redirector": 1.5})
+
+    def test_scan_aggregates(self):
+        '''Tests that a scan returns the attempts of the file rather than its messages'''
+        start = 1790000000.0
+        lines = self.syslog_lines("leaf1", start, run_messages()[4:], timestamp=rfc3339)
+        for index in range(3):
+            lines += self.syslog_lines("leaf1", start + 3600 * (index + 1), run_messages(),
+                                       timestamp=rfc3339)
+        scanned = ztp_log_analyzer.scanFile(self.write_syslog("syslog", lines))
+        self.assertEqual([(device, attempt.continuation) for device, _, _, attempt in scanned],
+                         [("leaf1", True)] + [("leaf1", False)] * 3)
+        self.assertEqual(len(scanned[1][3].steps), 6)
+
+    def test_parallel_workers(self):
+        '''Tests that the workers give the same report, attempts spanning rotated files'''
+        start = 1790000000.0
+        paths = []
+        for index in range(4):
+            lines = []
+            for device in range(10):
+                messages = run_messages(steps=(device, 10, 5, 3, 0, index + 1))
+                lines += self.syslog_lines(f"leaf{index}-{device}", start, messages,
+                                           timestamp=rfc3339)
+            paths.append(self.write_syslog(f"syslog.{index}.gz", lines))
+        # The end of an attempt in another file
+        lines = self.syslog_lines("spine1", start, run_messages()[:4], timestamp=rfc3339)
+        paths.append(self.write_syslog("spine1.1.gz", lines))
+        lines = self.syslog_lines("spine1", start, run_messages()[4:], timestamp=rfc3339)
+        paths.append(self.write_syslog("spine1.0.gz", lines))
+
+        sequential = ztp_log_analyzer.analyze(paths).asDict()
+        self.assertEqual(ztp_log_analyzer.analyze(paths, workers=3).asDict(), sequential)
+        self.assertEqual(sequential["outcomes"], {"success": 41})
+        self.assertEqual(sequential["latencies"]["exec"],
+                         {"count": 41, "p50": 3.0, "p90": 4.0, "p99": 25.6, "max": 40.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
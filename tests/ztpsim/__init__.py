@@ -0,0 +1,28 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''
+ZTP simulation harness: runs BootstrapScriptWithToken/bootstrap.py end to end on any
+Linux box, against stub EOS modules, fake EOS executables and a local CVaaS stub.
+'''
+
+from .harness import (ReplayResult, SimConfig, SimResult, StartupResult, load_bootstrap_module,
+                      load_module, make_token, measure_startup, replay_simulation,
+                      run_simulation)
+from .server import CvaasStub, StubBehaviour
+
+__all__ = [
+    "CvaasStub",
+    "ReplayResult",
+    "SimConfig",
+    "SimResult",
+    "StartupResult",
+    "StubBehaviour",
+    "load_bootstrap_module",
+    "load_module",
+    "make_token",
+    "measure_startup",
+    "replay_simulation",
+    "run_simulation",
+]
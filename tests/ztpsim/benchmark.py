@@ -0,0 +1,122 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''
+End-to-end benchmark of the bootstrap script against the ZTP simulation.
+Run from the repository root:
+
+    python -m tests.ztpsim.benchmark --runs 5 --terminattr-delay 0.5 --ntp-server ntp.sim
+
+--startup measures the interpreter startup and imports with `-X importtime` instead.
+'''
+
+import argparse
+import json
+import statistics
+
+from .harness import SimConfig, measure_startup, run_simulation
+from .server import StubBehaviour
+
+
+def parse_args() -> argparse.Namespace:
+    '''Parses the command line'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deployment", choices=["cloud", "onprem", "both"], default="both")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--ntp-server", default="")
+    parser.add_argument("--ntp-sync-after", type=float, default=0.0)
+    parser.add_argument("--sysdb-delay", type=float, default=0.0)
+    parser.add_argument("--fastcli-delay", type=float, default=0.0)
+    parser.add_argument("--terminattr-delay", type=float, default=0.0)
+    parser.add_argument("--redirector-latency", type=float, default=0.0)
+    parser.add_argument("--bootstrap-latency", type=float, default=0.0)
+    parser.add_argument("--redirector-failures", type=int, default=0)
+    parser.add_argument("--bootstrap-failures", type=int, default=0)
+    parser.add_argument("--bootstrap-drops", type=int, default=0)
+    parser.add_argument("--script-size", type=int, default=0,
+                        help="pad the served bootstrap script to this many bytes")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=JSON",
+                        help="override a constant of the bootstrap script, e.g. "
+                             "PIPELINED_RUN=false")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure the interpreter startup and imports of the script")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    return parser.parse_args()
+
+
+def build_config(args: argparse.Namespace, deployment: str) -> SimConfig:
+    '''Builds the simulation config of one deployment from the command line'''
+    script = b"#!/bin/sh\nexit 0\n"
+    if args.script_size > len(script):
+        script += b"#" * (args.script_size - len(script) - 1) + b"\n"
+    overrides = {}
+    for override in args.set:
+        name, _, value = override.partition("=")
+        overrides[name] = json.loads(value)
+    stub = StubBehaviour(redirector_latency=args.redirector_latency,
+                         bootstrap_latency=args.bootstrap_latency,
+                         redirector_failures=args.redirector_failures,
+                         bootstrap_failures=args.bootstrap_failures,
+                         bootstrap_drops=args.bootstrap_drops, script=script)
+    return SimConfig(deployment=deployment, ntp_server=args.ntp_server,
+                     ntp_sync_after=args.ntp_sync_after, sysdb_delay=args.sysdb_delay,
+                     fastcli_delay=args.fastcli_delay,
+                     terminattr_delay=args.terminattr_delay, stub=stub,
+                     overrides=overrides)
+
+
+def report(deployment: str, results: list) -> None:
+    '''Prints per-stage wall time and allocation statistics'''
+    failed = [result for result in results if result.status != "success"]
+    print(f"\n{deployment}: {len(results)} runs, {len(failed)} failed")
+    for result in failed:
+        print(f"  failure: {result.error}")
+    stages = []
+    for result in results:
+        stages.extend(stage for stage in result.stages if stage not in stages)
+    print(f"  {'stage':<14}{'median s':>10}{'min s':>10}{'max s':>10}{'alloc KiB':>12}")
+    rows = [(stage, [r.stages[stage] for r in results if stage in r.stages],
+             [r.allocations.get(stage, 0) for r in results]) for stage in stages]
+    rows.append(("total (peak)", [r.wall_time for r in results], [r.peak_memory for r in results]))
+    for stage, times, allocs in rows:
+        print(f"  {stage:<14}{statistics.median(times):>10.3f}{min(times):>10.3f}"
+              f"{max(times):>10.3f}{statistics.mean(allocs) / 1024:>12.1f}")
+
+
+def report_startup(runs: int) -> None:
+    '''Prints the startup wall time and the slowest top level imports'''
+    results = [measure_startup() for _ in range(runs)]
+    wall_times = [result.wall_time for result in results]
+    print(f"startup: {runs} runs, median {statistics.median(wall_times):.3f}s, "
+          f"min {min(wall_times):.3f}s, max {max(wall_times):.3f}s")
+    imports = {}
+    for result in results:
+        for name, cumulative in result.imports.items():
+            imports.setdefault(name, []).append(cumulative)
+    total = sum(statistics.median(times) for times in imports.values())
+    print(f"  top level imports: {total * 1000:.1f}ms")
+    slowest = sorted(imports.items(), key=lambda item: -statistics.median(item[1]))
+    for name, times in slowest[:10]:
+        print(f"  {name:<30}{statistics.median(times) * 1000:>8.1f}ms")
+
+
+def main() -> None:
+    '''Runs the benchmark'''
+    args = parse_args()
+    if args.startup:
+        report_startup(args.runs)
+        return
+    deployments = ["cloud", "onprem"] if args.deployment == "both" else [args.deployment]
+    for deployment in deployments:
+        config = build_config(args, deployment)
+        results = [run_simulation(config) for _ in range(args.runs)]
+        if args.json:
+            print(json.dumps([result.__dict__ for result in results], indent=2))
+        else:
+            report(deployment, results)
+
+
+if __name__ == "__main__":
+    main()
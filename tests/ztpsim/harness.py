@@ -0,0 +1,343 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''
+Runs the bootstrap script end to end against the stub EOS modules, the fake FastCli,
+TerminAttr and ntpstat executables and the CVaaS stub server.
+'''
+
+import base64
+import contextlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from dataclasses import dataclass, field
+
+from .server import IMAGE_PATH, CvaasStub, StubBehaviour
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(SIM_DIR, "stubs")
+BIN_DIR = os.path.join(SIM_DIR, "bin")
+REPO_DIR = os.path.dirname(os.path.dirname(SIM_DIR))
+BOOTSTRAP_FILE = os.path.join(REPO_DIR, "BootstrapScriptWithToken", "bootstrap.py")
+
+_module_ids = itertools.count()
+
+
+@dataclass
+class SimConfig:
+    '''Describes a simulated device and the delays of the systems it talks to'''
+    deployment: str = "cloud"  # "cloud" or "onprem"
+    ntp_server: str = ""  # NTP is only configured and polled when set
+    ntp_sync_after: float = 0.0
+    sysdb_delay: float = 0.0
+    tpm_delay: float = 0.0  # Added to the Sysdb delay of the TPM status
+    fastcli_delay: float = 0.0
+    fastcli_fail: str = ""  # Prefixes of the commands FastCli rejects, comma separated
+    terminattr_delay: float = 0.0
+    terminattr_fail: str = ""  # "enrollonly", "certsconfig", "version" and/or "help"
+    terminattr_version: str = "1.29.0"
+    # Flags the fake TerminAttr rejects, e.g. "cvproxy", comma separated
+    terminattr_unsupported: str = ""
+    # Seconds the client certificate issued by the fake TerminAttr remains valid
+    cert_validity: float = 365 * 24 * 3600
+    # Enrollment token, a fresh one is made when empty
+    token: str = ""
+    # Directory standing in for /persist, holding the client certificates and the state
+    # cache. Sharing it between runs simulates ZTP attempts of the same device.
+    persist_dir: str = ""
+    # Content of flash:/EOS.swi before the run
+    flash_image: bytes = b""
+    stub: StubBehaviour = field(default_factory=StubBehaviour)
+    # Module level constants of the bootstrap script to override, e.g. PIPELINED_RUN
+    overrides: dict = field(default_factory=dict)
+
+
+@dataclass
+class SimResult:
+    '''Outcome of a simulated run'''
+    status: str
+    error: str
+    wall_time: float
+    stages: dict[str, float]
+    # Net bytes allocated per stage and peak traced memory of the whole run
+    allocations: dict[str, int]
+    peak_memory: int
+    metrics: dict
+    server_stats: dict[str, int]
+    # Commands run through FastCli, in order
+    cli_commands: list[str]
+    # Records of the JSON lines log file, and records dumped because the run failed
+    log_records: list[dict]
+    failure_log: str
+    # Last redirector query and bootstrap script request headers received by the stub
+    redirector_payload: dict
+    bootstrap_headers: dict[str, str]
+    # Everything the script printed
+    output: str
+
+
+@dataclass
+class ReplayResult:
+    '''Outcome of the replay of a recorded run'''
+    status: str
+    error: str
+    wall_time: float
+    metrics: dict
+    output: str
+
+
+@dataclass
+class StartupResult:
+    '''Interpreter startup cost of the bootstrap script, up to the start of main()'''
+    wall_time: float
+    # Cumulative import time in seconds of each module imported at the top level
+    imports: dict[str, float]
+
+
+def measure_startup() -> StartupResult:
+    '''
+    Runs the bootstrap script with `-X importtime` and without any user input, so that
+    it exits as soon as main() starts, measuring the interpreter startup and the imports
+    done before the first step.
+    '''
+    env = dict(os.environ, PYTHONPATH=STUBS_DIR)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", BOOTSTRAP_FILE], env=env,
+                          capture_output=True, text=True, check=False)
+    wall_time = time.perf_counter() - start
+    imports = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the module importing them
+        if not name.startswith("  "):
+            imports[name.strip()] = int(cumulative) / 1e6
+    return StartupResult(wall_time=wall_time, imports=imports)
+
+
+def make_token(lifetime: int = 3600, **claims) -> str:
+    '''Builds an unsigned JWT shaped enrollment token, with extra claims if given'''
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+    claims = dict({"exp": int(time.time()) + lifetime, "iat": int(time.time())}, **claims)
+    return f"{encode({'alg': 'RS256', 'typ': 'JWT'})}.{encode(claims)}.signature"
+
+
+def load_module(name: str, path: str) -> types.ModuleType:
+    '''
+    Loads the script at `path`, relative to the repository root, as the module `name`. It
+    is registered in sys.modules so that the worker processes it starts can unpickle it, and
+    the test files loading the same module share it.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_bootstrap_module():
+    '''Loads a fresh copy of the bootstrap script, with the stub EOS modules importable'''
+    if STUBS_DIR not in sys.path:
+        sys.path.insert(0, STUBS_DIR)
+    name = f"bootstrap_sim_{next(_module_ids)}"
+    spec = importlib.util.spec_from_file_location(name, BOOTSTRAP_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _environment(config: SimConfig, workdir: str, persist_dir: str) -> dict[str, str]:
+    return {
+        "ZTPSIM_SYSDB_DELAY": str(config.sysdb_delay),
+        "ZTPSIM_TPM_DELAY": str(config.tpm_delay),
+        "ZTPSIM_FASTCLI_DELAY": str(config.fastcli_delay),
+        "ZTPSIM_FASTCLI_FAIL": config.fastcli_fail,
+        "ZTPSIM_TERMINATTR_DELAY": str(config.terminattr_delay),
+        "ZTPSIM_TERMINATTR_FAIL": config.terminattr_fail,
+        "ZTPSIM_TERMINATTR_VERSION": config.terminattr_version,
+        "ZTPSIM_TERMINATTR_UNSUPPORTED": config.terminattr_unsupported,
+        "ZTPSIM_NTP_START": str(time.time()),
+        "ZTPSIM_NTP_SYNC_AFTER": str(config.ntp_sync_after),
+        "ZTPSIM_CERT_FILE": os.path.join(persist_dir, "client.crt"),
+        "ZTPSIM_KEY_FILE": os.path.join(persist_dir, "client.key"),
+        "ZTPSIM_CERT_VALIDITY": str(config.cert_validity),
+        "ZTPSIM_FASTCLI_LOG": os.path.join(workdir, "fastcli.log"),
+    }
+
+
+def _configure(module, config: SimConfig, stub: CvaasStub, workdir: str,
+               persist_dir: str) -> None:
+    if config.deployment == "cloud":
+        # The stub is also the proxy, any plain HTTP host name ends up being served by it
+        module.cvAddr = "http://www.arista.io"
+        module.cvproxy = stub.url
+    else:
+        module.cvAddr = stub.url.replace("http://", "")
+        module.cvproxy = ""
+    module.proxies = {"https": module.cvproxy, "http": module.cvproxy}
+    module.enrollmentToken = config.token or make_token()
+    module.ntpServer = config.ntp_server
+    # The stub doubles as the local image server
+    module.eosUrl = stub.url + IMAGE_PATH if config.stub.image else ""
+
+    module.TOKEN_FILE_PATH = os.path.join(workdir, "token.tok")
+    module.BOOT_SCRIPT_PATH = os.path.join(persist_dir, "bootstrap-script")
+    module.METRICS_FILE_PATH = os.path.join(workdir, "metrics.json")
+    module.SWI_VERSION_FILE = os.path.join(workdir, "swi-version")
+    module.ARCH_FILE = os.path.join(workdir, "arch")
+    module.TERMINATTR_BINARY = os.path.join(BIN_DIR, "TerminAttr")
+    module.NTPSTAT_BINARY = os.path.join(BIN_DIR, "ntpstat")
+    module.OPENSSL_BINARY = os.path.join(BIN_DIR, "openssl")
+    module.EOS_IMAGE_PATH = os.path.join(workdir, "EOS.swi")
+    module.PRESTAGED_IMAGE_PATH = os.path.join(workdir, "EOS.swi.prestaged")
+    module.STATE_CACHE_PATH = os.path.join(persist_dir, "ztp-bootstrap-state.json")
+    module.CliManager.FAST_CLI_BINARY = os.path.join(BIN_DIR, "FastCli")
+    # There is no syslog to send to
+    module.SYSLOG_ADDRESS = ""
+    module.LOG_FILE_PATH = os.path.join(workdir, "log.jsonl")
+    module.LOG_DUMP_PATH = os.path.join(workdir, "failure.log")
+    for name, value in config.overrides.items():
+        setattr(module, name, value)
+
+
+def _prepare_workdir(workdir: str, persist_dir: str) -> None:
+    files = {
+        os.path.join(persist_dir, "client.crt"): "certificate",
+        os.path.join(persist_dir, "client.key"): "key",
+        os.path.join(workdir, "swi-version"): "SWI_VERSION=4.32.1F\nSWI_ARCH=x86_64\n",
+        os.path.join(workdir, "arch"): "x86_64\n",
+    }
+    for path, content in files.items():
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+def _track_stage_allocations(module, allocations: dict[str, int]) -> None:
+    '''Wraps BootstrapManager.timeStage to record the memory allocated by each stage'''
+    time_stage = module.BootstrapManager.timeStage
+
+    def traced_time_stage(manager, stage, func, *args):
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            return time_stage(manager, stage, func, *args)
+        finally:
+            allocations[stage] = tracemalloc.get_traced_memory()[0] - before
+
+    module.BootstrapManager.timeStage = traced_time_stage
+
+
+def _read_lines(path: str) -> list[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def run_simulation(config: SimConfig | None = None) -> SimResult:
+    '''Runs the bootstrap script main() once against fresh fakes'''
+    config = config or SimConfig()
+    allocations: dict[str, int] = {}
+    saved_environ = dict(os.environ)
+    saved_sigterm = signal.getsignal(signal.SIGTERM)
+    with tempfile.TemporaryDirectory(prefix="ztpsim-") as workdir, \
+            CvaasStub(config.stub) as stub:
+        persist_dir = config.persist_dir or workdir
+        _prepare_workdir(workdir, persist_dir)
+        os.environ.update(_environment(config, workdir, persist_dir))
+        if config.flash_image:
+            with open(os.path.join(workdir, "EOS.swi"), "wb") as f:
+                f.write(config.flash_image)
+        module = load_bootstrap_module()
+        _configure(module, config, stub, workdir, persist_dir)
+        _track_stage_allocations(module, allocations)
+
+        status, error = "success", ""
+        output = io.StringIO()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                try:
+                    module.main()
+                finally:
+                    module.stopLogger()
+        except SystemExit as e:
+            if e.code:
+                status, error = "failed", str(e.code)
+        except Exception as e:  # pylint: disable=broad-except
+            status, error = "failed", f"{type(e).__name__}: {e}"
+        finally:
+            wall_time = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            signal.signal(signal.SIGTERM, saved_sigterm)
+            # The simulation reports the metrics itself, nothing to export at exit
+            module.metrics.exported = True
+            # As at exit, the image prestaged for nothing is removed
+            module.discardImagePrestage()
+            if module.trace is not None:
+                module.trace.close(module.metrics.status)
+            module.CliManager.getInstance().closeSession()
+
+        summary = module.metrics.summary()
+        cli_commands = _read_lines(os.path.join(workdir, "fastcli.log"))
+        log_records = [json.loads(line) for line in _read_lines(os.path.join(workdir,
+                                                                             "log.jsonl"))]
+        failure_log = "\n".join(_read_lines(os.path.join(workdir, "failure.log")))
+        return SimResult(status=status, error=error, wall_time=wall_time,
+                         stages=summary["stages"], allocations=allocations,
+                         peak_memory=peak_memory, metrics=summary,
+                         server_stats=dict(stub.stats), cli_commands=cli_commands,
+                         log_records=log_records, failure_log=failure_log,
+                         redirector_payload=stub.redirector_payload,
+                         bootstrap_headers=stub.bootstrap_headers,
+                         output=output.getvalue())
+
+
+def replay_simulation(trace_path: str, speed: float = 0.0) -> ReplayResult:
+    '''
+    Replays a trace recorded by a run with RECORD_TRACE, without any of the fakes, the
+    way it is replayed away from the device
+    '''
+    module = load_bootstrap_module()
+    saved_sigterm = signal.getsignal(signal.SIGTERM)
+    status, error = "success", ""
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            try:
+                module.main(["--replay", trace_path, "--speed", str(speed)])
+            finally:
+                module.stopLogger()
+    except SystemExit as e:
+        if e.code:
+            status, error = "failed", str(e.code)
+    except Exception as e:  # pylint: disable=broad-except
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    finally:
+        wall_time = time.perf_counter() - start
+        signal.signal(signal.SIGTERM, saved_sigterm)
+        module.metrics.exported = True
+        # Files the replay wrote, in place of flash and /persist
+        shutil.rmtree(os.path.dirname(module.STATE_CACHE_PATH), ignore_errors=True)
+    return ReplayResult(status=status, error=error, wall_time=wall_time,
+                        metrics=module.metrics.summary(), output=output.getvalue())
@@ -0,0 +1,194 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''
+Local stand-in for CVaaS: serves the redirector and the /ztp/bootstrap endpoint, and
+optionally an EOS image as a local image server would.
+It also accepts absolute-form requests, so it can act as the `cvproxy` for plain HTTP
+URLs, which is how cloud deployments are simulated without name resolution or TLS.
+'''
+
+import base64
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+REDIRECTOR_PATH = "/api/v3/services/arista.redirector.v1.AssignmentService/GetOne"
+BOOTSTRAP_PATH = "/ztp/bootstrap"
+IMAGE_PATH = "/images/EOS.swi"
+# Host handed out by the simulated redirector, reached through the stub acting as proxy
+ASSIGNED_HOST = "http://www.cv-sim.arista.io"
+
+
+@dataclass
+class StubBehaviour:
+    '''Latency and failures injected by the stub'''
+    redirector_latency: float = 0.0
+    bootstrap_latency: float = 0.0
+    # Number of requests answered with a 503 before the endpoint starts to succeed
+    redirector_failures: int = 0
+    bootstrap_failures: int = 0
+    # Hosts whose redirector is down, all the queries sent to them being answered with a 503
+    redirector_down_hosts: list[str] = field(default_factory=list)
+    # Number of bootstrap downloads cut halfway through the body, or after the fraction of
+    # it given by bootstrap_cuts for each of them
+    bootstrap_drops: int = 0
+    bootstrap_cuts: list[float] = field(default_factory=list)
+    # Number of bootstrap Range requests answered with the whole script, as by a backend
+    # not supporting them
+    bootstrap_ignored_ranges: int = 0
+    script: bytes = b"#!/bin/sh\nexit 0\n"
+    # Served instead of the script from the second bootstrap request on, as when it is
+    # regenerated between attempts, when not empty
+    updated_script: bytes = b""
+    # Whether to advertise the digest of the bootstrap script, and its ETag, honouring the
+    # If-Range requests with it
+    digest: bool = True
+    etag: bool = True
+    hosts: list[str] = field(default_factory=lambda: [ASSIGNED_HOST])
+    # EOS image served at IMAGE_PATH, along with its sha512sum, when not empty
+    image: bytes = b""
+    image_ranges: bool = True
+
+
+class CvaasStub(ThreadingHTTPServer):
+    '''Threaded HTTP server playing the redirector and the bootstrap endpoint'''
+    daemon_threads = True
+
+    def __init__(self, behaviour: StubBehaviour | None = None):
+        super().__init__(("127.0.0.1", 0), _CvaasHandler)
+        self.behaviour = behaviour or StubBehaviour()
+        self.stats: dict[str, int] = {}
+        # Body of the last redirector query and headers of the last bootstrap request
+        self.redirector_payload: dict = {}
+        self.bootstrap_headers: dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        '''Base URL of the stub'''
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, key: str) -> int:
+        '''Increments the given counter, returning its previous value'''
+        with self.lock:
+            value = self.stats.get(key, 0)
+            self.stats[key] = value + 1
+            return value
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class _CvaasHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: CvaasStub
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: dict | None = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''Answers redirector queries'''
+        behaviour = self.server.behaviour
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path != REDIRECTOR_PATH:
+            self._send(404)
+            return
+        payload = self.server.redirector_payload = json.loads(body)
+        time.sleep(behaviour.redirector_latency)
+        if urlsplit(self.path).netloc in behaviour.redirector_down_hosts:
+            self.server.count("redirectorDown")
+            self._send(503)
+            return
+        if self.server.count("redirector") < behaviour.redirector_failures:
+            self._send(503)
+            return
+        assignment = [{"value": {"key": payload.get("key"), "clusters": {"values": [
+            {"hosts": {"values": behaviour.hosts}}]}}}]
+        self._send(200, json.dumps(assignment).encode(), {"Content-Type": "application/json"})
+
+    def serve_image(self, path: str) -> None:
+        '''Serves the EOS image, honouring Range requests, and its checksum'''
+        image = self.server.behaviour.image
+        if path == IMAGE_PATH + ".sha512sum":
+            self.server.count("imageChecksum")
+            checksum = f"{hashlib.sha512(image).hexdigest()}  EOS.swi\n"
+            self._send(200, checksum.encode())
+            return
+        self.server.count("image")
+        byteRange = self.headers.get("Range", "")
+        if not byteRange.startswith("bytes=") or not self.server.behaviour.image_ranges:
+            self._send(200, image)
+            return
+        start, end = byteRange[len("bytes="):].split("-")
+        start, end = int(start), min(int(end or len(image) - 1), len(image) - 1)
+        self._send(206, image[start:end + 1],
+                   {"Content-Range": f"bytes {start}-{end}/{len(image)}"})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''Serves the bootstrap script, honouring Range requests'''
+        behaviour = self.server.behaviour
+        path = urlsplit(self.path).path
+        if behaviour.image and path.startswith(IMAGE_PATH):
+            self.serve_image(path)
+            return
+        if path != BOOTSTRAP_PATH:
+            self._send(404)
+            return
+        self.server.bootstrap_headers = dict(self.headers.items())
+        time.sleep(behaviour.bootstrap_latency)
+        attempt = self.server.count("bootstrap")
+        if attempt < behaviour.bootstrap_failures:
+            self._send(503)
+            return
+
+        script = behaviour.updated_script if behaviour.updated_script and attempt else \
+            behaviour.script
+        headers = {}
+        if behaviour.digest:
+            digest = base64.b64encode(hashlib.sha256(script).digest()).decode()
+            headers["Repr-Digest"] = f"sha-256=:{digest}:"
+        etag = f'"{hashlib.sha256(script).hexdigest()[:16]}"'
+        if behaviour.etag:
+            headers["ETag"] = etag
+        status, body = 200, script
+        byteRange = self.headers.get("Range", "")
+        if byteRange.startswith("bytes=") and self.headers.get("If-Range", etag) == etag and \
+                self.server.count("bootstrapRange") >= behaviour.bootstrap_ignored_ranges:
+            start = int(byteRange[len("bytes="):].split("-")[0])
+            status, body = 206, script[start:]
+            headers["Content-Range"] = f"bytes {start}-{len(script) - 1}/{len(script)}"
+
+        drop = attempt - behaviour.bootstrap_failures
+        if drop < behaviour.bootstrap_drops:
+            # Announce the full body but only send part of it
+            cut = behaviour.bootstrap_cuts[drop] if drop < len(behaviour.bootstrap_cuts) \
+                else 0.5
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:int(len(body) * cut)])
+            self.close_connection = True
+            return
+        self._send(status, body, headers)
@@ -0,0 +1,10 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''Stub of the EOS Cell module used by the ZTP simulation'''
+
+
+def cellId() -> int:
+    '''Returns the cell id of the simulated supervisor'''
+    return 1
@@ -0,0 +1,39 @@
+# Copyright (c) 2026 Arista Networks, Inc. All rights reserved.
+# Use of this source code is governed by the Apache License 2.0
+# that can be found in the COPYING file.
+
+'''
+Stub of the EOS SysdbHelperUtils module used by the ZTP simulation.
+Every entity lookup sleeps for ZTPSIM_SYSDB_DELAY seconds to model a Sysdb round trip,
+and the TPM status lookup ZTPSIM_TPM_DELAY more seconds.
+'''
+
+import os
+import time
+from types import SimpleNamespace
+
+SERIAL_NUMBER = "SIM0000000001"
+SYSTEM_MAC = "00:1c:73:00:00:01"
+MODEL_NAME = "DCS-7050SX3-48YC8"
+HARDWARE_REV = "11.00"
+
+
+class SysdbPathHelper:
+    '''Serves the few Sysdb entities read by the bootstrap script'''
+
+    def __init__(self, sysname: str):
+        self.sysname = sysname
+
+    def getEntity(self, path: str) -> SimpleNamespace:  # pylint: disable=invalid-name
+        '''Returns the entity mounted at the given path'''
+        time.sleep(float(os.environ.get("ZTPSIM_SYSDB_DELAY", "0")))
+        if path == "hardware/entmib":
+            return SimpleNamespace(
+                systemMacAddr=SYSTEM_MAC,
+                root=SimpleNamespace(serialNum=SERIAL_NUMBER, modelName=MODEL_NAME,
+                                     hardwareRev=HARDWARE_REV))
+        if path.endswith("/hardware/tpm/status"):
+            time.sleep(float(os.environ.get("ZTPSIM_TPM_DELAY", "0")))
+            return SimpleNamespace(tpmVersion="2.0", firmwareVersion="7.2.3.1",
+                                   boardValidated=True)
+        raise KeyError(f"No simulated Sysdb entity at {path}")